@@ -1,36 +1,111 @@
 from django.contrib import admin
-from .models import FinancialYear, Earning, Expense, BusinessCost, Depreciation, PersonalDetails
+from django.db.models import F
+from .bulk import reassign_financial_years, recompute_gst
+from .depreciation import recompute
+from .models import FinancialYear, Earning, Expense, BusinessCost, Depreciation, PersonalDetails, TaxBracket, GSTRate, GSTReturn, ReportJob
+
+class TaxBracketInline(admin.TabularInline):
+    model = TaxBracket
+    extra = 0
+
+class GSTRateInline(admin.StackedInline):
+    model = GSTRate
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables that grow to hundreds of thousands of rows:
+    no COUNT(*) of the whole table on every page, and foreign keys edited by
+    id instead of a <select> of every row.
+    """
+    show_full_result_count = False
+    list_per_page = 50
+
+@admin.action(description='Move to the financial year of their date')
+def reassign_year(modeladmin, request, queryset):
+    moved = reassign_financial_years(queryset)
+    modeladmin.message_user(request, f'{moved} rows moved to the financial year of their date.')
+
+@admin.action(description="Recompute GST at their year's rate")
+def recompute_gst_action(modeladmin, request, queryset):
+    updated = recompute_gst(queryset)
+    modeladmin.message_user(request, f'GST recomputed on {updated} rows.')
+
+@admin.action(description='Regenerate depreciation schedules')
+def regenerate_depreciation(modeladmin, request, queryset):
+    created = recompute(queryset)
+    modeladmin.message_user(request, f'{created} depreciation rows written.')
 
 class FinancialYearAdmin(admin.ModelAdmin):
-    #list_display = ['year', 'total_earnings', 'total_expenses']
-    list_display = ['year']
-    search_fields = ['year']
-
-class EarningAdmin(admin.ModelAdmin):
-    list_display = ['description', 'amount', 'date', 'financial_year', 'gst']
-    search_fields = ['description']
-    list_filter = ['financial_year']
-
-class ExpenseAdmin(admin.ModelAdmin):
-    list_display = ['description', 'amount', 'purchase_date', 'financial_year', 'gst']
-    search_fields = ['description']
-    list_filter = ['financial_year']
-
-class BusinessCostAdmin(admin.ModelAdmin):
-    list_display = ['description', 'amount', 'date', 'depreciation_rate', 'financial_year']
-    search_fields = ['description']
-    list_filter = ['financial_year']
-
-class DepreciationAdmin(admin.ModelAdmin):
-    list_display = ['expense', 'financial_year', 'current_value', 'tax_write_off', 'years_to_zero']
-    search_fields = ['expense']
-    list_filter = ['expense']
+    list_display = ['owner', 'year', 'total_earnings', 'total_expenses', 'schedule_version']
+    list_select_related = ['owner']
+    search_fields = ['year', 'owner__username']
+    list_filter = ['year']
+    inlines = [TaxBracketInline, GSTRateInline]
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # Totals come from each year's summary in the same query, not a SUM over the ledger
+        return super().get_queryset(request).annotate(
+            total_earnings=F('summary__total_earnings'), total_expenses=F('summary__total_expenses'),
+        )
+
+    @admin.display(ordering='total_earnings')
+    def total_earnings(self, obj):
+        return obj.total_earnings
+
+    @admin.display(ordering='total_expenses')
+    def total_expenses(self, obj):
+        return obj.total_expenses
+
+class EarningAdmin(LargeTableAdmin):
+    list_display = ['description', 'amount', 'date', 'owner', 'financial_year', 'gst']
+    list_select_related = ['owner', 'financial_year']
+    search_fields = ['description', 'owner__username']
+    list_filter = ['financial_year__year']
+    raw_id_fields = ['financial_year']
+    actions = [reassign_year, recompute_gst_action]
+
+class ExpenseAdmin(LargeTableAdmin):
+    list_display = ['description', 'amount', 'purchase_date', 'owner', 'financial_year', 'gst']
+    list_select_related = ['owner', 'financial_year']
+    search_fields = ['description', 'owner__username']
+    list_filter = ['financial_year__year', 'expense_type']
+    raw_id_fields = ['financial_year']
+    actions = [reassign_year, recompute_gst_action, regenerate_depreciation]
+
+class BusinessCostAdmin(LargeTableAdmin):
+    list_display = ['description', 'amount', 'date', 'depreciation_rate', 'depreciation_method', 'owner', 'financial_year']
+    list_select_related = ['owner', 'financial_year']
+    search_fields = ['description', 'owner__username']
+    list_filter = ['financial_year__year']
+    raw_id_fields = ['financial_year']
+    actions = [regenerate_depreciation]
+
+class DepreciationAdmin(LargeTableAdmin):
+    list_display = ['expense', 'business_cost', 'financial_year', 'current_value', 'tax_write_off', 'years_to_zero']
+    list_select_related = ['expense', 'business_cost', 'financial_year']
+    search_fields = ['expense__description', 'business_cost__description']
+    list_filter = ['financial_year__year']
+    raw_id_fields = ['expense', 'business_cost', 'financial_year']
 
 class PersonalDetailsAdmin(admin.ModelAdmin):
-    list_display = ['gst_registered', 'first_name', 'last_name', 'email', 'phone', 'permanent_income']
-    search_fields = ['first_name']
-    list_filter = ['last_name']
+    list_display = ['owner', 'gst_registered', 'first_name', 'last_name', 'email', 'phone', 'permanent_income']
+    list_select_related = ['owner']
+    search_fields = ['first_name', 'last_name', 'owner__username']
+    list_filter = ['gst_registered']
+    raw_id_fields = ['owner']
+
+class GSTReturnAdmin(LargeTableAdmin):
+    list_display = ['financial_year', 'months', 'period_start', 'period_end', 'gst_collected', 'gst_claimed']
+    list_select_related = ['financial_year']
+    list_filter = ['months']
+    raw_id_fields = ['financial_year']
 
+class ReportJobAdmin(LargeTableAdmin):
+    list_display = ['financial_year', 'data_version', 'status', 'created_at', 'finished_at']
+    list_select_related = ['financial_year']
+    list_filter = ['status']
+    raw_id_fields = ['financial_year']
 
 # Register the models with the admin site
 admin.site.register(FinancialYear, FinancialYearAdmin)
@@ -38,4 +113,6 @@ admin.site.register(Earning, EarningAdmin)
 admin.site.register(Expense, ExpenseAdmin)
 admin.site.register(Depreciation, DepreciationAdmin)
 admin.site.register(BusinessCost, BusinessCostAdmin)
-admin.site.register(PersonalDetails, PersonalDetailsAdmin)
\ No newline at end of file
+admin.site.register(PersonalDetails, PersonalDetailsAdmin)
+admin.site.register(GSTReturn, GSTReturnAdmin)
+admin.site.register(ReportJob, ReportJobAdmin)
@@ -0,0 +1,234 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import time
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.deconstruct import deconstructible
+from django.utils.http import content_disposition_header
+
+# Blobs are stored as MEDIA_ROOT/attachments/<first two hex digits>/<sha256><extension>
+BLOB_DIRECTORY = 'attachments'
+
+# Bytes read at a time when hashing a file that did not arrive as an upload,
+# and when sending part of a file
+CHUNK_SIZE = 64 * 1024
+
+# The file name of a blob, as opposed to a preview or marker beside it
+BLOB_FILE = re.compile(r'^[0-9a-f]{64}(\.[^.]+)?$')
+
+# Files beside a blob, named after it, that mark a preview as failed or queued
+MARKER_EXTENSIONS = {'.failed', '.pending'}
+
+# A single byte range, e.g. "bytes=0-1023", "bytes=1024-" or "bytes=-500"
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class HashingUploadMixin:
+    """Work out an upload's SHA-256 as its chunks arrive, and set it on the file as ``content_digest``."""
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_digest = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    """Keeps small uploads in memory, hashing them on the way in."""
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    """Streams large uploads to a temporary file, hashing them on the way in."""
+
+
+def file_digest(content):
+    """Return the SHA-256 of a File, reusing the one worked out during upload if there is one."""
+    digest = getattr(content, 'content_digest', None)
+    if digest is None:
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks(CHUNK_SIZE):
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+    return digest
+
+
+def is_blob(name):
+    return name.startswith(f'{BLOB_DIRECTORY}/')
+
+
+def write_atomically(path, chunks, permissions=None):
+    """
+    Write chunks of bytes to a temporary file beside ``path`` and rename it
+    into place, so the file is either whole or absent. Writers racing to the
+    same path must be writing the same bytes.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        if permissions is not None:
+            os.chmod(temporary_path, permissions)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that keeps each distinct file once, named after its SHA-256.
+
+    Saving a file whose content is already stored writes nothing and returns
+    the existing name, so every row with the same receipt shares one blob.
+    As rows share blobs, deleting a row leaves its blob alone; the
+    remove_orphaned_attachments command deletes blobs no row refers to.
+    """
+
+    def blob_name(self, name, content):
+        """Return the name of the blob holding ``content``, keeping the extension of ``name``."""
+        digest = file_digest(content)
+        extension = os.path.splitext(name)[1].lower()
+        return f'{BLOB_DIRECTORY}/{digest[:2]}/{digest}{extension}'
+
+    def get_available_name(self, name, max_length=None):
+        # _save names the file after its content, so there is no free name to probe for
+        return name
+
+    def _save(self, name, content):
+        name = self.blob_name(name, content)
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path)  # In use again, so not an orphan to remove
+        else:
+            write_atomically(path, content.chunks(), self.file_permissions_mode)
+        return name
+
+    def blobs(self):
+        """Yield the name and age in seconds of every stored blob, leaving out the previews and markers beside them."""
+        root = self.path(BLOB_DIRECTORY)
+        now = time.time()
+        for directory, _, files in os.walk(root):
+            for file in files:
+                if BLOB_FILE.match(file) and os.path.splitext(file)[1] not in MARKER_EXTENSIONS:
+                    path = os.path.join(directory, file)
+                    yield os.path.relpath(path, self.location).replace(os.sep, '/'), now - os.path.getmtime(path)
+
+    def delete_blob(self, name):
+        """Delete a blob with the previews and markers named after it."""
+        directory, file = os.path.split(self.path(name))
+        base = os.path.splitext(file)[0]
+        for other in os.listdir(directory):
+            if other == file or other.startswith(f'{base}.'):
+                try:
+                    os.unlink(os.path.join(directory, other))
+                except FileNotFoundError:
+                    pass  # Removed meanwhile
+
+
+attachment_storage = ContentAddressedStorage()
+
+
+def byte_range(header, size):
+    """
+    Return the inclusive (start, end) of a single-range Range header, or None
+    to send the whole file. Raises ValueError if the range lies outside it.
+    """
+    match = BYTE_RANGE.match(header or '')
+    if not match:
+        return None  # No range, or several ranges, which are answered in full
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    elif last:
+        start, end = max(size - int(last), 0), size - 1  # The last N bytes
+    else:
+        return None
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def read_range(file, start, end):
+    """Yield bytes ``start`` to ``end`` of a file in chunks, then close it."""
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def stream_attachment(request, file, content_type):
+    """Send a file from Python, honouring a single byte range so media players and resumed downloads work."""
+    try:
+        requested = byte_range(request.headers.get('Range'), file.size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{file.size}'
+        return response
+
+    if requested is None:
+        response = FileResponse(file.open('rb'), content_type=content_type)
+    else:
+        start, end = requested
+        response = StreamingHttpResponse(read_range(file.open('rb'), start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{file.size}'
+        response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def serve_attachment(request, file, filename, as_attachment=False):
+    """
+    Respond with a stored attachment (a FieldFile).
+
+    With ``ATTACHMENT_SENDFILE`` set to 'x-sendfile' or 'x-accel-redirect' the
+    web server sends the file and the worker is free straight away; otherwise
+    it is streamed by FileResponse. A blob never changes, so its digest is a
+    strong ETag. The URL names the row rather than the blob, and stays the
+    same when the row's file is replaced, so browsers must still revalidate:
+    an unchanged file costs them a 304 and no body.
+    """
+    etag = None
+    if is_blob(file.name):
+        etag = '"%s"' % os.path.splitext(os.path.basename(file.name))[0]
+        if etag in request.headers.get('If-None-Match', ''):
+            return HttpResponseNotModified(headers={'ETag': etag})
+
+    content_type = mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+    if settings.ATTACHMENT_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = file.path
+    elif settings.ATTACHMENT_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.ATTACHMENT_ACCEL_REDIRECT_PREFIX + file.name
+    else:
+        response = stream_attachment(request, file, content_type)
+
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    if etag:
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+    return response
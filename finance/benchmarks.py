@@ -0,0 +1,322 @@
+import gc
+import platform
+import statistics
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+import django
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connection, connections
+from django.test import RequestFactory
+from django.utils import timezone
+from . import views
+from .dashboard import build_dashboard_context, financial_years
+from .depreciation import MAX_YEARS, depreciation_schedule, replace_schedules
+from .models import DIMINISHING_VALUE, STRAIGHT_LINE, Earning, Expense, FinancialYear
+from .pdf_jobs import render_dashboard_pdf
+from .schedules import get_tax_schedule
+from .summaries import rebuild_summary
+from .tax_engine import np
+
+# Rows inserted per bulk_create while seeding a benchmark year
+SEED_BATCH_SIZE = 10000
+
+# Above this many rows the whole-ledger context (what the PDF is built from)
+# is not benchmarked, as it holds every row in memory at once
+FULL_LEDGER_LIMIT = 100000
+
+# Benchmark data goes in years no real ledger uses. Depreciation schedules
+# run for up to MAX_YEARS, so their assets are bought that long before the rest
+FIRST_BENCHMARK_YEAR = 1900
+DEPRECIATION_YEAR = FIRST_BENCHMARK_YEAR - MAX_YEARS
+
+
+class LoadTestError(Exception):
+    """Raised when the load test would touch an account it did not create."""
+
+
+class BenchmarkResult:
+    """The timings of one benchmark case, in seconds."""
+
+    def __init__(self, name, timings, params=None):
+        self.name = name
+        self.timings = timings
+        self.params = params or {}
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'params': self.params,
+            'runs': len(self.timings),
+            'min': min(self.timings),
+            'median': statistics.median(self.timings),
+            'mean': statistics.fmean(self.timings),
+        }
+
+
+def measure(name, function, repeat, **params):
+    """Time ``function`` ``repeat`` times, collecting garbage before each run."""
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return BenchmarkResult(name, timings, params)
+
+
+def environment():
+    """Describe where the benchmarks ran, so runs on different machines are not compared blindly."""
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'numpy': np.__version__ if np is not None else None,
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+def benchmark_owner():
+    """The user every benchmark's data belongs to."""
+    return get_user_model().objects.get_or_create(username='benchmark')[0]
+
+
+def signed_in_request(request, user):
+    """Sign a RequestFactory request in as ``user``, for sync and async views alike."""
+    request.user = user
+    request.auser = sync_to_async(lambda: user)
+    return request
+
+
+def benchmark_year(offset):
+    return FinancialYear.objects.create(owner=benchmark_owner(), year=FIRST_BENCHMARK_YEAR + offset)
+
+
+def seed_ledger(financial_year, rows):
+    """Bulk insert ``rows`` earnings and expenses (half each) into a year and build its summary."""
+    start = date(financial_year.year, 4, 1)
+    for first in range(0, rows // 2, SEED_BATCH_SIZE):
+        batch = range(first, min(first + SEED_BATCH_SIZE, rows // 2))
+        Earning.objects.bulk_create(
+            Earning(description=f'Invoice {i}', amount=Decimal(100 + i % 900), gst=Decimal(15),
+                    date=start + timedelta(days=i % 365), financial_year=financial_year,
+                    owner_id=financial_year.owner_id)
+            for i in batch
+        )
+        Expense.objects.bulk_create(
+            Expense(description=f'Purchase {i}', amount=Decimal(50 + i % 900), gst=Decimal(6),
+                    purchase_date=start + timedelta(days=i % 365), expense_type=Expense.EXPENSE_TYPES[i % 9][0],
+                    financial_year=financial_year, owner_id=financial_year.owner_id)
+            for i in batch
+        )
+    rebuild_summary(financial_year)
+
+
+def bench_tax(options):
+    """FinancialYear.calculate_tax one income at a time, and the batch path, across $0 to $500k."""
+    financial_year = benchmark_year(0)
+    incomes = [Decimal(income) for income in range(0, 500000, 50)]
+
+    def one_at_a_time():
+        for income in incomes:
+            financial_year.calculate_tax(income, True, permanent_income=income)
+
+    tax_schedule = get_tax_schedule(financial_year)
+    return [
+        measure('tax.calculate_tax', one_at_a_time, options['repeat'], incomes=len(incomes)),
+        measure('tax.batch', lambda: tax_schedule.tax_for_incomes(incomes), options['repeat'], incomes=len(incomes)),
+    ]
+
+
+def bench_gst(options):
+    """Earning.save and Expense.save, which work out GST and fire the summary signals, row by row."""
+    financial_year = benchmark_year(1)
+    rows = options['save_rows']
+    today = date(financial_year.year, 6, 1)
+
+    def save_earnings():
+        for i in range(rows):
+            Earning(description='Invoice', amount=Decimal(100 + i), date=today, financial_year=financial_year).save()
+
+    def save_expenses():
+        for i in range(rows):
+            Expense(description='Purchase', amount=Decimal(50 + i), purchase_date=today, expense_type='travel',
+                    financial_year=financial_year).save()
+
+    rebuild_summary(financial_year)
+    return [
+        measure('gst.earning_save', save_earnings, options['repeat'], rows=rows),
+        measure('gst.expense_save', save_expenses, options['repeat'], rows=rows),
+    ]
+
+
+def bench_depreciation(options):
+    """Schedules of long-life assets, worked out in memory and written for many assets at once."""
+    financial_year = FinancialYear.objects.create(owner=benchmark_owner(), year=DEPRECIATION_YEAR)
+    purchase_date = date(DEPRECIATION_YEAR, 6, 1)
+    assets = options['save_rows']
+
+    def schedules():
+        for method in (DIMINISHING_VALUE, STRAIGHT_LINE):
+            for _ in range(assets):
+                depreciation_schedule(Decimal('250000.00'), Decimal('0.02'), purchase_date, method)
+
+    expenses = Expense.objects.bulk_create(
+        Expense(description='Building', amount=Decimal('250000.00'), gst=0, purchase_date=purchase_date,
+                expense_type='equipment', is_good=True, depreciation_rate=2, depreciation_method=DIMINISHING_VALUE,
+                financial_year=financial_year, owner_id=financial_year.owner_id)
+        for _ in range(assets)
+    )
+    return [
+        measure('depreciation.schedule', schedules, options['repeat'], assets=assets * 2, rate='2%'),
+        measure('depreciation.replace_schedules', lambda: replace_schedules(expenses), options['repeat'], assets=assets),
+    ]
+
+
+def bench_dashboard(options):
+    """The financial year page (one page of each ledger) and the whole-ledger context at each size."""
+    factory = RequestFactory()
+    results = []
+    for offset, rows in enumerate(options['rows'], start=2):
+        financial_year = benchmark_year(offset)
+        seed_ledger(financial_year, rows)
+        request = signed_in_request(factory.get(f'/financial-year/{financial_year.pk}/'), financial_year.owner)
+        view = async_to_sync(views.financial_year_detail)
+        results.append(measure(
+            'dashboard.page', lambda: view(request, financial_year.pk),
+            options['repeat'], rows=rows,
+        ))
+        if rows <= FULL_LEDGER_LIMIT:
+            year = financial_years().get(pk=financial_year.pk)
+            results.append(measure(
+                'dashboard.full_ledger', lambda: build_dashboard_context(year), options['repeat'], rows=rows,
+            ))
+    return results
+
+
+def bench_pdf(options):
+    """xhtml2pdf turning dashboard_pdf.html into a PDF, for a year of ``pdf_rows`` rows."""
+    financial_year = benchmark_year(2 + len(options['rows']))
+    seed_ledger(financial_year, options['pdf_rows'])
+    context = build_dashboard_context(financial_years().get(pk=financial_year.pk))
+    return [measure('pdf.render', lambda: render_dashboard_pdf(context), options['repeat'], rows=options['pdf_rows'])]
+
+
+BENCHMARKS = {
+    'tax': bench_tax,
+    'gst': bench_gst,
+    'depreciation': bench_depreciation,
+    'dashboard': bench_dashboard,
+    'pdf': bench_pdf,
+}
+
+
+def compare(results, baseline):
+    """
+    Compare results with a baseline run.
+
+    Returns a list of ``(name, params, baseline median, median, ratio)`` for
+    every case both runs have, where a ratio above 1 means slower.
+    """
+    baseline_cases = {(case['name'], repr(case['params'])): case for case in baseline.get('results', [])}
+    comparisons = []
+    for result in results:
+        case = baseline_cases.get((result['name'], repr(result['params'])))
+        if case and case['median']:
+            comparisons.append((
+                result['name'], result['params'], case['median'], result['median'], result['median'] / case['median'],
+            ))
+    return comparisons
+
+
+def journal_mode():
+    """The SQLite journal mode in use (e.g. 'wal' or 'delete'), or None on other databases."""
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+
+def load_test(threads, writes, read_every=5, username=None):
+    """
+    Save expenses through the add_expense view from several threads at once,
+    each with its own database connection, as concurrent requests would. After
+    every ``read_every`` writes a thread also loads the dashboard, which
+    resolves the current year with ``get_or_create``.
+
+    Unlike the benchmarks this commits to the configured database, as rows
+    written in one connection's open transaction are invisible to the others.
+    They belong to a user made for the run, ``username`` or a new
+    ``load-test-<random>`` name, who is deleted with everything they own at
+    the end. Raises LoadTestError rather than use a user that already exists.
+    Returns a dict of throughput, write latencies and the database errors
+    (such as "database is locked") that were hit.
+    """
+    username = username or f'load-test-{uuid.uuid4().hex[:12]}'
+    if get_user_model().objects.filter(username=username).exists():
+        raise LoadTestError(f'User {username!r} already exists; the load test only deletes a user it created')
+    owner = get_user_model().objects.create_user(username)
+    try:
+        return run_load_test(owner, threads, writes, read_every)
+    finally:
+        owner.delete()
+
+
+def run_load_test(owner, threads, writes, read_every):
+    factory = RequestFactory()
+    dashboard = async_to_sync(views.dashboard)
+    today = timezone.now().date().isoformat()
+    start = threading.Barrier(threads)
+    latencies, write_errors, read_errors = [], [], []
+
+    def worker(index):
+        try:
+            start.wait()
+            for i in range(writes):
+                request = factory.post('/add-expense/', {
+                    'description': f'Load test {index}-{i}', 'amount': '20.00', 'expense_type': 'office_supplies',
+                    'purchase_date': today, 'depreciation_method': STRAIGHT_LINE,
+                })
+                started = time.perf_counter()
+                try:
+                    views.add_expense(signed_in_request(request, owner))
+                    latencies.append(time.perf_counter() - started)
+                except DatabaseError as e:
+                    write_errors.append(str(e))
+                if read_every and i % read_every == 0:
+                    try:
+                        dashboard(signed_in_request(factory.get('/'), owner))
+                    except DatabaseError as e:
+                        read_errors.append(str(e))
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    saved = Expense.objects.for_owner(owner).count()
+    latencies.sort()
+    return {
+        'database': connection.vendor,
+        'journal_mode': journal_mode(),
+        'threads': threads,
+        'writes_attempted': threads * writes,
+        'writes_saved': saved,
+        'seconds': elapsed,
+        'writes_per_second': saved / elapsed if elapsed else None,
+        'median_write': statistics.median(latencies) if latencies else None,
+        'p95_write': latencies[int(len(latencies) * 0.95)] if latencies else None,
+        'write_errors': len(write_errors),
+        'read_errors': len(read_errors),
+        'error_messages': sorted(set(write_errors + read_errors)),
+    }
@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.models.lookups import LessThan
+from .models import Earning, FinancialYear, GSTReturn
+from .money import apply_rate, from_cents, included_at_rate, to_cents
+from .schedules import get_gst_rate
+from .summaries import rebuild_summary
+from .years import resolve_financial_years
+
+# Rows recompute_gst reads and writes at a time
+RECOMPUTE_BATCH_SIZE = 2000
+
+
+def date_field_of(model):
+    return 'date' if model is Earning else 'purchase_date'
+
+
+def financial_year_of(date):
+    """The NZ financial year (e.g. 2024 for 2024-25) of a date expression, worked out in the database."""
+    return ExtractYear(date) - Case(When(LessThan(ExtractMonth(date), 4), then=Value(1)), default=Value(0))
+
+
+def refresh_years(financial_year_ids):
+    """Rebuild the summaries and drop the stored GST returns of years whose rows were changed by an UPDATE."""
+    GSTReturn.objects.filter(financial_year__in=financial_year_ids).delete()
+    for financial_year in FinancialYear.objects.filter(pk__in=financial_year_ids):
+        rebuild_summary(financial_year)
+
+
+def reassign_financial_years(queryset):
+    """
+    Move Earning or Expense rows to the financial year their date falls in,
+    in one UPDATE however many rows are selected. Missing years are created
+    first, one insert per owner. Returns the number of rows moved.
+    """
+    date = date_field_of(queryset.model)
+    queryset = queryset.annotate(target_year=financial_year_of(F(date))).exclude(
+        financial_year__year=F('target_year'),
+    )
+    with transaction.atomic():
+        moves = queryset.values_list('owner_id', 'target_year', 'financial_year_id').distinct().order_by()
+        touched, wanted = set(), {}
+        for owner_id, year, financial_year_id in moves:
+            touched.add(financial_year_id)
+            wanted.setdefault(owner_id, set()).add(year)
+        if not wanted:
+            return 0
+        for owner_id, years in wanted.items():
+            touched.update(financial_year.pk for financial_year in resolve_financial_years(owner_id, years).values())
+
+        target = FinancialYear.objects.filter(
+            owner=OuterRef('owner'), year=financial_year_of(OuterRef(date)),
+        ).values('pk')[:1]
+        moved = queryset.model.objects.filter(pk__in=queryset.values('pk')).update(financial_year=Subquery(target))
+        refresh_years(touched)
+    return moved
+
+
+def recompute_gst(queryset, batch_size=RECOMPUTE_BATCH_SIZE):
+    """
+    Work out the GST of Earning or Expense rows again at their year's rate:
+    earnings add GST on top of their amount, expenses include it. The values
+    come from the same ``money`` helpers ``save()`` uses, so a half cent rounds
+    the same way either path, and only rows whose GST changes are written, in
+    one UPDATE per ``batch_size`` of them. Returns the number of rows updated.
+    """
+    model = queryset.model
+    gst_of = apply_rate if model is Earning else included_at_rate
+    with transaction.atomic():
+        rows = model.objects.filter(pk__in=queryset.values('pk')).only('amount', 'gst', 'financial_year_id').order_by('pk')
+        financial_year_ids = set(rows.values_list('financial_year_id', flat=True).distinct().order_by())
+        rates = {
+            financial_year.pk: get_gst_rate(financial_year)
+            for financial_year in FinancialYear.objects.filter(pk__in=financial_year_ids)
+        }
+        changed = []
+        for row in rows.iterator(chunk_size=batch_size):
+            gst = from_cents(gst_of(to_cents(row.amount), rates[row.financial_year_id]))
+            if gst != row.gst:
+                row.gst = gst
+                changed.append(row)
+        model.objects.bulk_update(changed, ['gst'], batch_size=batch_size)
+        refresh_years({row.financial_year_id for row in changed})
+    return len(changed)
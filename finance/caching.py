@@ -0,0 +1,43 @@
+import uuid
+from collections import OrderedDict
+from django.core.cache import cache
+
+
+class LRUCache(OrderedDict):
+    """A process-local map of at most ``max_size`` entries; past that the least recently used is dropped."""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+def current_stamp(key):
+    """
+    Return the stamp stored under ``key`` in the shared cache, starting a new
+    one if there is none. Each process keeps the stamp beside what it cached
+    and reloads once the shared stamp has moved on. None when the cache stores
+    nothing (e.g. DummyCache), which can never say when to reload.
+    """
+    stamp = cache.get(key)
+    if stamp is None:
+        # First use, or the stamp was evicted: no process may trust its old entries
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        stamp = cache.get(key)
+    return stamp
+
+
+def new_stamp(key):
+    """Move the stamp under ``key`` on, so every process drops what it cached against the old one."""
+    cache.set(key, uuid.uuid4().hex, timeout=None)
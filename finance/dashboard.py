@@ -0,0 +1,175 @@
+import asyncio
+from decimal import Decimal
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from .models import Earning, Expense, FinancialYear, FinancialYearSummary
+from .pagination import akeyset_page, keyset_page
+from .personal import get_cached
+from .provisional import project_tax
+from .summaries import rebuild_summary
+from .tax_impact import expense_tax_savings
+
+# Columns the ledger tables actually display; everything else stays in the database
+EARNING_COLUMNS = ['id', 'reference', 'description', 'amount', 'gst', 'date']
+EXPENSE_COLUMNS = ['id', 'reference', 'description', 'amount', 'gst', 'purchase_date', 'expense_type', 'attachment']
+
+# The model, displayed columns, date field and database-computed columns of
+# each ledger table. The computed columns save the templates doing sums per row.
+LEDGERS = {
+    'earnings': {
+        'model': Earning, 'columns': EARNING_COLUMNS, 'date_field': 'date',
+        'annotations': {'amount_including_gst': F('amount') + F('gst')},
+    },
+    'expenses': {
+        'model': Expense, 'columns': EXPENSE_COLUMNS, 'date_field': 'purchase_date',
+        'annotations': {'amount_excluding_gst': F('amount') - F('gst')},
+    },
+}
+
+
+def financial_years():
+    """
+    FinancialYear queryset that brings each year's summary and GST rate along
+    in the same query, so building its context needs no further lookups.
+    """
+    return FinancialYear.objects.select_related('summary', 'gst_rate')
+
+
+def ledger_queryset(financial_year, ledger, filters=None):
+    """Return a year's earnings or expenses, narrowed by the filters of a LedgerFilterForm."""
+    filters = filters or {}
+    definition = LEDGERS[ledger]
+    queryset = definition['model'].objects.for_owner(financial_year.owner_id).filter(financial_year=financial_year)
+    queryset = queryset.only(*definition['columns']).annotate(**definition['annotations'])
+    if filters.get('expense_type'):
+        queryset = queryset.filter(expense_type=filters['expense_type'])
+    if filters.get('min_amount') is not None:
+        queryset = queryset.filter(amount__gte=filters['min_amount'])
+    if filters.get('max_amount') is not None:
+        queryset = queryset.filter(amount__lte=filters['max_amount'])
+    return queryset
+
+
+def ledger_sort(ledger, filters):
+    """Return the field a ledger table is sorted by, and whether it is descending (newest first by default)."""
+    sort = filters.get('sort') or '-date'
+    field = LEDGERS[ledger]['date_field'] if sort.lstrip('-') == 'date' else 'amount'
+    return field, sort.startswith('-')
+
+
+def ledger_page(financial_year, ledger, filters=None):
+    """Return one keyset page of a year's earnings or expenses."""
+    filters = filters or {}
+    field, descending = ledger_sort(ledger, filters)
+    return keyset_page(
+        ledger_queryset(financial_year, ledger, filters), field,
+        descending=descending, cursor=filters.get('cursor'), page_size=settings.LEDGER_PAGE_SIZE,
+    )
+
+
+async def aledger_page(financial_year, ledger, filters=None):
+    """Async ``ledger_page``."""
+    filters = filters or {}
+    field, descending = ledger_sort(ledger, filters)
+    return await akeyset_page(
+        ledger_queryset(financial_year, ledger, filters), field,
+        descending=descending, cursor=filters.get('cursor'), page_size=settings.LEDGER_PAGE_SIZE,
+    )
+
+
+def add_tax_savings(financial_year, expenses, gst_registered, summary=None):
+    """Set ``tax_saving`` on each expense, in one batch."""
+    tax_savings = expense_tax_savings(financial_year, expenses, gst_registered, summary=summary)
+    for expense in expenses:
+        expense.tax_saving = tax_savings[expense.pk]
+
+
+def dashboard_totals(financial_year):
+    """
+    Return the totals, tax and GST part of a year's dashboard context, and the
+    year's summary. ``financial_year`` should come from ``financial_years()``.
+    """
+    cached = get_cached(financial_year.owner_id)
+    personal_details = cached.personal_details
+    gst_registered = personal_details.gst_registered if personal_details else False
+
+    try:
+        summary = financial_year.summary
+    except FinancialYearSummary.DoesNotExist:
+        summary = rebuild_summary(financial_year)
+    total_earnings = summary.total_earnings
+    total_expenses = summary.total_expenses
+
+    # Calculate tax owed on earnings less expenses
+    adjusted_earnings = total_earnings - total_expenses
+    tax_owed_permanent_income, tax_owed_earnings = financial_year.calculate_tax(adjusted_earnings, gst_registered)
+
+    # GST if registered: what the year's rows actually carry, as filed in its GST returns
+    gst_to_pay = summary.gst_collected if gst_registered else Decimal(0)
+    gst_to_claim = summary.gst_claimed if gst_registered else Decimal(0)
+
+    context = {
+        'projection': project_tax(financial_year, summary, gst_registered),
+        'financial_year': financial_year,
+        'personal_details': personal_details,
+        'total_earnings': total_earnings,
+        'total_expenses': total_expenses,
+        'tax_owed_permanent_income': tax_owed_permanent_income,
+        'tax_owed_earnings': tax_owed_earnings,
+        'gst_registered': gst_registered,
+        'gst_to_pay': gst_to_pay,
+        'gst_to_claim': gst_to_claim,
+        'data_version': summary.data_version,
+        'personal_details_version': cached.version,
+    }
+    return context, summary
+
+
+def build_dashboard_context(financial_year, pages=None):
+    """
+    Build the context shared by the dashboard, its PDF and the financial year
+    detail page.
+
+    ``financial_year`` should come from ``financial_years()``. Totals are read
+    from the year's summary, and the earnings and expenses only select the
+    columns the tables show; each is one query. Every expense carries the
+    income tax it saves as ``tax_saving``.
+
+    ``pages`` maps 'earnings' and 'expenses' to the LedgerFilterForm data of
+    the page to show, and each table's KeysetPage goes in the context as
+    ``earnings_page`` and ``expenses_page``. Without it (for the PDF) the
+    whole ledger is listed.
+    """
+    context, summary = dashboard_totals(financial_year)
+    for ledger, definition in LEDGERS.items():
+        if pages is None:
+            rows = list(ledger_queryset(financial_year, ledger).order_by(definition['date_field'], 'pk'))
+            page = None
+        else:
+            page = ledger_page(financial_year, ledger, pages.get(ledger))
+            rows = page.rows
+        context[ledger] = rows
+        context[f'{ledger}_page'] = page
+    add_tax_savings(financial_year, context['expenses'], context['gst_registered'], summary)
+    return context
+
+
+async def abuild_dashboard_context(financial_year, pages):
+    """
+    Async ``build_dashboard_context`` for one page of each ledger table.
+
+    The two pages are read with the async ORM while the totals are worked out,
+    all awaited together, so the event loop serves other requests while this
+    one waits on the database. The totals and tax savings go through
+    ``sync_to_async`` as they may load the personal details or a tax schedule.
+    """
+    (context, summary), *ledger_pages = await asyncio.gather(
+        sync_to_async(dashboard_totals)(financial_year),
+        *(aledger_page(financial_year, ledger, pages.get(ledger)) for ledger in LEDGERS),
+    )
+    for ledger, page in zip(LEDGERS, ledger_pages):
+        context[ledger] = page.rows
+        context[f'{ledger}_page'] = page
+    await sync_to_async(add_tax_savings)(financial_year, context['expenses'], context['gst_registered'], summary)
+    return context
@@ -0,0 +1,19 @@
+def query_budget(queries):
+    """
+    Declare the most database queries a view may run for one request.
+
+    The budget is stored on the view as ``query_budget`` and enforced by the
+    tests, so a template or view change that adds queries fails the build. It
+    counts every query of a signed-in request, including the two that load
+    the session and the user.
+    """
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+def query_budget_of(view):
+    """Return the query budget declared on a view function or class-based view, or None."""
+    view_class = getattr(view, 'view_class', None)
+    return getattr(view, 'query_budget', getattr(view_class, 'query_budget', None))
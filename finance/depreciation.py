@@ -0,0 +1,122 @@
+from django.db import transaction
+from .models import BusinessCost, Depreciation, DIMINISHING_VALUE, Expense, get_financial_year_for_date
+from .money import apply_rate, from_cents, to_cents
+from .years import resolve_financial_years
+
+# Diminishing value never quite reaches zero, so once an asset is worth less
+# than this many cents the rest is written off, and no schedule runs longer than MAX_YEARS
+WRITE_OFF_BELOW = 100
+MAX_YEARS = 50
+
+
+class DepreciationYear:
+    """One financial year of an asset's depreciation schedule."""
+
+    def __init__(self, financial_year, opening_cents, write_off_cents, years_to_zero=None):
+        self.financial_year = financial_year  # The NZ financial year, e.g. 2024 for 2024-25
+        self.opening_value = from_cents(opening_cents)
+        self.tax_write_off = from_cents(write_off_cents)
+        self.current_value = from_cents(opening_cents - write_off_cents)
+        self.years_to_zero = years_to_zero
+
+
+def depreciation_schedule(cost, rate, start_date, method):
+    """
+    Work out an asset's whole depreciation schedule in memory.
+
+    ``rate`` is the yearly rate as a fraction (0.25 for 25%). Straight line
+    writes off ``cost * rate`` every year until the asset is worth nothing;
+    diminishing value writes off ``rate`` of what is left each year. The first
+    year is the NZ financial year (April to March) the asset was bought in.
+    Values are worked out in whole cents, each write-off rounded to the cent.
+    """
+    cost = to_cents(cost)
+    if cost <= 0 or rate <= 0:
+        return []
+
+    straight_line_write_off = apply_rate(cost, rate)
+    first_year = get_financial_year_for_date(start_date)
+    schedule = []
+    value = cost
+    while value > 0 and len(schedule) < MAX_YEARS:
+        if method == DIMINISHING_VALUE:
+            write_off = apply_rate(value, rate)
+            if value - write_off < WRITE_OFF_BELOW or len(schedule) == MAX_YEARS - 1:
+                write_off = value
+        else:
+            write_off = min(straight_line_write_off, value)
+        schedule.append(DepreciationYear(first_year + len(schedule), value, write_off))
+        value -= write_off
+
+    for index, year in enumerate(schedule):
+        year.years_to_zero = len(schedule) - index
+    return schedule
+
+
+def asset_schedule(asset):
+    """Return the depreciation schedule of an Expense or BusinessCost."""
+    if not asset.should_depreciate():
+        return []
+    return depreciation_schedule(
+        asset.amount, asset.depreciation_fraction(), asset.depreciation_start_date(), asset.depreciation_method,
+    )
+
+
+def build_depreciations(asset, schedule, financial_years):
+    """Build the unsaved Depreciation rows for an asset's schedule."""
+    asset_field = {'business_cost': asset} if isinstance(asset, BusinessCost) else {'expense': asset}
+    return [
+        Depreciation(
+            financial_year=financial_years[year.financial_year],
+            current_value=year.current_value,
+            tax_write_off=year.tax_write_off,
+            years_to_zero=year.years_to_zero,
+            **asset_field,
+        )
+        for year in schedule
+    ]
+
+
+def replace_schedules(assets):
+    """
+    Replace the stored depreciation of some Expenses or BusinessCosts (not mixed)
+    with freshly computed schedules, in one transaction: one delete, one
+    financial year lookup per owner and one bulk insert however many assets
+    there are.
+    """
+    assets = [asset for asset in assets if asset.pk]
+    if not assets:
+        return 0
+    asset_field = 'business_cost' if isinstance(assets[0], BusinessCost) else 'expense'
+    schedules = [(asset, asset_schedule(asset)) for asset in assets]
+
+    with transaction.atomic():
+        Depreciation.objects.filter(**{f'{asset_field}__in': [asset.pk for asset in assets]}).delete()
+        depreciations = []
+        for owner_id in {asset.owner_id for asset in assets}:
+            owned = [(asset, schedule) for asset, schedule in schedules if asset.owner_id == owner_id]
+            financial_years = resolve_financial_years(
+                owner_id, (year.financial_year for asset, schedule in owned for year in schedule)
+            )
+            for asset, schedule in owned:
+                depreciations += build_depreciations(asset, schedule, financial_years)
+        Depreciation.objects.bulk_create(depreciations)
+    return len(depreciations)
+
+
+def recompute(queryset, chunk_size=500):
+    """Rebuild the depreciation of a queryset of Expenses or BusinessCosts, a chunk at a time."""
+    created = 0
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            break
+        created += replace_schedules(chunk)
+        last_pk = chunk[-1].pk
+    return created
+
+
+def recompute_all(chunk_size=500):
+    """Rebuild the depreciation of every Expense and BusinessCost, a chunk at a time."""
+    return sum(recompute(model.objects.all(), chunk_size) for model in (Expense, BusinessCost))
@@ -0,0 +1,151 @@
+import csv
+import json
+from django.db.models import F
+from .importers import chunked
+from .models import Depreciation, Earning, Expense, get_financial_year_for_date
+
+# Rows fetched from the database per round trip, and rows per chunk of output
+CHUNK_SIZE = 2000
+
+# Each dataset is a queryset of plain tuples (no model instances), with the
+# computed columns worked out by the database
+DATASETS = {
+    'earnings': {
+        'model': Earning,
+        'date_field': 'date',
+        'columns': {
+            'id': F('id'),
+            'reference': F('reference'),
+            'description': F('description'),
+            'date': F('date'),
+            'financial_year': F('financial_year__year'),
+            'amount': F('amount'),
+            'gst': F('gst'),
+            'amount_including_gst': F('amount') + F('gst'),
+        },
+    },
+    'expenses': {
+        'model': Expense,
+        'date_field': 'purchase_date',
+        'columns': {
+            'id': F('id'),
+            'reference': F('reference'),
+            'description': F('description'),
+            'purchase_date': F('purchase_date'),
+            'financial_year': F('financial_year__year'),
+            'expense_type': F('expense_type'),
+            'is_good': F('is_good'),
+            'amount': F('amount'),
+            'gst': F('gst'),
+            'amount_excluding_gst': F('amount') - F('gst'),
+            'depreciation_rate': F('depreciation_rate'),
+        },
+    },
+    'depreciation': {
+        'model': Depreciation,
+        'date_field': None,
+        'columns': {
+            'id': F('id'),
+            'expense_id': F('expense_id'),
+            'expense_reference': F('expense__reference'),
+            'expense_description': F('expense__description'),
+            'business_cost_id': F('business_cost_id'),
+            'financial_year': F('financial_year__year'),
+            'current_value': F('current_value'),
+            'tax_write_off': F('tax_write_off'),
+            'years_to_zero': F('years_to_zero'),
+        },
+    },
+}
+
+# Content type and file extension of each export format
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'columnar': ('application/x-ndjson', 'columnar.jsonl'),
+}
+
+
+class Echo:
+    """A file-like object that hands back what is written, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(owner_id, dataset, years=None, start=None, end=None):
+    """
+    Return the column names and a lazy iterator over the rows of a user's dataset.
+
+    Rows can be limited to some financial years, a date range, or both.
+    Depreciation has no date of its own, so a date range selects the
+    financial years it covers.
+    """
+    definition = DATASETS[dataset]
+    queryset = definition['model'].objects.for_owner(owner_id)
+    if years:
+        queryset = queryset.filter(financial_year__year__in=years)
+
+    date_field = definition['date_field']
+    if date_field:
+        if start:
+            queryset = queryset.filter(**{f'{date_field}__gte': start})
+        if end:
+            queryset = queryset.filter(**{f'{date_field}__lte': end})
+        queryset = queryset.order_by(date_field, 'id')
+    else:
+        if start:
+            queryset = queryset.filter(financial_year__year__gte=get_financial_year_for_date(start))
+        if end:
+            queryset = queryset.filter(financial_year__year__lte=get_financial_year_for_date(end))
+        queryset = queryset.order_by('financial_year__year', 'id')
+
+    columns = definition['columns']
+    # Annotation names must not clash with model fields, so prefix them
+    names = [f'export_{name}' for name in columns]
+    queryset = queryset.annotate(**dict(zip(names, columns.values()))).values_list(*names)
+    return list(columns), queryset.iterator(chunk_size=CHUNK_SIZE)
+
+
+def to_json(value):
+    """Make dates and Decimals JSON-friendly; money stays a string so no cents are lost."""
+    return str(value)
+
+
+def write_csv(columns, rows):
+    """Yield CSV text, one chunk of rows at a time."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for chunk in chunked(rows, CHUNK_SIZE):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+
+def write_jsonl(columns, rows):
+    """Yield JSON Lines text: one object per row."""
+    for chunk in chunked(rows, CHUNK_SIZE):
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=to_json) + '\n' for row in chunk)
+
+
+def write_columnar(columns, rows):
+    """
+    Yield column-oriented JSON Lines, in the spirit of Parquet row groups.
+
+    Each line holds one group of up to CHUNK_SIZE rows as a list of values per
+    column, which compresses far better and loads straight into data frames.
+    """
+    for chunk in chunked(rows, CHUNK_SIZE):
+        group = {'rows': len(chunk), 'columns': dict(zip(columns, map(list, zip(*chunk))))}
+        yield json.dumps(group, default=to_json) + '\n'
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'columnar': write_columnar,
+}
+
+
+def export(owner_id, dataset, file_format, years=None, start=None, end=None):
+    """Yield a user's dataset in a file format as chunks of text, holding one chunk in memory."""
+    columns, rows = export_rows(owner_id, dataset, years=years, start=start, end=end)
+    return WRITERS[file_format](columns, rows)
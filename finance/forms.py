@@ -1,11 +1,17 @@
 from django import forms
-from .models import Earning, Expense, PersonalDetails, FinancialYear
+from .models import Earning, Expense, PersonalDetails
 from django.utils import timezone
+from .pagination import InvalidCursor, decode_cursor
+from .years import get_financial_year_id_for_date
 
 class EarningForm(forms.ModelForm):
     """
     A form for creating and updating Earnings.
 
+    Like ExpenseForm, it puts the earning in its owner's financial year of the
+    date when saved, so an edited date moves it to that year. New earnings are
+    passed as ``instance=Earning(owner=user)``.
+
     Attributes:
         Meta: Defines the model and fields to include in the form.
     """
@@ -16,20 +22,28 @@ class EarningForm(forms.ModelForm):
             'date': forms.DateInput(attrs={'type': 'date'}, format='%Y-%m-%d')  # Use a date input widget for the date field
         }
 
+    def save(self, commit=True):
+        """Put the earning in its owner's financial year (April to March) of its date, creating the year if needed."""
+        self.instance.financial_year_id = get_financial_year_id_for_date(
+            self.instance.owner_id, self.cleaned_data['date'],
+        )
+        return super().save(commit)
+
 
 class ExpenseForm(forms.ModelForm):
     """
     A form for creating and updating Expenses.
 
-    This form includes validation logic to associate expenses with the correct financial year
-    based on the purchase date, and to ensure depreciation is applied correctly.
+    This form associates expenses with the owner's financial year of the purchase
+    date when saved, and validates that depreciation is applied correctly. New
+    expenses are passed as ``instance=Expense(owner=user)``.
 
     Attributes:
         Meta: Defines the model and fields to include in the form.
     """
     class Meta:
         model = Expense
-        fields = ['reference', 'description', 'amount', 'is_good', 'depreciation_rate', 'expense_type', 'attachment', 'purchase_date']
+        fields = ['reference', 'description', 'amount', 'is_good', 'depreciation_rate', 'depreciation_method', 'expense_type', 'attachment', 'purchase_date']
         widgets = {
             'purchase_date': forms.DateInput(attrs={'type': 'date'}, format='%Y-%m-%d'),  # Use a date input widget for the purchase date field
             'depreciation_rate': forms.NumberInput(attrs={'min': '0', 'max': '100', 'type': 'number'}),
@@ -51,24 +65,13 @@ class ExpenseForm(forms.ModelForm):
         """
         Custom validation for the Expense form.
 
-        This method ensures that the purchase date is associated with the correct financial year
-        and checks if depreciation is applied to goods that cost more than $500.
-        
+        This method checks if depreciation is applied to goods that cost more than $500.
+        It does not touch the database; the financial year is looked up on save.
+
         Returns:
-            dict: The cleaned data with any added financial year information.
+            dict: The cleaned data.
         """
         cleaned_data = super().clean()
-        purchase_date = cleaned_data.get("purchase_date")
-
-        # Determine the financial year based on the purchase date
-        if purchase_date:
-            year = purchase_date.year
-            if purchase_date.month < 4:
-                # If before April, it's considered the previous financial year
-                financial_year = FinancialYear.objects.get_or_create(year=year - 1)[0]
-            else:
-                financial_year = FinancialYear.objects.get_or_create(year=year)[0]
-            cleaned_data['financial_year'] = financial_year
 
         # Other validation rules for amount, is_good, depreciation_rate, etc.
         amount = cleaned_data.get("amount")
@@ -81,6 +84,13 @@ class ExpenseForm(forms.ModelForm):
 
         return cleaned_data
 
+    def save(self, commit=True):
+        """Put the expense in its owner's financial year (April to March) of the purchase date, creating the year if needed."""
+        self.instance.financial_year_id = get_financial_year_id_for_date(
+            self.instance.owner_id, self.cleaned_data['purchase_date'],
+        )
+        return super().save(commit)
+
 
 class PersonalDetailsForm(forms.ModelForm):
     """
@@ -91,4 +101,62 @@ class PersonalDetailsForm(forms.ModelForm):
     """
     class Meta:
         model = PersonalDetails
-        fields = ['gst_registered', 'first_name', 'last_name', 'email', 'phone', 'permanent_income']
+        fields = ['gst_registered', 'gst_filing_months', 'first_name', 'last_name', 'email', 'phone', 'permanent_income']
+
+
+class StatementImportForm(forms.Form):
+    """
+    A form for uploading a bank statement to import as earnings and expenses.
+
+    Attributes:
+        statement: The CSV or OFX file to import.
+        expense_type: The expense type for lines that do not give one.
+    """
+    statement = forms.FileField(help_text='A CSV or OFX bank statement.')
+    expense_type = forms.ChoiceField(choices=Expense.EXPENSE_TYPES, initial='professional_services')
+
+    def file_format(self):
+        """Work out the statement's format from its file name."""
+        name = self.cleaned_data['statement'].name.lower()
+        return 'ofx' if name.endswith(('.ofx', '.qfx')) else 'csv'
+
+
+class LedgerFilterForm(forms.Form):
+    """
+    A form for sorting, filtering and paging through a year's earnings or expenses.
+
+    Used with ``prefix`` set to the ledger ('earnings' or 'expenses'), so both
+    tables on a page keep their own filters in the query string.
+
+    Attributes:
+        sort: The column and direction to sort by.
+        expense_type: Only show expenses of this type (expenses only).
+        min_amount, max_amount: Only show rows within this amount range.
+        cursor: Where the page starts, as handed out with the previous page.
+    """
+    SORTS = [
+        ('-date', 'Newest first'),
+        ('date', 'Oldest first'),
+        ('-amount', 'Largest first'),
+        ('amount', 'Smallest first'),
+    ]
+
+    sort = forms.ChoiceField(choices=SORTS, required=False)
+    expense_type = forms.ChoiceField(choices=[('', 'All types')] + Expense.EXPENSE_TYPES, required=False)
+    min_amount = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    max_amount = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    cursor = forms.CharField(required=False, widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.prefix == 'earnings':
+            del self.fields['expense_type']
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data.get('cursor')
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except InvalidCursor:
+                raise forms.ValidationError("This page link is no longer valid.")
+        return cursor
@@ -0,0 +1,143 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from django.db.models import DecimalField, Sum, Value
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from .models import Earning, Expense, GSTReturn
+
+ZERO = Value(Decimal(0), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+# The first month of the NZ financial year; filing periods are counted from it
+FIRST_MONTH = 4
+
+
+class GSTPeriod:
+    """The GST totals of one filing period. ``closed`` is True once the period has ended."""
+
+    def __init__(self, start, end, months, sales, purchases, gst_collected, gst_claimed, closed):
+        self.start = start
+        self.end = end
+        self.months = months
+        self.sales = sales  # Including GST
+        self.purchases = purchases  # Including GST
+        self.gst_collected = gst_collected
+        self.gst_claimed = gst_claimed
+        self.closed = closed
+
+    @property
+    def gst_to_pay(self):
+        """GST owed for the period; negative when it is a refund."""
+        return self.gst_collected - self.gst_claimed
+
+    @classmethod
+    def from_return(cls, gst_return):
+        return cls(
+            gst_return.period_start, gst_return.period_end, gst_return.months, gst_return.sales,
+            gst_return.purchases, gst_return.gst_collected, gst_return.gst_claimed, closed=True,
+        )
+
+
+def add_months(day, months):
+    """The first of the month ``months`` after ``day``'s month."""
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def filing_periods(year, months):
+    """
+    Return the (start, end) of each filing period of a financial year.
+
+    Periods are counted from the start of the year (1 April), so two-monthly
+    periods end in May, July and so on, and six-monthly ones in September and
+    March. Every length divides the year, so no period spans two years.
+    """
+    first = date(year, FIRST_MONTH, 1)
+    periods = []
+    for offset in range(0, 12, months):
+        start = add_months(first, offset)
+        periods.append((start, add_months(start, months) - timedelta(days=1)))
+    return periods
+
+
+def monthly_totals(financial_year, start, end):
+    """
+    Sum a year's sales, purchases and GST by calendar month between two dates
+    in one query: the earnings and expenses are each grouped by TruncMonth of
+    their date and the two results joined with UNION ALL.
+
+    Returns a dict of month (its first day) to [sales, purchases, gst_collected, gst_claimed].
+    """
+    earnings = (
+        Earning.objects.for_owner(financial_year.owner_id)
+        .filter(financial_year=financial_year, date__range=(start, end))
+        .annotate(month=TruncMonth('date')).values('month')
+        .annotate(sales=Sum('amount'), purchases=ZERO, gst_collected=Sum('gst'), gst_claimed=ZERO)
+        .order_by()
+    )
+    expenses = (
+        Expense.objects.for_owner(financial_year.owner_id)
+        .filter(financial_year=financial_year, purchase_date__range=(start, end))
+        .annotate(month=TruncMonth('purchase_date')).values('month')
+        .annotate(sales=ZERO, purchases=Sum('amount'), gst_collected=ZERO, gst_claimed=Sum('gst'))
+        .order_by()
+    )
+    totals = {}
+    for row in earnings.union(expenses, all=True):
+        month_totals = totals.setdefault(row['month'], [Decimal(0)] * 4)
+        # An earning's amount is before GST, an expense's includes it
+        sales = (row['sales'] or 0) + (row['gst_collected'] or 0)
+        for index, value in enumerate((sales, row['purchases'], row['gst_collected'], row['gst_claimed'])):
+            month_totals[index] += Decimal(value or 0)
+    return totals
+
+
+def gst_returns(financial_year, months):
+    """
+    Return a GSTPeriod for each filing period of a year, ``months`` long.
+
+    Closed periods come from their stored GSTReturn; the rest (the open period,
+    future ones, and closed ones not summed yet) are summed in one query, and
+    closed ones among them are stored for next time.
+    """
+    today = timezone.now().date()
+    stored = {
+        gst_return.period_start: gst_return
+        for gst_return in GSTReturn.objects.filter(financial_year=financial_year, months=months)
+    }
+    periods = filing_periods(financial_year.year, months)
+    missing = [(start, end) for start, end in periods if start not in stored or end >= today]
+
+    totals = monthly_totals(financial_year, missing[0][0], missing[-1][1]) if missing else {}
+    results, new_returns = [], []
+    for start, end in periods:
+        if start in stored and end < today:
+            results.append(GSTPeriod.from_return(stored[start]))
+            continue
+        period_totals = [Decimal(0)] * 4
+        month = start
+        while month <= end:
+            for index, value in enumerate(totals.get(month, ())):
+                period_totals[index] += value
+            month = add_months(month, 1)
+        period = GSTPeriod(start, end, months, *period_totals, closed=end < today)
+        results.append(period)
+        if period.closed:
+            new_returns.append(GSTReturn(
+                financial_year=financial_year, months=months, period_start=start, period_end=end,
+                sales=period.sales, purchases=period.purchases,
+                gst_collected=period.gst_collected, gst_claimed=period.gst_claimed,
+            ))
+    if new_returns:
+        # Another request may have stored the same periods meanwhile
+        GSTReturn.objects.bulk_create(new_returns, ignore_conflicts=True)
+    return results
+
+
+def forget_gst_returns(owner_id, since):
+    """Delete a user's stored returns of periods that end on or after ``since``, after a row dated then changed."""
+    GSTReturn.objects.for_owner(owner_id).filter(period_end__gte=since).delete()
+
+
+def is_back_dated(day):
+    """Whether a row dated ``day`` could fall in a closed filing period, i.e. is before this month."""
+    return day is not None and day < timezone.now().date().replace(day=1)
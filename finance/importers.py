@@ -0,0 +1,311 @@
+import csv
+import hashlib
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.db import transaction
+from .depreciation import replace_schedules
+from .gst_returns import forget_gst_returns, is_back_dated
+from .money import apply_rate, from_cents, included_at_rate, to_cents
+from .models import Earning, Expense, FinancialYear, get_financial_year_for_date
+from .schedules import get_gst_rate
+from .summaries import rebuild_summary
+from .years import resolve_financial_years
+
+DEFAULT_CHUNK_SIZE = 1000
+REFERENCE_LENGTH = Earning._meta.get_field('reference').max_length
+EXPENSE_TYPES = {choice for choice, label in Expense.EXPENSE_TYPES}
+
+# Matches one OFX tag and its value, e.g. "<TRNAMT>-12.50" or "<NAME>Cafe</NAME>"
+OFX_TAG = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+
+
+class StatementImportError(Exception):
+    """Raised when a statement line cannot be read."""
+
+
+class StatementLine:
+    """
+    One transaction read from a statement.
+
+    Positive amounts are earnings and negative amounts are expenses, unless
+    ``kind`` says otherwise.
+    """
+
+    def __init__(self, date, amount, description, reference=None, kind=None,
+                 expense_type=None, is_good=False, depreciation_rate=None):
+        self.date = date
+        self.amount = amount
+        self.description = description
+        self.reference = reference or None
+        self.kind = kind or ('earning' if amount >= 0 else 'expense')
+        self.expense_type = expense_type
+        self.is_good = is_good
+        self.depreciation_rate = depreciation_rate
+
+
+class ImportResult:
+    """Counts of what an import did."""
+
+    def __init__(self):
+        self.earnings_created = 0
+        self.earnings_updated = 0
+        self.expenses_created = 0
+        self.expenses_updated = 0
+        self.unchanged = 0
+        self.depreciations_created = 0
+
+    def __str__(self):
+        return (
+            f'{self.earnings_created} earnings created, {self.earnings_updated} updated; '
+            f'{self.expenses_created} expenses created, {self.expenses_updated} updated; '
+            f'{self.unchanged} unchanged; {self.depreciations_created} depreciation rows created'
+        )
+
+
+def parse_date(value):
+    """Parse an ISO (2024-04-30), NZ (30/04/2024) or OFX (20240430...) date."""
+    value = value.strip()
+    for pattern, length in (('%Y-%m-%d', 10), ('%d/%m/%Y', 10), ('%Y%m%d', 8)):
+        try:
+            return datetime.strptime(value[:length], pattern).date()
+        except ValueError:
+            continue
+    raise StatementImportError(f'Unrecognised date: {value!r}')
+
+
+def parse_amount(value):
+    """Parse an amount such as "-1,234.50" or "$99" into a Decimal."""
+    try:
+        return Decimal(value.strip().replace(',', '').replace('$', ''))
+    except InvalidOperation:
+        raise StatementImportError(f'Unrecognised amount: {value!r}')
+
+
+def clean_reference(value):
+    """Fit a bank's transaction ID into the reference field, hashing IDs that are too long."""
+    value = (value or '').strip()
+    if len(value) > REFERENCE_LENGTH:
+        value = hashlib.sha1(value.encode()).hexdigest()[:REFERENCE_LENGTH]
+    return value or None
+
+
+def read_csv(lines):
+    """
+    Read statement lines from CSV text, one row at a time.
+
+    Needs ``date``, ``amount`` and ``description`` columns. ``reference``,
+    ``type`` (earning or expense), ``expense_type``, ``is_good`` and
+    ``depreciation_rate`` are optional.
+    """
+    for row in csv.DictReader(lines):
+        row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+        amount = parse_amount(row.get('amount', ''))
+        kind = row.get('type', '').lower() or None
+        rate = row.get('depreciation_rate')
+        expense_type = row.get('expense_type') or None
+        if expense_type and expense_type not in EXPENSE_TYPES:
+            raise StatementImportError(f'Unknown expense type: {expense_type!r}')
+        yield StatementLine(
+            date=parse_date(row.get('date', '')),
+            amount=amount,
+            description=row.get('description', ''),
+            reference=clean_reference(row.get('reference')),
+            kind=kind,
+            expense_type=expense_type,
+            is_good=row.get('is_good', '').lower() in ('1', 'true', 'yes', 'y'),
+            depreciation_rate=parse_amount(rate) if rate else None,
+        )
+
+
+def read_ofx(lines):
+    """Read statement lines from the <STMTTRN> blocks of an OFX file, one block at a time."""
+    transaction_fields = None
+    for line in lines:
+        for closing, tag, value in OFX_TAG.findall(line):
+            if tag == 'STMTTRN':
+                if not closing:
+                    transaction_fields = {}
+                elif transaction_fields is not None:
+                    yield ofx_statement_line(transaction_fields)
+                    transaction_fields = None
+            elif transaction_fields is not None and not closing:
+                transaction_fields[tag] = value.strip()
+
+
+def ofx_statement_line(fields):
+    """Turn the fields of one OFX <STMTTRN> block into a StatementLine."""
+    description = ' '.join(part for part in (fields.get('NAME'), fields.get('MEMO')) if part)
+    return StatementLine(
+        date=parse_date(fields.get('DTPOSTED', '')),
+        amount=parse_amount(fields.get('TRNAMT', '')),
+        description=description[:255],
+        reference=clean_reference(fields.get('FITID')),
+    )
+
+
+def read_statement(lines, file_format):
+    """Read statement lines from CSV or OFX text."""
+    if file_format == 'ofx':
+        return read_ofx(lines)
+    return read_csv(lines)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items, so only one chunk is in memory at a time."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class StatementImporter:
+    """
+    Write statement lines to one user's Earning and Expense in bulk.
+
+    Lines are handled a chunk at a time. Each chunk resolves its financial
+    years in one query, computes GST in Python and writes with
+    ``bulk_create``/``bulk_update``. Lines with a reference already in the
+    database update that row instead of adding a new one (or are skipped if
+    nothing changed), so importing the same statement twice changes nothing. Model ``save()`` and signals are skipped,
+    so summaries of the touched years are rebuilt once at the end.
+
+    The whole statement is one transaction: lines are read lazily, so a bad
+    line can turn up after earlier chunks were written, and it rolls them back
+    rather than leaving rows behind that the summaries never counted.
+    """
+
+    def __init__(self, owner_id, default_expense_type='professional_services', chunk_size=DEFAULT_CHUNK_SIZE):
+        self.owner_id = owner_id
+        self.default_expense_type = default_expense_type
+        self.chunk_size = chunk_size
+        self.financial_years = {}
+        self.touched_years = set()
+        self.earliest_date = None  # Of every row written or moved, for the GST returns it changes
+        self.result = ImportResult()
+
+    def run(self, lines):
+        """Import every statement line and return an ImportResult."""
+        with transaction.atomic():
+            for chunk in chunked(lines, self.chunk_size):
+                self.import_chunk(chunk)
+            for financial_year in self.touched_years:
+                rebuild_summary(financial_year)
+            if is_back_dated(self.earliest_date):
+                forget_gst_returns(self.owner_id, self.earliest_date)
+        return self.result
+
+    def touch_date(self, date):
+        if self.earliest_date is None or date < self.earliest_date:
+            self.earliest_date = date
+
+    def resolve_financial_years(self, years):
+        """Make sure every year is in ``self.financial_years``, creating missing ones."""
+        missing = set(years) - set(self.financial_years)
+        if missing:
+            self.financial_years.update(resolve_financial_years(self.owner_id, missing))
+
+    def import_chunk(self, chunk):
+        """Resolve years for a chunk, then write its earnings and expenses."""
+        self.resolve_financial_years(get_financial_year_for_date(line.date) for line in chunk)
+
+        earnings = [self.build_earning(line) for line in chunk if line.kind == 'earning']
+        expenses = [self.build_expense(line) for line in chunk if line.kind != 'earning']
+
+        created, updated = self.upsert(Earning, earnings, ['description', 'amount', 'gst', 'date', 'financial_year'])
+        self.result.earnings_created += len(created)
+        self.result.earnings_updated += len(updated)
+
+        created, updated = self.upsert(Expense, expenses, [
+            'description', 'amount', 'gst', 'purchase_date', 'financial_year', 'expense_type', 'is_good', 'depreciation_rate',
+        ])
+        self.result.expenses_created += len(created)
+        self.result.expenses_updated += len(updated)
+        self.replace_depreciations(created, updated)
+
+    def build_earning(self, line):
+        financial_year = self.financial_years[get_financial_year_for_date(line.date)]
+        self.touched_years.add(financial_year)
+        self.touch_date(line.date)
+        cents = abs(to_cents(line.amount))
+        return Earning(
+            owner_id=self.owner_id,
+            reference=line.reference,
+            description=line.description,
+            amount=from_cents(cents),
+            date=line.date,
+            financial_year=financial_year,
+            gst=from_cents(apply_rate(cents, get_gst_rate(financial_year))),
+        )
+
+    def build_expense(self, line):
+        financial_year = self.financial_years[get_financial_year_for_date(line.date)]
+        self.touched_years.add(financial_year)
+        self.touch_date(line.date)
+        cents = abs(to_cents(line.amount))
+        return Expense(
+            owner_id=self.owner_id,
+            reference=line.reference,
+            description=line.description,
+            amount=from_cents(cents),
+            purchase_date=line.date,
+            financial_year=financial_year,
+            expense_type=line.expense_type or self.default_expense_type,
+            is_good=line.is_good,
+            depreciation_rate=line.depreciation_rate,
+            gst=from_cents(included_at_rate(cents, get_gst_rate(financial_year))),
+        )
+
+    def upsert(self, model, rows, update_fields):
+        """
+        Insert new rows and update rows whose reference already exists.
+
+        Rows identical to what is already stored are left alone. Returns the
+        lists of created and updated rows.
+        """
+        columns = [model._meta.get_field(name).attname for name in update_fields]
+        references = {row.reference for row in rows if row.reference}
+        existing = {}
+        if references:
+            stored = model.objects.for_owner(self.owner_id).filter(reference__in=references)
+            stored = stored.values_list('pk', 'reference', *columns)
+            for pk, reference, *values in stored:
+                existing[reference] = (pk, dict(zip(columns, values)))
+
+        # The same reference twice in one chunk: the last line wins
+        by_reference = {}
+        unreferenced = []
+        for row in rows:
+            if row.reference:
+                by_reference[row.reference] = row
+            else:
+                unreferenced.append(row)
+
+        created, updated = unreferenced, []
+        for reference, row in by_reference.items():
+            if reference in existing:
+                row.pk, old_values = existing[reference]
+                if all(getattr(row, column) == value for column, value in old_values.items()):
+                    self.result.unchanged += 1
+                    continue
+                if old_values['financial_year_id'] != row.financial_year_id:
+                    self.touched_years.add(FinancialYear(pk=old_values['financial_year_id'], owner_id=self.owner_id))
+                self.touch_date(old_values['date' if model is Earning else 'purchase_date'])
+                updated.append(row)
+            else:
+                created.append(row)
+
+        model.objects.bulk_create(created, batch_size=self.chunk_size)
+        model.objects.bulk_update(updated, update_fields, batch_size=self.chunk_size)
+        return created, updated
+
+    def replace_depreciations(self, created, updated):
+        """Write depreciation schedules for new goods and replace those of updated expenses."""
+        # replace_schedules skips rows whose primary key the backend could not return from bulk_create
+        expenses = [expense for expense in created if expense.should_depreciate()] + updated
+        self.result.depreciations_created += replace_schedules(expenses)
+
+
+def import_statement(owner_id, lines, file_format='csv', **options):
+    """Import a CSV or OFX statement into a user's ledger from an iterable of text lines."""
+    return StatementImporter(owner_id, **options).run(read_statement(lines, file_format))
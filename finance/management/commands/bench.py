@@ -0,0 +1,62 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from finance.benchmarks import BENCHMARKS, compare, environment
+
+
+def sizes(value):
+    """Parse a comma-separated list of row counts, e.g. "1000,100000"."""
+    return [int(size) for size in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the hot paths (tax, GST, depreciation, dashboard, PDF) and write the results as JSON. '
+        'Everything runs in a transaction that is rolled back, so the database is left as it was.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', help=f'Benchmarks to run: {", ".join(BENCHMARKS)} (default: all).')
+        parser.add_argument('--repeat', type=int, default=5, help='Times to run each case.')
+        parser.add_argument('--rows', type=sizes, default=[1000, 100000, 1000000],
+                            help='Ledger sizes for the dashboard benchmark, comma-separated.')
+        parser.add_argument('--save-rows', type=int, default=1000, help='Rows saved, or assets depreciated, per run.')
+        parser.add_argument('--pdf-rows', type=int, default=200, help='Ledger size for the PDF benchmark.')
+        parser.add_argument('--output', help='File to write the JSON to (default: standard output).')
+        parser.add_argument('--baseline', help='JSON from an earlier run to compare against.')
+        parser.add_argument('--max-slowdown', type=float,
+                            help='With --baseline, fail if any median is more than this many times its baseline.')
+
+    def handle(self, *args, **options):
+        names = options['benchmarks'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+
+        results = []
+        with transaction.atomic():
+            for name in names:
+                self.stderr.write(f'Running {name}...')
+                results += [result.as_dict() for result in BENCHMARKS[name](options)]
+            transaction.set_rollback(True)
+
+        report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+        if options['baseline']:
+            self.compare_with_baseline(results, options['baseline'], options['max_slowdown'])
+
+    def compare_with_baseline(self, results, path, max_slowdown):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        slower = []
+        for name, params, baseline_median, median, ratio in compare(results, baseline):
+            self.stderr.write(f'{name} {params}: {baseline_median:.6f}s -> {median:.6f}s ({ratio:.2f}x)')
+            if max_slowdown and ratio > max_slowdown:
+                slower.append(name)
+        if slower:
+            raise CommandError(f'Slower than the baseline allows: {", ".join(slower)}')
@@ -0,0 +1,31 @@
+from datetime import date
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from finance.exporters import DATASETS, FORMATS, export
+
+
+class Command(BaseCommand):
+    help = "Export a user's earnings, expenses or depreciation as CSV, JSON Lines or columnar JSON, streaming row by row."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(DATASETS))
+        parser.add_argument('--user', required=True, help='Username of the ledger to export.')
+        parser.add_argument('--format', default='csv', choices=list(FORMATS))
+        parser.add_argument('--year', type=int, action='append', dest='years', help='Financial year to export (repeatable).')
+        parser.add_argument('--start', type=date.fromisoformat, help='First date to export (YYYY-MM-DD).')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last date to export (YYYY-MM-DD).')
+        parser.add_argument('--output', help='File to write to (default: standard output).')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            owner = User.objects.get_by_natural_key(options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user {options['user']!r}")
+        chunks = export(owner.pk, options['dataset'], options['format'], options['years'], options['start'], options['end'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from finance.importers import DEFAULT_CHUNK_SIZE, StatementImportError, import_statement
+from finance.models import Expense
+
+
+class Command(BaseCommand):
+    help = "Import earnings and expenses into a user's ledger from a bank statement CSV or OFX file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Statement file to import.')
+        parser.add_argument('--user', required=True, help='Username of the ledger to import into.')
+        parser.add_argument('--format', choices=['csv', 'ofx'], help='File format (default: from the file extension).')
+        parser.add_argument(
+            '--expense-type', default='professional_services', choices=[choice for choice, label in Expense.EXPENSE_TYPES],
+            help='Expense type for lines that do not give one.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Lines written per batch.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('ofx' if path.lower().endswith(('.ofx', '.qfx')) else 'csv')
+        User = get_user_model()
+        try:
+            owner = User.objects.get_by_natural_key(options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user {options['user']!r}")
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as statement:
+                result = import_statement(
+                    owner.pk, statement, file_format,
+                    default_expense_type=options['expense_type'],
+                    chunk_size=options['chunk_size'],
+                )
+        except (OSError, StatementImportError) as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f'Imported {path}: {result}'))
@@ -0,0 +1,34 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from finance.benchmarks import LoadTestError, environment, load_test
+
+
+class Command(BaseCommand):
+    help = (
+        'Save expenses and load the dashboard from many threads at once and report write throughput, latency and '
+        'database errors as JSON. Run it once per database profile to compare them, e.g. with '
+        'SQLITE_JOURNAL_MODE=DELETE SQLITE_TRANSACTION_MODE=DEFERRED for SQLite as it was. '
+        'Writes are committed to the configured database, so do not point it at live data: they belong to a new '
+        'load-test-<random> user, who is deleted with their rows afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent writers, each with its own connection.')
+        parser.add_argument('--writes', type=int, default=100, help='Expenses each thread saves.')
+        parser.add_argument('--read-every', type=int, default=5,
+                            help='Load the dashboard after every this many writes (0 for writes only).')
+        parser.add_argument('--output', help='File to write the JSON to (default: standard output).')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['writes'] < 1:
+            raise CommandError('--threads and --writes must be at least 1')
+        try:
+            result = load_test(options['threads'], options['writes'], options['read_every'])
+        except LoadTestError as e:
+            raise CommandError(str(e))
+        report = json.dumps({'environment': environment(), 'result': result}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from finance.models import FinancialYear
+from finance.summaries import check_summary, rebuild_summary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-year summary totals from the ledger, or check them for drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('years', nargs='*', type=int, help='Financial years to process (default: all).')
+        parser.add_argument('--user', help="Username whose years to process (default: every user's).")
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report summaries that disagree with the ledger; exit with an error if any do.',
+        )
+
+    def handle(self, *args, **options):
+        financial_years = FinancialYear.objects.select_related('owner').order_by('owner', 'year')
+        if options['user']:
+            User = get_user_model()
+            try:
+                financial_years = financial_years.for_owner(User.objects.get_by_natural_key(options['user']))
+            except User.DoesNotExist:
+                raise CommandError(f"No user {options['user']!r}")
+        if options['years']:
+            financial_years = financial_years.filter(year__in=options['years'])
+
+        drifted = 0
+        for financial_year in financial_years:
+            if options['check']:
+                drift = check_summary(financial_year)
+                if drift:
+                    drifted += 1
+                    for name, (stored, actual) in drift.items():
+                        self.stdout.write(f'{financial_year.owner} {financial_year.year}: {name} is {stored}, ledger says {actual}')
+            else:
+                rebuild_summary(financial_year)
+                self.stdout.write(f'Rebuilt summary for {financial_year.owner} {financial_year.year}')
+
+        if drifted:
+            raise CommandError(f'{drifted} financial year summaries have drifted from the ledger.')
+        if options['check']:
+            self.stdout.write(self.style.SUCCESS('All summaries match the ledger.'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from finance.depreciation import recompute_all
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the depreciation schedules of every expense and business cost.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Assets recomputed per transaction.')
+
+    def handle(self, *args, **options):
+        created = recompute_all(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Created {created} depreciation rows'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from finance.attachments import attachment_storage
+from finance.models import Earning, Expense
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete stored attachments, with their previews, that no earning or expense refers to any more. '
+        'Rows share one blob per distinct file, so deleting or replacing a row never deletes its file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=float, default=24,
+            help='Hours since a blob was last stored before it may be deleted, so an upload whose row has not '
+                 'been saved yet is kept (default: 24).',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only list the blobs that would be deleted.')
+
+    def handle(self, *args, **options):
+        # Listed before the rows are read: a blob stored after this is not considered
+        blobs = list(attachment_storage.blobs())
+        referenced = set()
+        for model in (Earning, Expense):
+            referenced.update(model.objects.exclude(attachment='').exclude(attachment=None).values_list('attachment', flat=True))
+
+        removed = 0
+        for name, age in blobs:
+            if name in referenced or age < options['min_age'] * 3600:
+                continue
+            if not options['dry_run']:
+                attachment_storage.delete_blob(name)
+            removed += 1
+            self.stdout.write(name)
+        action = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(f'{action} {removed} orphaned attachments')
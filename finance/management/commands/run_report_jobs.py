@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from finance.pdf_jobs import run_pending_reports
+
+
+class Command(BaseCommand):
+    help = 'Render queued dashboard PDF jobs, e.g. ones left pending when the web process restarted or running when a worker died.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help='Also retry jobs that failed to render.')
+
+    def handle(self, *args, **options):
+        count = run_pending_reports(retry_failed=options['retry_failed'])
+        self.stdout.write(f'Rendered {count} report jobs')
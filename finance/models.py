@@ -1,10 +1,26 @@
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
-from django.core.exceptions import ValidationError
 from decimal import Decimal
+from .attachments import attachment_storage
+from .money import apply_rate, from_cents, included_at_rate, to_cents
+from .schedules import get_gst_rate, get_tax_schedule
+from .tax_engine import NZ_GST_RATE
 
 # Constants
-GST_RATE = Decimal('0.15')
+GST_RATE = NZ_GST_RATE  # Default GST rate; each year can override it with a GSTRate
+DIMINISHING_VALUE = 'DV'
+STRAIGHT_LINE = 'SL'
+DEPRECIATION_METHODS = [
+    (DIMINISHING_VALUE, 'Diminishing value'),
+    (STRAIGHT_LINE, 'Straight line'),
+]
+# Months in each GST filing period
+GST_FILING_FREQUENCIES = [
+    (1, 'Monthly'),
+    (2, 'Two-monthly'),
+    (6, 'Six-monthly'),
+]
 
 # Helper function to calculate the current New Zealand financial year
 def get_current_financial_year():
@@ -12,64 +28,140 @@ def get_current_financial_year():
     # NZ financial year runs from 1st April to 31st March
     return today.year if today.month >= 4 else today.year - 1
 
+def get_financial_year_for_date(date):
+    """Return the NZ financial year (1st April to 31st March) a date falls in."""
+    return date.year if date.month >= 4 else date.year - 1
+
+class OwnedQuerySet(models.QuerySet):
+    """
+    QuerySet of a model that belongs to one user.
+
+    Every per-user query goes through ``for_owner``. Models that hold their
+    owner on a related row name the lookup in ``owner_lookup``.
+    """
+
+    def for_owner(self, owner):
+        """Only the rows of ``owner`` (a user or a user pk)."""
+        return self.filter(**{getattr(self.model, 'owner_lookup', 'owner'): owner})
+
+
 class FinancialYear(models.Model):
-    """Model representing a financial year."""
-    year = models.IntegerField()
-
-    def calculate_tax(self, earnings, gst_registered):
-        """Calculate tax owed based on earnings and personal income."""
-        personal_details = PersonalDetails.objects.first()  # Assuming only one row
-        permanent_income = personal_details.permanent_income
-
-        # New Zealand tax brackets as of 2023
-        tax_brackets = [
-            (0, 14000, 0.105),     # 10.5% on income up to $14,000
-            (14001, 48000, 0.175), # 17.5% on income over $14,000 up to $48,000
-            (48001, 70000, 0.30),  # 30% on income over $48,000 up to $70,000
-            (70001, 180000, 0.33), # 33% on income over $70,000 up to $180,000
-            (180001, float('inf'), 0.39),  # 39% on income over $180,000
+    """Model representing one user's financial year."""
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='financial_years')
+    year = models.IntegerField()  # e.g. 2024 for April 2024 to March 2025
+    # Bumped whenever this year's tax brackets or GST rate change, so compiled
+    # schedules cached in each process know to recompile. Only ever written
+    # with an F() update, never by save()
+    schedule_version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'year'], name='unique_owner_year'),
         ]
 
-        def calculate_tax_for_income(income):
-            tax_owed = Decimal(0)
-            remaining_income = income
+    def save(self, *args, **kwargs):
+        """
+        Save every field but schedule_version, so a stale instance never
+        writes back an old version that compiled schedules would trust again.
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'schedule_version'
+            ]
+        super().save(*args, **kwargs)
+
+    def calculate_tax(self, earnings, gst_registered, permanent_income=None):
+        """
+        Calculate tax owed based on earnings and personal income.
 
-            for lower, upper, rate in tax_brackets:
-                if remaining_income > lower:
-                    taxable_income_in_bracket = min(remaining_income, upper) - lower
-                    if taxable_income_in_bracket > 0:
-                        tax_owed += Decimal(taxable_income_in_bracket) * Decimal(rate)
-            return tax_owed
+        Without ``permanent_income``, the tax on the saved personal details'
+        permanent income is used, which each process works out once per year.
+        """
+        tax_schedule = get_tax_schedule(self)
 
         # Calculate taxes separately for permanent income
-        tax_owed_permanent_income = calculate_tax_for_income(permanent_income)
+        if permanent_income is None:
+            from .personal import get_permanent_income_tax
+            tax_owed_permanent_income = get_permanent_income_tax(self)  # Cached until the details change
+        else:
+            tax_owed_permanent_income = tax_schedule.tax_for_income(permanent_income)
 
         # Adjust earnings based on GST registration
+        earnings_cents = to_cents(earnings)
         if gst_registered:
-            earnings_excluding_gst = earnings / (1 + GST_RATE)
-            tax_owed_earnings = calculate_tax_for_income(earnings_excluding_gst)
-        else:
-            tax_owed_earnings = calculate_tax_for_income(earnings)
+            earnings_cents -= included_at_rate(earnings_cents, get_gst_rate(self))
+        tax_owed_earnings = tax_schedule.tax_for_income(from_cents(earnings_cents))
+
+        # Both are rounded to the cent by the tax schedule
+        return tax_owed_permanent_income, tax_owed_earnings
+
+    def __str__(self):
+        return str(self.year)
 
-        return round(tax_owed_permanent_income, 2), round(tax_owed_earnings, 2)
+class FinancialYearSummary(models.Model):
+    """
+    Model holding the running totals of a financial year.
+
+    Kept up to date by signals on Earning and Expense, so reading a year's
+    totals is a primary-key lookup instead of an aggregate over the ledger.
+    """
+    financial_year = models.OneToOneField(FinancialYear, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    total_earnings = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_expenses = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    gst_collected = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    gst_claimed = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    earning_count = models.IntegerField(default=0)
+    expense_count = models.IntegerField(default=0)
+    data_version = models.PositiveIntegerField(default=0)  # Bumped on every change to the year's ledger
+
+    def __str__(self):
+        return f"Summary of {self.financial_year}"
+
+class TaxBracket(models.Model):
+    """Model representing one income tax bracket of a financial year."""
+    financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='tax_brackets')
+    lower = models.DecimalField(max_digits=12, decimal_places=2)  # Income above this is taxed at rate
+    upper = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)  # Blank for no upper limit
+    rate = models.DecimalField(max_digits=5, decimal_places=4)  # e.g., 0.1050 for 10.5%
+
+    class Meta:
+        ordering = ['financial_year', 'lower']
+
+    def __str__(self):
+        return f"{self.financial_year}: {self.rate} over {self.lower}"
+
+class GSTRate(models.Model):
+    """Model representing the GST rate of a financial year."""
+    financial_year = models.OneToOneField(FinancialYear, on_delete=models.CASCADE, related_name='gst_rate')
+    rate = models.DecimalField(max_digits=5, decimal_places=4)  # e.g., 0.1500 for 15%
+
+    def __str__(self):
+        return f"{self.financial_year}: {self.rate}"
 
 class PersonalDetails(models.Model):
     """Model representing personal details of the user."""
+    owner = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='personal_details')
     gst_registered = models.BooleanField(default=False)
     first_name = models.CharField(max_length=100, blank=True)
     last_name = models.CharField(max_length=100, blank=True)
     email = models.EmailField(blank=True)
     phone = models.CharField(max_length=15, blank=True)
-    permanent_income = models.FloatField(default=0)
+    permanent_income = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    gst_filing_months = models.PositiveSmallIntegerField(
+        'GST filing period', choices=GST_FILING_FREQUENCIES, default=2,
+    )
 
-    def clean(self):
-        """Ensure only one instance of PersonalDetails can exist."""
-        if PersonalDetails.objects.exists() and not self.pk:
-            raise ValidationError('Only one instance of PersonalDetails can exist.')
+    objects = OwnedQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
-        """Ensure only one instance of PersonalDetails is saved."""
-        self.full_clean()  # Call clean to enforce the unique instance
+        """Ensure each user has only one instance of PersonalDetails."""
+        # A saved row keeps its owner, so only a new one is checked for being the
+        # user's second, and updates skip those queries
+        adding = self._state.adding
+        self.full_clean(exclude=None if adding else ['owner'], validate_unique=adding)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -89,57 +181,83 @@ class Expense(models.Model):
         ('professional_services', 'Professional Services'),
     ]
 
+    # The financial year's owner, repeated so per-user indexes can lead with it
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='expenses', editable=False)
     reference = models.CharField(max_length=20, blank=True, null=True)
     description = models.CharField(max_length=255)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     is_good = models.BooleanField(default=False)
     financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='expenses')
-    depreciation_rate = models.FloatField(null=True, blank=True)
+    depreciation_rate = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)  # e.g. 25 for 25%
+    depreciation_method = models.CharField(max_length=2, choices=DEPRECIATION_METHODS, default=STRAIGHT_LINE)
     expense_type = models.CharField(max_length=50, choices=EXPENSE_TYPES)
-    attachment = models.FileField(upload_to='expenses_attachments/', blank=True, null=True)
+    attachment = models.FileField(upload_to='expenses_attachments/', storage=attachment_storage, blank=True, null=True)
     gst = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     purchase_date = models.DateField()
 
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        # One per way the dashboard pages through a year, each led by the owner
+        # and ending in id for the keyset tie-break, plus the importer's lookup
+        indexes = [
+            models.Index(fields=['owner', 'financial_year', 'purchase_date', 'id'], name='expense_owner_date_idx'),
+            models.Index(fields=['owner', 'financial_year', 'expense_type', 'purchase_date', 'id'],
+                         name='expense_owner_type_date_idx'),
+            models.Index(fields=['owner', 'financial_year', 'amount', 'id'], name='expense_owner_amount_idx'),
+            models.Index(fields=['owner', 'reference'], name='expense_owner_reference_idx'),
+        ]
+
     def should_depreciate(self):
         """Check if the expense should depreciate based on its type and amount."""
         return self.is_good and self.amount > 500
 
+    def depreciation_fraction(self):
+        """Return the depreciation rate as a fraction (the field holds a percentage)."""
+        if self.depreciation_rate is None:
+            return Decimal(0)
+        return Decimal(self.depreciation_rate) / 100
+
+    def depreciation_start_date(self):
+        return self.purchase_date
+
     def depreciation_years(self):
         """Calculate the number of years for depreciation."""
-        if self.depreciation_rate is not None and self.depreciation_rate > 0:
-            depreciation_rate_decimal = Decimal(self.depreciation_rate) / Decimal(100)
-            return int(self.amount / (self.amount * depreciation_rate_decimal))
-        return 0  # Default if no depreciation rate
+        from .depreciation import asset_schedule
+        return len(asset_schedule(self))
 
     def calculate_depreciation(self):
         """Calculate the depreciation amount for the expense."""
         if self.is_good and self.depreciation_rate:
-            depreciation_rate_decimal = Decimal(self.depreciation_rate) / Decimal(100)
-            return round(self.amount * depreciation_rate_decimal, 2)
+            return from_cents(apply_rate(to_cents(self.amount), self.depreciation_fraction()))
         return 0
 
-    def tax_impact(self):
-        """Calculate the tax impact of the expense on total earnings."""
-        total_earnings = sum(exp.amount for exp in self.financial_year.expenses.all() if exp.is_good)
-        tax_owed_permanent_income, tax_owed_earnings = self.financial_year.calculate_tax(total_earnings)
-        adjusted_earnings = total_earnings - self.amount
-        adjusted_tax_owed = self.financial_year.calculate_tax(adjusted_earnings)
-        return {
-            'tax_owed_permanent_income': tax_owed_permanent_income,
-            'tax_owed_earnings': tax_owed_earnings,
-            'adjusted_tax_owed': adjusted_tax_owed,
-        }
+    def tax_impact(self, gst_registered=None):
+        """Calculate how much income tax the expense saves in its financial year."""
+        from .personal import get_personal_details
+        from .tax_impact import expense_tax_savings
+        if gst_registered is None:
+            personal_details = get_personal_details(self.owner_id)
+            gst_registered = personal_details.gst_registered if personal_details else False
+        return expense_tax_savings(self.financial_year, [self], gst_registered)[self.pk]
 
     def calculate_depreciation_for_year(self, year):
-        """Calculate the current value and tax write-off for depreciation."""
-        current_value = self.amount - self.calculate_depreciation()
-        tax_write_off = self.calculate_depreciation()
-        return current_value, tax_write_off
+        """Calculate the current value and tax write-off for depreciation in a financial year."""
+        from .depreciation import asset_schedule
+        schedule = asset_schedule(self)
+        for depreciation_year in schedule:
+            if depreciation_year.financial_year == year:
+                return depreciation_year.current_value, depreciation_year.tax_write_off
+        if schedule and year < schedule[0].financial_year:
+            return schedule[0].opening_value, Decimal(0)  # Not bought yet
+        return Decimal(0), Decimal(0)
 
     def save(self, *args, **kwargs):
         """Override save to calculate GST based on total amount."""
-        self.amount = Decimal(self.amount)
-        self.gst = self.amount - (self.amount / (1 + GST_RATE))
+        self.owner_id = self.financial_year.owner_id
+        cents = to_cents(self.amount)
+        self.amount = from_cents(cents)
+        self.gst = from_cents(included_at_rate(cents, get_gst_rate(self.financial_year)))
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -147,37 +265,138 @@ class Expense(models.Model):
 
 class Earning(models.Model):
     """Model representing earnings received by the business."""
+    # The financial year's owner, repeated so per-user indexes can lead with it
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='earnings', editable=False)
     reference = models.CharField(max_length=20, blank=True, null=True)
     description = models.CharField(max_length=255)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date = models.DateField()
     financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='earnings')
-    attachment = models.FileField(upload_to='earnings_attachments/', blank=True, null=True)
+    attachment = models.FileField(upload_to='earnings_attachments/', storage=attachment_storage, blank=True, null=True)
     gst = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
 
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'financial_year', 'date', 'id'], name='earning_owner_date_idx'),
+            models.Index(fields=['owner', 'financial_year', 'amount', 'id'], name='earning_owner_amount_idx'),
+            models.Index(fields=['owner', 'reference'], name='earning_owner_reference_idx'),
+        ]
+
     def save(self, *args, **kwargs):
-        """Override save to calculate GST as 15% of the earnings amount."""
-        self.gst = Decimal(self.amount) * GST_RATE
+        """Override save to calculate GST at the financial year's rate (15% by default)."""
+        self.owner_id = self.financial_year.owner_id
+        cents = to_cents(self.amount)
+        self.amount = from_cents(cents)
+        self.gst = from_cents(apply_rate(cents, get_gst_rate(self.financial_year)))
         super().save(*args, **kwargs)
 
     def __str__(self):
         return self.description
 
 class Depreciation(models.Model):
-    """Model representing depreciation for an expense."""
-    expense = models.ForeignKey(Expense, on_delete=models.CASCADE)
+    """Model representing one year of depreciation for an expense or business cost."""
+    expense = models.ForeignKey(Expense, on_delete=models.CASCADE, null=True, blank=True)
+    business_cost = models.ForeignKey('BusinessCost', on_delete=models.CASCADE, null=True, blank=True)
     financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE)
     current_value = models.DecimalField(max_digits=10, decimal_places=2)
     tax_write_off = models.DecimalField(max_digits=10, decimal_places=2)
     years_to_zero = models.IntegerField()
 
+    owner_lookup = 'financial_year__owner'
+    objects = OwnedQuerySet.as_manager()
+
 class BusinessCost(models.Model):
     """Model representing business costs that do not fit into other categories."""
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='business_costs', editable=False)
     description = models.CharField(max_length=255)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date = models.DateField()
     depreciation_rate = models.DecimalField(max_digits=5, decimal_places=2)  # e.g., 0.20 for 20% depreciation rate
+    depreciation_method = models.CharField(max_length=2, choices=DEPRECIATION_METHODS, default=STRAIGHT_LINE)
     financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='business_costs')
 
+    objects = OwnedQuerySet.as_manager()
+
+    def should_depreciate(self):
+        return self.amount > 0 and self.depreciation_rate > 0
+
+    def depreciation_fraction(self):
+        return self.depreciation_rate
+
+    def depreciation_start_date(self):
+        return self.date
+
+    def save(self, *args, **kwargs):
+        self.owner_id = self.financial_year.owner_id
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.description
+
+
+class ReportJob(models.Model):
+    """
+    Model representing a dashboard PDF render, queued for a worker process.
+
+    Finished PDFs are kept and reused for as long as the year's ledger
+    (data_version) and everything else on the report (context_hash) stay the same.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='report_jobs')
+    data_version = models.PositiveIntegerField()
+    context_hash = models.CharField(max_length=40)  # Personal details and tax schedule the report was built from
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    file = models.FileField(upload_to='reports/', blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)  # Last claimed by a worker, or put back in the queue
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    owner_lookup = 'financial_year__owner'
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['financial_year', 'data_version', 'context_hash'], name='unique_report_version'),
+        ]
+
+    def __str__(self):
+        return f"Report {self.financial_year} v{self.data_version} ({self.status})"
+
+class GSTReturn(models.Model):
+    """
+    The totals of one closed GST filing period, stored so they are summed only
+    once. A change to a row dated in or before the period deletes it, and it
+    is summed again the next time it is asked for.
+    """
+    financial_year = models.ForeignKey(FinancialYear, on_delete=models.CASCADE, related_name='gst_returns')
+    months = models.PositiveSmallIntegerField(choices=GST_FILING_FREQUENCIES)
+    period_start = models.DateField()
+    period_end = models.DateField()
+    sales = models.DecimalField(max_digits=14, decimal_places=2)  # Including GST
+    purchases = models.DecimalField(max_digits=14, decimal_places=2)  # Including GST
+    gst_collected = models.DecimalField(max_digits=14, decimal_places=2)
+    gst_claimed = models.DecimalField(max_digits=14, decimal_places=2)
+
+    owner_lookup = 'financial_year__owner'
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['financial_year', 'months', 'period_start'], name='unique_gst_return_period'),
+        ]
+
+    def __str__(self):
+        return f"GST return {self.period_start} to {self.period_end}"
@@ -0,0 +1,57 @@
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+
+CENT = Decimal('0.01')
+
+# The one rounding rule for money: to the cent, halves away from zero. GST,
+# tax and depreciation are worked out exactly in whole cents and rounded once.
+ROUNDING = ROUND_HALF_UP
+
+
+def to_cents(value):
+    """
+    Return an amount (a Decimal, int, str or float) as a whole number of cents,
+    rounding to the cent. A float is read as the number it prints as, so 0.1 is 10
+    cents and not 0.1000000000000000055...
+    """
+    if isinstance(value, int):
+        return value * 100
+    if isinstance(value, float):
+        value = str(value)
+    return int(Decimal(value).quantize(CENT, ROUNDING).scaleb(2))
+
+
+def from_cents(cents):
+    """Return a number of cents as a Decimal amount with two places."""
+    return Decimal(cents).scaleb(-2)
+
+
+def round_money(value):
+    """Round an amount to the cent, the same way every other money value is rounded."""
+    return Decimal(value or 0).quantize(CENT, ROUNDING)
+
+
+def divide(numerator, denominator):
+    """Divide integers, rounding to the nearest whole number with halves away from zero."""
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+@lru_cache(maxsize=256)
+def rate_ratio(rate):
+    """Return a rate (a Decimal fraction such as 0.15) as an exact (numerator, denominator) pair."""
+    return Decimal(str(rate) if isinstance(rate, float) else rate).as_integer_ratio()
+
+
+def apply_rate(cents, rate):
+    """``cents * rate``, in whole cents: e.g. the GST on a price before GST."""
+    numerator, denominator = rate_ratio(rate)
+    return divide(cents * numerator, denominator)
+
+
+def included_at_rate(cents, rate):
+    """The part of ``cents`` that a rate added on top: e.g. the GST in a price including GST."""
+    numerator, denominator = rate_ratio(rate)
+    return divide(cents * numerator, denominator + numerator)
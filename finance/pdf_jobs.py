@@ -0,0 +1,293 @@
+import functools
+import hashlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from django.template.loader import get_template
+from django.utils import timezone
+from xhtml2pdf import pisa
+from .dashboard import build_dashboard_context, financial_years
+from .models import FinancialYearSummary, ReportJob
+from .personal import get_personal_details
+from .summaries import rebuild_summary
+from .workers import start_worker
+
+# Pool of worker processes that render PDFs, started on first use
+_executor = None
+
+# Threads that async views render PDFs on when there is no worker pool, started on first use
+_render_threads = None
+
+
+class ReportRenderError(Exception):
+    """Raised when xhtml2pdf cannot turn the report HTML into a PDF."""
+
+
+def get_executor():
+    """Return the process pool that renders reports, starting it if needed."""
+    global _executor
+    if _executor is None:
+        # Spawn rather than fork, so workers never share the web process's
+        # database connections. Each worker sets Django up before its first job.
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PDF_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=start_worker,
+        )
+    return _executor
+
+
+def discard_executor(executor):
+    """
+    Drop a pool whose worker died (e.g. killed for running out of memory). A
+    broken pool refuses all work for good, so the next submit starts a new one.
+    """
+    global _executor
+    if _executor is executor:
+        _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def submit(fn, *args):
+    """
+    Run ``fn(*args)`` in the worker pool, replacing the pool once if it is
+    broken. Returns the future, or None if the work could not be handed over:
+    a report job then stays pending for ``reclaim_report_job`` to queue again.
+    """
+    for attempt in range(2):
+        executor = get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError):  # RuntimeError: shut down by another thread's discard
+            discard_executor(executor)
+            continue
+        future.add_done_callback(functools.partial(discard_if_broken, executor))
+        return future
+    return None
+
+
+def discard_if_broken(executor, future):
+    """Done callback: drop the pool straight away when a worker died running ``future``."""
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        discard_executor(executor)
+
+
+def get_render_threads():
+    """
+    Return the bounded thread pool async views render PDFs on when
+    ``PDF_RENDER_WORKERS`` is 0, so at most ``PDF_RENDER_THREADS`` renders run
+    at once however many requests are waiting, starting it if needed.
+    """
+    global _render_threads
+    if _render_threads is None:
+        _render_threads = ThreadPoolExecutor(max_workers=settings.PDF_RENDER_THREADS, thread_name_prefix='pdf-render')
+    return _render_threads
+
+
+def report_context_hash(financial_year, personal_details):
+    """
+    Fingerprint everything on the report that is not part of the year's ledger:
+    the personal details and the year's tax schedule.
+    """
+    values = [financial_year.schedule_version]
+    if personal_details:
+        values += [
+            personal_details.gst_registered, personal_details.first_name, personal_details.last_name,
+            personal_details.email, personal_details.phone, personal_details.permanent_income,
+        ]
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def render_dashboard_pdf(context):
+    """Render the dashboard PDF template with a context and return the PDF bytes."""
+    html = get_template('dashboard_pdf.html').render(context)
+    pdf = io.BytesIO()
+    pisa_status = pisa.CreatePDF(html, dest=pdf)
+    if pisa_status.err:
+        raise ReportRenderError(f'xhtml2pdf reported {pisa_status.err} errors')
+    return pdf.getvalue()
+
+
+async def arender_dashboard_pdf(context):
+    """Render the dashboard PDF on the render threads, leaving the event loop free."""
+    return await sync_to_async(render_dashboard_pdf, thread_sensitive=False, executor=get_render_threads())(context)
+
+
+def get_report_job(financial_year):
+    """
+    Return the report job for the year's current data, and whether it was
+    just created. ``financial_year`` should come from ``financial_years()``
+    so its summary is already loaded.
+    """
+    try:
+        summary = financial_year.summary
+    except FinancialYearSummary.DoesNotExist:
+        summary = rebuild_summary(financial_year)
+    personal_details = get_personal_details(financial_year.owner_id)
+
+    job, created = ReportJob.objects.get_or_create(
+        financial_year=financial_year,
+        data_version=summary.data_version,
+        context_hash=report_context_hash(financial_year, personal_details),
+    )
+    job.financial_year = financial_year  # A job that was already there comes back without it
+    return job, created
+
+
+def stale_before():
+    """Jobs queued or claimed before this are taken to have lost their worker."""
+    return timezone.now() - timedelta(seconds=settings.PDF_RENDER_TIMEOUT)
+
+
+def is_stale(job):
+    """Whether a pending or running job has waited past ``PDF_RENDER_TIMEOUT``."""
+    return job.status in (ReportJob.PENDING, ReportJob.RUNNING) and (job.started_at or job.created_at) < stale_before()
+
+
+def reclaim_report_job(job):
+    """
+    Put a stale job back in the queue, e.g. one whose worker died mid-render
+    or that never reached the pool. Returns whether this call reclaimed it: the
+    update only matches the job as it was read, so only one request wins.
+    """
+    if not is_stale(job):
+        return False
+    now = timezone.now()
+    reclaimed = ReportJob.objects.filter(pk=job.pk, status=job.status, started_at=job.started_at).update(
+        status=ReportJob.PENDING, started_at=now,
+    )
+    if reclaimed:
+        job.status, job.started_at = ReportJob.PENDING, now
+    return bool(reclaimed)
+
+
+def reclaim_stale_reports():
+    """Put every stale job back in the queue. Returns the number reclaimed."""
+    cutoff = stale_before()
+    stale = ReportJob.objects.filter(status__in=[ReportJob.PENDING, ReportJob.RUNNING]).filter(
+        Q(started_at__lt=cutoff) | Q(started_at=None, created_at__lt=cutoff),
+    )
+    return stale.update(status=ReportJob.PENDING, started_at=timezone.now())
+
+
+def request_report(financial_year):
+    """
+    Return the report job for the year's current data, queueing a render if
+    there is no PDF for it yet, or if the last one was lost. A failed render
+    stays failed until the data changes or ``run_report_jobs --retry-failed`` is run.
+    """
+    job, created = get_report_job(financial_year)
+    if created or reclaim_report_job(job):
+        enqueue_report(job)
+    return job
+
+
+async def arequest_report(financial_year):
+    """Async ``request_report``. Without a worker pool the PDF is rendered on the render threads."""
+    job, created = await sync_to_async(get_report_job)(financial_year)
+    if created or await sync_to_async(reclaim_report_job)(job):
+        if settings.PDF_RENDER_WORKERS:
+            await sync_to_async(enqueue_report)(job)
+        else:
+            await arun_report_job(job.pk)
+            await job.arefresh_from_db()
+    return job
+
+
+def enqueue_report(job):
+    """Hand a pending job to the worker pool, or render it now if there is no pool."""
+    if not settings.PDF_RENDER_WORKERS:
+        run_report_job(job.pk)
+        job.refresh_from_db()
+        return
+    # Only submit once the job row is visible to the worker's connection
+    transaction.on_commit(lambda: submit(run_report_job, job.pk))
+
+
+def claim_report_job(job_id):
+    """Mark a pending job as running and return it, or None if another worker took it first."""
+    claimed = ReportJob.objects.filter(pk=job_id, status=ReportJob.PENDING).update(
+        status=ReportJob.RUNNING, started_at=timezone.now(),
+    )
+    return ReportJob.objects.get(pk=job_id) if claimed else None
+
+
+def report_context(job):
+    return build_dashboard_context(financial_years().get(pk=job.financial_year_id))
+
+
+def store_report(job, context, pdf):
+    """Save a claimed job's PDF and mark it done."""
+    filename = f'dashboard-{context["financial_year"].year}-v{job.data_version}.pdf'
+    job.file.save(filename, ContentFile(pdf), save=False)
+    job.status = ReportJob.DONE
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def fail_report(job, error):
+    job.status = ReportJob.FAILED
+    job.error = str(error)
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def run_report_job(job_id):
+    """Render one pending report job and store the PDF. Runs in a worker process."""
+    job = claim_report_job(job_id)
+    if job is None:
+        return
+    try:
+        context = report_context(job)
+        store_report(job, context, render_dashboard_pdf(context))
+    except Exception as e:
+        fail_report(job, e)
+    else:
+        delete_old_reports(job)
+
+
+async def arun_report_job(job_id):
+    """Async ``run_report_job``: the database work is awaited and the render runs on the render threads."""
+    job = await sync_to_async(claim_report_job)(job_id)
+    if job is None:
+        return
+    try:
+        context = await sync_to_async(report_context)(job)
+        pdf = await arender_dashboard_pdf(context)
+        await sync_to_async(store_report)(job, context, pdf)
+    except Exception as e:
+        await sync_to_async(fail_report)(job, e)
+    else:
+        await sync_to_async(delete_old_reports)(job)
+
+
+def delete_old_reports(job):
+    """Remove the year's older PDFs once a newer one is ready."""
+    old_jobs = ReportJob.objects.filter(financial_year_id=job.financial_year_id).exclude(pk=job.pk)
+    old_jobs = old_jobs.exclude(status__in=[ReportJob.PENDING, ReportJob.RUNNING])
+    for old_job in old_jobs:
+        if old_job.file:
+            old_job.file.delete(save=False)
+        old_job.delete()
+
+
+def run_pending_reports(retry_failed=False):
+    """
+    Render every pending job in this process, and every stale one left running
+    by a worker that died. Returns the number of jobs run.
+    """
+    reclaim_stale_reports()
+    if retry_failed:
+        ReportJob.objects.filter(status=ReportJob.FAILED).update(status=ReportJob.PENDING, error='')
+    pending = ReportJob.objects.filter(status=ReportJob.PENDING).order_by('created_at')
+    job_ids = list(pending.values_list('pk', flat=True))
+    for job_id in job_ids:
+        run_report_job(job_id)
+    return len(job_ids)
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+from .caching import LRUCache, current_stamp, new_stamp
+from .models import PersonalDetails
+from .schedules import get_tax_schedule
+
+# Users whose personal details this process keeps at once; the least recently
+# used are dropped first, so a process serving thousands of users stays small
+MAX_CACHED_OWNERS = 1000
+
+# This process's copies of users' personal details, by owner pk. Each is valid
+# while its version matches the user's shared stamp.
+_cached = LRUCache(MAX_CACHED_OWNERS)
+
+# Cache backends whose entries only the process that wrote them can see
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache'}
+
+# False in a PDF worker, which never sees the web process's stamps move when
+# they are kept in a process-local cache, so has to read the row every time
+_local_stamps_trusted = True
+
+
+class CachedPersonalDetails:
+    """A user's personal details row (or None) and the tax on their permanent income per year."""
+
+    def __init__(self, version, personal_details):
+        self.version = version
+        self.personal_details = personal_details
+        self.permanent_income_tax = {}  # (financial year pk, schedule_version): tax
+
+
+def version_key(owner_id):
+    """
+    Cache key of a user's version stamp, shared by every process. Saving or
+    deleting their personal details writes a new stamp, and each process
+    reloads its copy the next time it sees the stamp has changed.
+    """
+    return f'finance:personal_details:version:{owner_id}'
+
+
+def load_personal_details(owner_id):
+    """Read a user's personal details row from the database, or None."""
+    return PersonalDetails.objects.for_owner(owner_id).first()
+
+
+def cache_is_process_local():
+    return settings.CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHES
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs=None, **kwargs):
+    """
+    ``check --deploy``: several web processes on a cache only one of them can
+    see would each keep their own stamps, and serve stale details after a
+    save in another.
+    """
+    if settings.WEB_WORKERS > 1 and cache_is_process_local():
+        return [Error(
+            f'WEB_CONCURRENCY is {settings.WEB_WORKERS} but the default cache is process-local.',
+            hint='Set CACHE_BACKEND and CACHE_LOCATION to a shared cache such as Redis or Memcached.',
+            id='finance.E001',
+        )]
+    return []
+
+
+def distrust_local_stamps():
+    """Make this process (a PDF worker) read personal details every time if the stamps are not shared."""
+    global _local_stamps_trusted
+    _local_stamps_trusted = False
+
+
+def get_cached(owner_id):
+    """Return this process's CachedPersonalDetails of a user, reloading it if the stamp has moved on."""
+    if not _local_stamps_trusted and cache_is_process_local():
+        return CachedPersonalDetails(None, load_personal_details(owner_id))
+    version = current_stamp(version_key(owner_id))
+    if version is None:
+        # A cache that stores nothing (e.g. DummyCache) cannot tell us when to reload
+        return CachedPersonalDetails(None, load_personal_details(owner_id))
+    cached = _cached.get(owner_id)
+    if cached is None or cached.version != version:
+        cached = _cached[owner_id] = CachedPersonalDetails(version, load_personal_details(owner_id))
+    return cached
+
+
+def get_personal_details(owner_id):
+    """
+    Return a user's personal details, or None if there are none yet, without a
+    query when this process already has the current row.
+
+    The instance is shared, so treat it as read-only: load the row from the
+    database to edit it. ``QuerySet.update()`` skips the signals that move the
+    stamp on, so call ``invalidate_personal_details()`` once it commits.
+    """
+    return get_cached(owner_id).personal_details
+
+
+def get_permanent_income_tax(financial_year):
+    """Return the income tax on the owner's permanent income in a financial year, worked out once per year."""
+    cached = get_cached(financial_year.owner_id)
+    key = (financial_year.pk, financial_year.schedule_version)
+    if key not in cached.permanent_income_tax:
+        personal_details = cached.personal_details
+        permanent_income = personal_details.permanent_income if personal_details else 0
+        cached.permanent_income_tax[key] = get_tax_schedule(financial_year).tax_for_income(permanent_income)
+    return cached.permanent_income_tax[key]
+
+
+def invalidate_personal_details(owner_id):
+    """Forget this process's copy of a user's details and tell every other process to drop theirs."""
+    _cached.pop(owner_id, None)
+    new_stamp(version_key(owner_id))
@@ -0,0 +1,180 @@
+import io
+import os
+import time
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, ImageOps, features
+from pypdf import PdfReader
+from .attachments import attachment_storage, write_atomically
+from .pdf_jobs import submit
+
+try:
+    import pypdfium2
+except ImportError:  # Without it a PDF's preview is the largest image on its first page
+    pypdfium2 = None
+
+# Longest side, in pixels, of each preview of an attachment
+PREVIEW_SIZES = {
+    'preview': 1200,   # Detail pages
+    'thumbnail': 240,  # Ledger tables
+}
+
+IMAGE_EXTENSIONS = {'.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+
+# Photos and scans are previewed as WebP, or JPEG where Pillow was built without it
+IMAGE_FORMAT, IMAGE_EXTENSION = ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+# Scale at which pypdfium2 renders a PDF's first page (1 is 72 dpi)
+PDF_RENDER_SCALE = 2
+
+
+def can_preview(name):
+    extension = os.path.splitext(name)[1].lower()
+    return extension in IMAGE_EXTENSIONS or extension == '.pdf'
+
+
+def preview_name(name, size):
+    """
+    Name of one size of an attachment's preview. It sits beside the file, so a
+    blob's previews are named after its digest and shared like the blob is.
+    A PDF's large preview is a PNG, which keeps the text of a page sharp.
+    """
+    base, extension = os.path.splitext(name)
+    suffix = '.png' if extension.lower() == '.pdf' and size == 'preview' else IMAGE_EXTENSION
+    return f'{base}.{size}{suffix}'
+
+
+def first_page(file, extension, pixels):
+    """
+    Return the first frame of an image, or the first page of a PDF, as a
+    Pillow image (or None). ``pixels`` is the largest preview wanted.
+    """
+    if extension != '.pdf':
+        image = Image.open(file)
+        image.seek(0)  # The first page of a multi-page TIFF
+        image.draft('RGB', (pixels, pixels))  # Lets a JPEG decode at a fraction of its size
+        return ImageOps.exif_transpose(image)
+    if pypdfium2 is not None:
+        page = pypdfium2.PdfDocument(file)[0]
+        return page.render(scale=PDF_RENDER_SCALE).to_pil()
+    # A scanned receipt is a page holding one image, which pypdf can pull out without rendering
+    images = PdfReader(file).pages[0].images
+    if not images:
+        return None
+    return max(images, key=lambda image: len(image.data)).image
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'PNG':
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(buffer, image_format, quality=80)
+    return buffer.getvalue()
+
+
+def failed_name(name):
+    """Name of the empty marker left beside an attachment no preview could be made of."""
+    return f'{name}.failed'  # Keeps the extension, so it is never the name of another blob
+
+
+def mark_failed(name):
+    write_atomically(attachment_storage.path(failed_name(name)), [], attachment_storage.file_permissions_mode)
+
+
+def pending_name(name):
+    """Name of the marker left beside an attachment whose previews are queued in the worker pool."""
+    return f'{name}.pending'
+
+
+def claim_pending(name):
+    """
+    Mark an attachment's previews as queued, returning False if they already
+    are, so a page that keeps asking for them queues one job, not one per
+    request. A marker older than PDF_RENDER_TIMEOUT lost its worker and is taken over.
+    """
+    path = attachment_storage.path(pending_name(name))
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) < settings.PDF_RENDER_TIMEOUT:
+                return False
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # Finished meanwhile; queueing again finds nothing missing
+        return True
+
+
+def release_pending(name):
+    try:
+        os.unlink(attachment_storage.path(pending_name(name)))
+    except FileNotFoundError:
+        pass
+
+
+def generate_previews(name):
+    """
+    Write every missing preview of a stored attachment, largest first so each
+    smaller one is shrunk from the last. Returns the names written; files that
+    cannot be read as an image or PDF get none, and a marker so they are not
+    tried again. A blob never changes, so neither does the outcome.
+    """
+    try:
+        return write_previews(name)
+    finally:
+        release_pending(name)
+
+
+def write_previews(name):
+    missing = [size for size in PREVIEW_SIZES if not attachment_storage.exists(preview_name(name, size))]
+    if not missing or not can_preview(name):
+        return []
+    extension = os.path.splitext(name)[1].lower()
+    written = []
+    with attachment_storage.open(name, 'rb') as file:
+        try:
+            image = first_page(file, extension, PREVIEW_SIZES[missing[0]])
+        except Exception:
+            image = None  # Damaged, encrypted or not really what its extension says
+        if image is None:
+            mark_failed(name)
+            return []
+        for size in missing:
+            image.thumbnail((PREVIEW_SIZES[size],) * 2)
+            name_of_preview = preview_name(name, size)
+            image_format = 'PNG' if name_of_preview.endswith('.png') else IMAGE_FORMAT
+            write_atomically(
+                attachment_storage.path(name_of_preview), [encode(image, image_format)],
+                attachment_storage.file_permissions_mode,
+            )
+            written.append(name_of_preview)
+    return written
+
+
+def previews_missing(name):
+    """Whether an attachment still needs previews made: not once they are all there, or making them failed."""
+    if not can_preview(name) or attachment_storage.exists(failed_name(name)):
+        return False
+    return not all(attachment_storage.exists(preview_name(name, size)) for size in PREVIEW_SIZES)
+
+
+def queue_previews(name):
+    """
+    Generate an attachment's previews in the worker pool once the current
+    transaction commits, or straight away when ``PDF_RENDER_WORKERS`` is 0.
+    Previews already queued are not queued again.
+    """
+    if not previews_missing(name):
+        return
+    if not settings.PDF_RENDER_WORKERS:
+        generate_previews(name)
+        return
+    transaction.on_commit(lambda: submit_previews(name))
+
+
+def submit_previews(name):
+    """Hand an attachment's previews to the worker pool, unless they are queued already."""
+    if claim_pending(name) and submit(generate_previews, name) is None:
+        release_pending(name)  # No pool took them; the next request queues them again
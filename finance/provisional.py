@@ -0,0 +1,99 @@
+from datetime import date
+from django.utils import timezone
+from .money import divide, from_cents, to_cents
+
+# Residual income tax above which IRD expects provisional tax the next year
+PROVISIONAL_TAX_THRESHOLD = 5000
+
+# Due dates of the standard three instalments for a 31 March balance date, as
+# (month, day, years after the start of the financial year)
+INSTALMENT_DATES = ((8, 28, 0), (1, 15, 1), (5, 7, 1))
+
+
+class Instalment:
+    """One suggested provisional tax payment."""
+
+    def __init__(self, due, amount, today):
+        self.due = due
+        self.amount = amount
+        self.past = due < today
+
+
+class TaxProjection:
+    """
+    A year's earnings, expenses and tax so far, and where they are heading.
+
+    ``elapsed`` is the share of the year gone by (0 to 1); the projected
+    figures assume the rest of the year keeps the same pace.
+    """
+
+    def __init__(self, as_of, elapsed, earnings, expenses, projected_earnings, projected_expenses,
+                 projected_tax, instalments):
+        self.as_of = as_of
+        self.elapsed = elapsed
+        self.earnings = earnings
+        self.expenses = expenses
+        self.projected_earnings = projected_earnings
+        self.projected_expenses = projected_expenses
+        self.projected_tax = projected_tax
+        self.instalments = instalments
+
+    @property
+    def provisional_tax_due(self):
+        return bool(self.instalments)
+
+
+def year_dates(financial_year):
+    """The first and last day of a financial year (1 April to 31 March)."""
+    return date(financial_year.year, 4, 1), date(financial_year.year + 1, 3, 31)
+
+
+def instalments(financial_year, tax, today):
+    """Split a year's tax into the three standard instalments, any odd cent going on the last."""
+    cents = to_cents(tax)
+    share = divide(cents, len(INSTALMENT_DATES)) if cents > 0 else 0
+    amounts = [share] * (len(INSTALMENT_DATES) - 1)
+    amounts.append(cents - sum(amounts))
+    return [
+        Instalment(date(financial_year.year + years, month, day), from_cents(amount), today)
+        for (month, day, years), amount in zip(INSTALMENT_DATES, amounts)
+    ]
+
+
+def project_tax(financial_year, summary, gst_registered, as_of=None):
+    """
+    Project a year's tax on earnings from its running totals.
+
+    The totals are the year's summary, which every Earning and Expense save
+    and delete already keeps current with a single UPDATE, so the projection
+    is a few sums in whole cents and one tax lookup: no query, however long
+    the ledger. The year-to-date totals are scaled up by the share of the
+    year gone by on ``as_of`` (today by default). Instalments are suggested
+    once the projected tax passes PROVISIONAL_TAX_THRESHOLD.
+    """
+    today = timezone.now().date()
+    as_of = as_of or today
+    start, end = year_dates(financial_year)
+    days = (end - start).days + 1
+    elapsed_days = min(max((as_of - start).days + 1, 0), days)
+
+    earnings, expenses = to_cents(summary.total_earnings), to_cents(summary.total_expenses)
+    if 0 < elapsed_days < days:
+        projected_earnings = divide(earnings * days, elapsed_days)
+        projected_expenses = divide(expenses * days, elapsed_days)
+    else:
+        projected_earnings, projected_expenses = earnings, expenses  # Over, or not started yet
+
+    projected_tax = financial_year.calculate_tax(
+        from_cents(projected_earnings - projected_expenses), gst_registered, permanent_income=0,
+    )[1]
+    return TaxProjection(
+        as_of=as_of,
+        elapsed=elapsed_days / days,
+        earnings=from_cents(earnings),
+        expenses=from_cents(expenses),
+        projected_earnings=from_cents(projected_earnings),
+        projected_expenses=from_cents(projected_expenses),
+        projected_tax=projected_tax,
+        instalments=instalments(financial_year, projected_tax, today) if projected_tax > PROVISIONAL_TAX_THRESHOLD else [],
+    )
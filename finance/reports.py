@@ -0,0 +1,118 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from .dashboard import financial_years
+from .models import Depreciation, Expense, FinancialYearSummary
+from .personal import get_personal_details
+from .money import round_money
+from .summaries import build_summaries
+
+
+class YearReport:
+    """One financial year's line of the year-over-year report."""
+
+    def __init__(self, financial_year, summary, expenses_by_type, depreciation, gst_registered):
+        self.year = financial_year.year
+        self.financial_year_id = financial_year.pk
+        self.earnings = summary.total_earnings
+        self.expenses = summary.total_expenses
+        self.gst_collected = summary.gst_collected
+        self.gst_claimed = summary.gst_claimed
+        self.expenses_by_type = expenses_by_type  # expense_type: total, largest first
+        self.depreciation = depreciation  # Tax written off the year's assets
+        self.tax_owed_permanent_income, self.tax_owed_earnings = financial_year.calculate_tax(
+            summary.total_earnings - summary.total_expenses, gst_registered,
+        )
+
+    def type_columns(self):
+        """The year's total of each expense type, in the order of Expense.EXPENSE_TYPES."""
+        return [self.expenses_by_type.get(expense_type, Decimal(0)) for expense_type, label in Expense.EXPENSE_TYPES]
+
+    def as_dict(self):
+        return {
+            'year': self.year,
+            'financial_year_id': self.financial_year_id,
+            'earnings': self.earnings,
+            'expenses': self.expenses,
+            'expenses_by_type': self.expenses_by_type,
+            'depreciation': self.depreciation,
+            'gst_collected': self.gst_collected,
+            'gst_claimed': self.gst_claimed,
+            'tax_owed_permanent_income': self.tax_owed_permanent_income,
+            'tax_owed_earnings': self.tax_owed_earnings,
+        }
+
+
+def breakdown_key(financial_year, summary):
+    """
+    Cache key of a year's expenses by type. It names the year's data version,
+    so any change to its ledger moves it on and the old entry is never read.
+    """
+    return f'finance:expense_breakdown:{financial_year.pk}:{summary.data_version}'
+
+
+def expense_breakdowns(owner_id, financial_year_ids):
+    """Total several years' expenses by type in one grouped query: {year pk: {expense_type: total}}."""
+    breakdowns = {pk: {} for pk in financial_year_ids}
+    rows = (
+        Expense.objects.for_owner(owner_id).filter(financial_year__in=financial_year_ids)
+        .values_list('financial_year_id', 'expense_type').annotate(total=Sum('amount')).order_by()
+    )
+    for financial_year_id, expense_type, total in rows:
+        breakdowns[financial_year_id][expense_type] = round_money(total)
+    for pk, breakdown in breakdowns.items():
+        breakdowns[pk] = dict(sorted(breakdown.items(), key=lambda item: item[1], reverse=True))
+    return breakdowns
+
+
+def depreciation_by_year(owner_id):
+    """Total every year's depreciation write-offs in one grouped query: {year pk: total}."""
+    rows = (
+        Depreciation.objects.for_owner(owner_id)
+        .values_list('financial_year_id').annotate(total=Sum('tax_write_off')).order_by()
+    )
+    return defaultdict(Decimal, {financial_year_id: round_money(total) for financial_year_id, total in rows})
+
+
+def year_over_year(owner):
+    """
+    Return a YearReport for each of a user's financial years, oldest first.
+
+    The totals and GST come from each year's summary, read with the years in
+    one query (years without one have theirs built together), and the
+    brackets of every year come in a second. Expenses by
+    type are cached per year under its data version, so only years whose
+    ledger changed since the last report (usually just the current one) are
+    grouped again, all in one query. Depreciation is summed for every year
+    each time: an asset's schedule writes to years after the one it was
+    bought in, whose data version does not move.
+    """
+    years = list(financial_years().for_owner(owner).prefetch_related('tax_brackets').order_by('year'))
+    summaries, unsummarised = {}, []
+    for financial_year in years:
+        try:
+            summaries[financial_year.pk] = financial_year.summary
+        except FinancialYearSummary.DoesNotExist:
+            unsummarised.append(financial_year)  # E.g. a year that only holds depreciation
+    summaries.update(build_summaries(unsummarised))
+
+    keys = {financial_year.pk: breakdown_key(financial_year, summaries[financial_year.pk]) for financial_year in years}
+    cached = cache.get_many(keys.values())
+    missing = [pk for pk, key in keys.items() if key not in cached]
+    if missing:
+        computed = expense_breakdowns(owner.pk, missing)
+        cache.set_many({keys[pk]: computed[pk] for pk in missing}, settings.YEAR_REPORT_TIMEOUT)
+        cached.update({keys[pk]: computed[pk] for pk in missing})
+
+    depreciation = depreciation_by_year(owner.pk)
+    personal_details = get_personal_details(owner.pk)
+    gst_registered = personal_details.gst_registered if personal_details else False
+    return [
+        YearReport(
+            financial_year, summaries[financial_year.pk], cached[keys[financial_year.pk]],
+            depreciation[financial_year.pk], gst_registered,
+        )
+        for financial_year in years
+    ]
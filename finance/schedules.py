@@ -0,0 +1,68 @@
+from django.core.exceptions import ObjectDoesNotExist
+from .caching import LRUCache
+from .tax_engine import NZ_2023_TAX_SCHEDULE, NZ_GST_RATE, TaxSchedule
+
+# Process-local cache of compiled schedules, keyed by FinancialYear pk.
+# Each entry remembers the schedule_version it was compiled from, so an edit
+# to a year's brackets or GST rate (which bumps the version) is picked up by
+# every process the next time it loads that year.
+# Holds at most MAX_CACHED_SCHEDULES years, the least recently used dropped first.
+MAX_CACHED_SCHEDULES = 10000
+_compiled_schedules = LRUCache(MAX_CACHED_SCHEDULES)
+
+
+class CompiledSchedule:
+    """The tax brackets and GST rate of one financial year, ready to use."""
+
+    def __init__(self, version, tax_schedule, gst_rate):
+        self.version = version
+        self.tax_schedule = tax_schedule
+        self.gst_rate = gst_rate
+
+
+def compile_schedule(financial_year):
+    """Read a year's brackets and GST rate from the database and compile them."""
+    brackets = [
+        (bracket.lower, bracket.upper, bracket.rate)
+        for bracket in financial_year.tax_brackets.all()
+    ]
+    tax_schedule = TaxSchedule(brackets) if brackets else NZ_2023_TAX_SCHEDULE
+
+    try:
+        gst_rate = financial_year.gst_rate.rate
+    except ObjectDoesNotExist:
+        gst_rate = NZ_GST_RATE
+
+    return CompiledSchedule(financial_year.schedule_version, tax_schedule, gst_rate)
+
+
+def get_schedule(financial_year):
+    """
+    Return the compiled schedule for a financial year.
+
+    Years that have not been saved yet, or that have no brackets or GST rate of
+    their own, use the New Zealand defaults.
+    """
+    if financial_year is None or financial_year.pk is None:
+        return CompiledSchedule(None, NZ_2023_TAX_SCHEDULE, NZ_GST_RATE)
+
+    compiled = _compiled_schedules.get(financial_year.pk)
+    if compiled is None or compiled.version != financial_year.schedule_version:
+        compiled = compile_schedule(financial_year)
+        _compiled_schedules[financial_year.pk] = compiled
+    return compiled
+
+
+def get_tax_schedule(financial_year):
+    """Return the compiled TaxSchedule for a financial year."""
+    return get_schedule(financial_year).tax_schedule
+
+
+def get_gst_rate(financial_year):
+    """Return the GST rate for a financial year as a Decimal."""
+    return get_schedule(financial_year).gst_rate
+
+
+def clear_schedule_cache():
+    """Forget every compiled schedule held by this process."""
+    _compiled_schedules.clear()
@@ -1,20 +1,139 @@
 # signals.py
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
-from .models import Expense, Depreciation, FinancialYear
+from .models import BusinessCost, Earning, Expense, FinancialYear, GSTRate, PersonalDetails, TaxBracket
+from .depreciation import replace_schedules
+from .gst_returns import forget_gst_returns, is_back_dated
+from .personal import invalidate_personal_details
+from .previews import queue_previews
+from .years import forget_financial_year
+from .summaries import apply_summary_delta, rebuild_summary, summary_values, touch_summary
 
+DEPRECIATION_FIELDS = ['amount', 'is_good', 'depreciation_rate', 'depreciation_method', 'purchase_date', 'date']
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """Apply SQLITE_PRAGMAS to each new SQLite connection."""
+    if connection.vendor == 'sqlite':
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            # Straight on the driver's connection, so the pragmas never count as a request's queries
+            connection.connection.execute(f'PRAGMA {name} = {value}')
+
+def depreciation_inputs(instance):
+    """Return the field values an asset's depreciation schedule depends on."""
+    return tuple(instance.__dict__.get(name) for name in DEPRECIATION_FIELDS)
+
+@receiver(post_init, sender=Expense)
+@receiver(post_init, sender=BusinessCost)
+def remember_depreciation_inputs(sender, instance, **kwargs):
+    instance._depreciation_inputs = depreciation_inputs(instance) if instance.pk else None
+
+@receiver(post_save, sender=Expense)
+@receiver(post_save, sender=BusinessCost)
+def replace_depreciation(sender, instance, created, **kwargs):
+    """Recompute an asset's depreciation schedule when anything it depends on changes."""
+    inputs = depreciation_inputs(instance)
+    if created:
+        if instance.should_depreciate():
+            replace_schedules([instance])
+    elif inputs != instance._depreciation_inputs:
+        replace_schedules([instance])
+    instance._depreciation_inputs = inputs
+
+@receiver(post_save, sender=Earning)
 @receiver(post_save, sender=Expense)
-def create_depreciation(sender, instance, created, **kwargs):
-    if created and instance.should_depreciate():
-        years = instance.depreciation_years()
-        for year in range(instance.purchase_date.year, instance.purchase_date.year + years):
-            financial_year, _ = FinancialYear.objects.get_or_create(year=year)
-            current_value, tax_write_off = instance.calculate_depreciation_for_year(year)
-            years_to_zero = years - (year - instance.purchase_date.year)
-            Depreciation.objects.create(
-                expense=instance,
-                financial_year=financial_year,
-                current_value=current_value,
-                tax_write_off=tax_write_off,
-                years_to_zero=years_to_zero
-            )
+def make_attachment_previews(sender, instance, **kwargs):
+    """Queue thumbnails of a newly attached receipt, so ledger pages never wait on them."""
+    if 'attachment' in instance.__dict__ and instance.attachment:  # A deferred attachment was not touched
+        queue_previews(instance.attachment.name)
+
+@receiver(post_save, sender=TaxBracket)
+@receiver(post_delete, sender=TaxBracket)
+@receiver(post_save, sender=GSTRate)
+@receiver(post_delete, sender=GSTRate)
+def bump_schedule_version(sender, instance, **kwargs):
+    """Invalidate compiled schedules of the year whose brackets or GST rate changed."""
+    FinancialYear.objects.filter(pk=instance.financial_year_id).update(schedule_version=F('schedule_version') + 1)
+
+@receiver(post_delete, sender=FinancialYear)
+def forget_deleted_financial_year(sender, instance, **kwargs):
+    forget_financial_year(instance)
+
+@receiver(post_save, sender=PersonalDetails)
+@receiver(post_delete, sender=PersonalDetails)
+def refresh_personal_details(sender, instance, **kwargs):
+    """Make every process reload the user's cached personal details once the change commits."""
+    # Before the commit another process could reload the old row under the
+    # new stamp, and a rolled-back save must not move the stamp at all
+    owner_id = instance.owner_id
+    transaction.on_commit(lambda: invalidate_personal_details(owner_id))
+
+@receiver(post_init, sender=Earning)
+@receiver(post_init, sender=Expense)
+def remember_summary_values(sender, instance, **kwargs):
+    """Remember what a loaded row contributes to its year's summary."""
+    instance._summary_values = summary_values(instance) if instance.pk else None
+
+@receiver(post_save, sender=Earning)
+@receiver(post_save, sender=Expense)
+def update_summary_on_save(sender, instance, created, **kwargs):
+    """Move the saved row's amount, GST and count into its year's summary."""
+    old_values = None if created else instance._summary_values
+    new_values = summary_values(instance)
+
+    if created:
+        apply_summary_delta(sender, *new_values, 1)
+    elif old_values is None or new_values is None:
+        # The row was loaded with deferred fields, so its previous amounts are
+        # unknown; recount the year rather than guess
+        rebuild_summary(instance.financial_year)
+    elif old_values != new_values:
+        apply_summary_delta(sender, old_values[0], -old_values[1], -old_values[2], -1)
+        apply_summary_delta(sender, *new_values, 1)
+    else:
+        # Only descriptive fields changed; the totals stay the same
+        touch_summary(instance.financial_year_id)
+
+    instance._summary_values = new_values
+
+def gst_inputs(instance):
+    """Return the (date, amount, gst) of an Earning or Expense that its GST return depends on."""
+    field = instance._meta.get_field('date' if isinstance(instance, Earning) else 'purchase_date')
+    values = instance.__dict__
+    day = field.to_python(values[field.attname]) if values.get(field.attname) is not None else None
+    return day, values.get('amount'), values.get('gst')
+
+@receiver(post_init, sender=Earning)
+@receiver(post_init, sender=Expense)
+def remember_gst_inputs(sender, instance, **kwargs):
+    instance._gst_inputs = gst_inputs(instance) if instance.pk else None
+
+@receiver(post_save, sender=Earning)
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Earning)
+@receiver(post_delete, sender=Expense)
+def forget_changed_gst_returns(sender, instance, signal, **kwargs):
+    """Drop the stored GST returns of closed periods that a back-dated change alters."""
+    inputs = gst_inputs(instance)
+    old_inputs = instance._gst_inputs
+    if signal is post_save and inputs == old_inputs:
+        return  # Only descriptive fields changed
+    dates = [inputs[0]] + ([old_inputs[0]] if old_inputs else [])
+    dates = [day for day in dates if is_back_dated(day)]
+    if dates:
+        forget_gst_returns(instance.owner_id, min(dates))
+    instance._gst_inputs = inputs
+
+@receiver(post_delete, sender=Earning)
+@receiver(post_delete, sender=Expense)
+def update_summary_on_delete(sender, instance, **kwargs):
+    """Take the deleted row out of its year's summary."""
+    values = instance._summary_values
+    if values is None:
+        rebuild_summary(instance.financial_year)
+    else:
+        apply_summary_delta(sender, values[0], -values[1], -values[2], -1)
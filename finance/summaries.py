@@ -0,0 +1,148 @@
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from .models import Earning, Expense, FinancialYearSummary
+from .money import round_money
+
+# Summary fields that are checked for drift against the ledger
+SUMMARY_FIELDS = [
+    'total_earnings', 'total_expenses', 'gst_collected', 'gst_claimed', 'earning_count', 'expense_count',
+]
+
+
+def summary_values(instance):
+    """
+    Return the (financial_year_id, amount, gst) an Earning or Expense contributes
+    to its year's summary, or None if any of them were deferred when loaded.
+    """
+    values = instance.__dict__
+    if any(name not in values for name in ('financial_year_id', 'amount', 'gst')):
+        return None
+    return values['financial_year_id'], round_money(values['amount']), round_money(values['gst'])
+
+
+def apply_summary_delta(sender, financial_year_id, amount, gst, count):
+    """
+    Add an Earning or Expense amount, GST and row count to a year's summary.
+
+    Pass negative values to take a row away. The update is a single atomic
+    F-expression UPDATE, so concurrent saves never lose each other's changes.
+    A year without a summary row is left alone; it is built from the ledger
+    the first time it is read.
+    """
+    if financial_year_id is None:
+        return
+    if sender is Earning:
+        changes = {
+            'total_earnings': F('total_earnings') + amount,
+            'gst_collected': F('gst_collected') + gst,
+            'earning_count': F('earning_count') + count,
+        }
+    else:
+        changes = {
+            'total_expenses': F('total_expenses') + amount,
+            'gst_claimed': F('gst_claimed') + gst,
+            'expense_count': F('expense_count') + count,
+        }
+    FinancialYearSummary.objects.filter(pk=financial_year_id).update(
+        data_version=F('data_version') + 1, **changes
+    )
+
+
+def touch_summary(financial_year_id):
+    """Bump a year's data version without changing its totals."""
+    FinancialYearSummary.objects.filter(pk=financial_year_id).update(data_version=F('data_version') + 1)
+
+
+def calculate_summary_totals(financial_year):
+    """Aggregate a year's totals straight from the Earning and Expense tables."""
+    earnings = Earning.objects.for_owner(financial_year.owner_id).filter(financial_year=financial_year).aggregate(
+        total_earnings=Sum('amount'), gst_collected=Sum('gst'), earning_count=Count('id'),
+    )
+    expenses = Expense.objects.for_owner(financial_year.owner_id).filter(financial_year=financial_year).aggregate(
+        total_expenses=Sum('amount'), gst_claimed=Sum('gst'), expense_count=Count('id'),
+    )
+    totals = {**earnings, **expenses}
+    for name in ('total_earnings', 'total_expenses', 'gst_collected', 'gst_claimed'):
+        totals[name] = round_money(totals[name])
+    return totals
+
+
+def ledger_totals(financial_year):
+    """A year's totals as subqueries of the ledger, to be worked out by the UPDATE that stores them."""
+    totals = {}
+    for model, names in ((Earning, ('total_earnings', 'gst_collected', 'earning_count')),
+                         (Expense, ('total_expenses', 'gst_claimed', 'expense_count'))):
+        rows = model.objects.filter(financial_year=OuterRef('pk')).order_by().values('financial_year')
+        for name, aggregate in zip(names, (Sum('amount'), Sum('gst'), Count('id'))):
+            output_field = IntegerField() if name.endswith('_count') else DecimalField(max_digits=14, decimal_places=2)
+            totals[name] = Coalesce(Subquery(rows.annotate(total=aggregate).values('total')), Value(0), output_field=output_field)
+    return totals
+
+
+def rebuild_summary(financial_year):
+    """
+    Recalculate a year's summary from the ledger and store it.
+
+    The summary row is locked first and the totals are summed by the same
+    UPDATE that writes them, so a save's F() delta can never land between
+    reading the ledger and writing the totals, to be overwritten.
+    """
+    summaries = FinancialYearSummary.objects.filter(pk=financial_year.pk)
+    with transaction.atomic():
+        if not list(summaries.select_for_update().values_list('pk', flat=True)):
+            # An empty row to fill; one another request inserted meanwhile is filled the same way
+            FinancialYearSummary.objects.bulk_create(
+                [FinancialYearSummary(financial_year_id=financial_year.pk)], ignore_conflicts=True,
+            )
+        summaries.update(data_version=F('data_version') + 1, **ledger_totals(financial_year))
+        return summaries.get()
+
+
+def build_summaries(financial_years):
+    """
+    Build the missing summaries of several years of one owner at once: two
+    grouped queries over the ledger and one insert, however many years.
+    Returns {year pk: summary}.
+    """
+    if not financial_years:
+        return {}
+    owner_id = financial_years[0].owner_id
+    totals = {financial_year.pk: {} for financial_year in financial_years}
+    for model, names in ((Earning, ('total_earnings', 'gst_collected', 'earning_count')),
+                         (Expense, ('total_expenses', 'gst_claimed', 'expense_count'))):
+        rows = (
+            model.objects.for_owner(owner_id).filter(financial_year__in=list(totals))
+            .values_list('financial_year_id').annotate(Sum('amount'), Sum('gst'), Count('id')).order_by()
+        )
+        for financial_year_id, amount, gst, count in rows:
+            totals[financial_year_id].update(zip(names, (round_money(amount), round_money(gst), count)))
+    summaries = {pk: FinancialYearSummary(financial_year_id=pk, **year_totals) for pk, year_totals in totals.items()}
+    # A summary built meanwhile by another request came from the same ledger
+    FinancialYearSummary.objects.bulk_create(summaries.values(), ignore_conflicts=True)
+    return summaries
+
+
+def get_summary(financial_year):
+    """Return a year's summary with a primary-key read, building it if needed."""
+    summary = FinancialYearSummary.objects.filter(pk=financial_year.pk).first()
+    if summary is None:
+        summary = rebuild_summary(financial_year)
+    return summary
+
+
+def check_summary(financial_year):
+    """
+    Compare a year's stored summary with the ledger.
+
+    Returns a dict of ``field: (stored, actual)`` for every field that has
+    drifted; an empty dict means the summary is correct.
+    """
+    summary = FinancialYearSummary.objects.filter(pk=financial_year.pk).first()
+    totals = calculate_summary_totals(financial_year)
+    drift = {}
+    for name in SUMMARY_FIELDS:
+        stored = getattr(summary, name) if summary else None
+        if stored != totals[name]:
+            drift[name] = (stored, totals[name])
+    return drift
@@ -0,0 +1,119 @@
+from bisect import bisect_left
+from decimal import Decimal
+from math import lcm
+from .money import divide, from_cents, rate_ratio, to_cents
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; batches fall back to pure Python
+    np = None
+
+# New Zealand GST rate, used for years without a GST rate of their own
+NZ_GST_RATE = Decimal('0.15')
+
+# New Zealand tax brackets as of 2023, used for years without brackets of their own
+NZ_2023_TAX_BRACKETS = (
+    (0, 14000, Decimal('0.105')),     # 10.5% on income up to $14,000
+    (14001, 48000, Decimal('0.175')), # 17.5% on income over $14,000 up to $48,000
+    (48001, 70000, Decimal('0.30')),  # 30% on income over $48,000 up to $70,000
+    (70001, 180000, Decimal('0.33')), # 33% on income over $70,000 up to $180,000
+    (180001, None, Decimal('0.39')),  # 39% on income over $180,000
+)
+
+
+class TaxSchedule:
+    """
+    A progressive tax bracket schedule compiled into cumulative-tax breakpoints.
+
+    Each bracket is a ``(lower, upper, rate)`` tuple. Income above ``lower`` and
+    up to ``upper`` is taxed at ``rate``, exactly as the original per-bracket loop
+    in ``FinancialYear.calculate_tax`` did. Compiling works out the tax owed on
+    every full bracket up front, so a lookup only has to find the bracket the
+    income lands in (a bisect) and add the part of that one bracket.
+
+    The scalar path works in whole cents: limits are held as cents and every
+    rate as a whole number over one shared denominator, so the tax is summed
+    exactly and rounded to the cent once, with ``money.ROUNDING``.
+    """
+
+    def __init__(self, brackets):
+        brackets = sorted(brackets, key=lambda bracket: bracket[0])
+        self.brackets = tuple(brackets)
+        self.lowers = [to_cents(lower) for lower, upper, rate in brackets]
+        # A missing upper limit means the bracket is open-ended
+        self.uppers = [None if upper in (None, float('inf')) else to_cents(upper) for lower, upper, rate in brackets]
+        ratios = [rate_ratio(rate) for lower, upper, rate in brackets]
+        self.denominator = lcm(*(denominator for numerator, denominator in ratios)) if ratios else 1
+        self.rates = [numerator * (self.denominator // denominator) for numerator, denominator in ratios]
+
+        # Tax owed on all brackets below each bracket, in cents times the denominator
+        self.cumulative_tax = []
+        tax_owed = 0
+        for lower, upper, rate in zip(self.lowers, self.uppers, self.rates):
+            self.cumulative_tax.append(tax_owed)
+            if upper is not None:
+                tax_owed += (upper - lower) * rate
+
+        self._arrays = None
+
+    def bracket_index(self, income_cents):
+        """Return the index of the bracket an income (in cents) falls in, or -1 for no tax."""
+        return bisect_left(self.lowers, income_cents) - 1
+
+    def tax_for_income(self, income):
+        """Calculate the tax owed on a single income as a Decimal, rounded to the cent."""
+        income = to_cents(income)
+        index = self.bracket_index(income)
+        if index < 0:
+            return from_cents(0)
+        upper = self.uppers[index]
+        taxable_income_in_bracket = (income if upper is None else min(income, upper)) - self.lowers[index]
+        tax_owed = self.cumulative_tax[index] + taxable_income_in_bracket * self.rates[index]
+        return from_cents(divide(tax_owed, self.denominator))
+
+    def tax_for_incomes(self, incomes):
+        """
+        Calculate the tax owed on many incomes at once.
+
+        Uses NumPy when it is installed and returns a float array, unrounded;
+        otherwise returns a list of Decimals from the scalar path.
+        """
+        if np is None:
+            return [self.tax_for_income(income) for income in incomes]
+
+        lowers, uppers, rates, cumulative_tax = self.as_arrays()
+        incomes = np.asarray(incomes, dtype=float)
+        index = np.searchsorted(lowers, incomes, side='left') - 1
+        taxed = index >= 0
+        index = np.clip(index, 0, None)
+        in_bracket = np.minimum(incomes, uppers[index]) - lowers[index]
+        return np.where(taxed, cumulative_tax[index] + in_bracket * rates[index], 0.0)
+
+    def tax_savings(self, income, deductions):
+        """
+        Calculate how much less tax is owed on ``income`` thanks to each of many
+        deductions: tax(income + deduction) - tax(income) for every deduction.
+
+        Returns a float array with NumPy and a list of Decimals without it.
+        """
+        if np is None:
+            base_tax = self.tax_for_income(income)
+            return [self.tax_for_income(income + deduction) - base_tax for deduction in deductions]
+        # Both sides unrounded, so no saving is out by the rounding of the base
+        base_tax = self.tax_for_incomes([float(income)])[0]
+        incomes = float(income) + np.asarray(deductions, dtype=float)
+        return self.tax_for_incomes(incomes) - base_tax
+
+    def as_arrays(self):
+        """Return the compiled breakpoints as NumPy float arrays in dollars (built once)."""
+        if self._arrays is None:
+            self._arrays = (
+                np.array(self.lowers, dtype=float) / 100,
+                np.array([np.inf if upper is None else upper for upper in self.uppers], dtype=float) / 100,
+                np.array(self.rates, dtype=float) / self.denominator,
+                np.array(self.cumulative_tax, dtype=float) / (100 * self.denominator),
+            )
+        return self._arrays
+
+
+NZ_2023_TAX_SCHEDULE = TaxSchedule(NZ_2023_TAX_BRACKETS)
@@ -0,0 +1,41 @@
+from decimal import Decimal
+from .models import Expense, FinancialYearSummary
+from .money import from_cents, to_cents
+from .schedules import get_gst_rate, get_tax_schedule
+from .summaries import rebuild_summary
+
+
+def expense_tax_savings(financial_year, expenses=None, gst_registered=False, summary=None):
+    """
+    Work out how much income tax each expense of a year saves.
+
+    An expense's saving is the tax on the year's earnings less every other
+    expense, minus the tax on its earnings less all expenses, following the
+    same GST rules as ``FinancialYear.calculate_tax``. The year's totals come
+    from its summary, and every expense goes through the compiled tax brackets
+    in one batch, so there are no per-expense queries however long the list.
+
+    Pass ``expenses`` when they are already loaded, otherwise the year's
+    amounts are read in one query. Returns a dict of expense pk to saving.
+    """
+    if expenses is None:
+        expenses = Expense.objects.for_owner(financial_year.owner_id).filter(financial_year=financial_year)
+        expenses = expenses.only('id', 'amount')
+    expenses = list(expenses)
+    if not expenses:
+        return {}
+
+    if summary is None:
+        try:
+            summary = financial_year.summary
+        except FinancialYearSummary.DoesNotExist:
+            summary = rebuild_summary(financial_year)
+
+    gst_divisor = 1 + get_gst_rate(financial_year) if gst_registered else Decimal(1)
+    taxable_earnings = (summary.total_earnings - summary.total_expenses) / gst_divisor
+    deductions = [expense.amount / gst_divisor for expense in expenses]
+    savings = get_tax_schedule(financial_year).tax_savings(taxable_earnings, deductions)
+    return {
+        expense.pk: from_cents(to_cents(saving))
+        for expense, saving in zip(expenses, savings)
+    }
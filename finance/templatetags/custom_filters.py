@@ -1,4 +1,5 @@
 from django import template
+from finance.previews import can_preview as previewable
 
 register = template.Library()
 
@@ -23,3 +24,8 @@ def add_attr(field, css):
             attrs[key] = val
 
     return field.as_widget(attrs=attrs)
+
+@register.filter
+def can_preview(attachment):
+    """Whether a preview can be made of an attachment (a FieldFile), so its <img> is worth rendering."""
+    return bool(attachment) and previewable(attachment.name)
@@ -1,14 +1,86 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.contrib.auth import get_user_model
 from django.utils import timezone
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from .models import Earning, Expense, PersonalDetails, FinancialYear
 from django.core.exceptions import ValidationError
+from datetime import date
 from decimal import Decimal
+from unittest import mock
+from . import tax_engine
+from .models import get_current_financial_year, GST_RATE, ReportJob, FinancialYearSummary, GSTRate, TaxBracket
+from django.core.management import call_command
+from django.core.management.base import CommandError, SystemCheckError
+from io import StringIO
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import io
+import os
+import shutil
+import time
+import tracemalloc
+import tempfile
+from .pdf_jobs import run_report_job
+from .importers import StatementImportError, import_statement
+from .exporters import export
+import csv
+import hashlib
+import json
+from .models import BusinessCost, Depreciation, DIMINISHING_VALUE, STRAIGHT_LINE
+from .depreciation import depreciation_schedule
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from . import urls
+from .decorators import query_budget_of
+from .depreciation import recompute_all
+from .pdf_jobs import get_report_job, request_report
+from .benchmarks import LoadTestError, load_test
+from .summaries import rebuild_summary
+from . import summaries
+from . import views
+from .schedules import get_schedule
+from .personal import get_personal_details, get_permanent_income_tax, invalidate_personal_details
+from .years import clear_year_cache, get_financial_year_id, get_financial_year_id_for_date
+from .forms import ExpenseForm
+from . import personal
+from django.core.cache import cache
+from .summaries import check_summary, get_summary
+from .money import apply_rate, from_cents, included_at_rate, round_money, to_cents
+from .schedules import clear_schedule_cache, get_gst_rate, get_tax_schedule
+from . import schedules
+from . import years
+from .tax_impact import expense_tax_savings
+from .dashboard import build_dashboard_context, financial_years, ledger_page
+from .tax_engine import NZ_2023_TAX_BRACKETS, NZ_2023_TAX_SCHEDULE, TaxSchedule
+from PIL import Image
+from .attachments import attachment_storage
+from .previews import PREVIEW_SIZES, generate_previews, pending_name, preview_name
+from .gst_returns import filing_periods, gst_returns
+from .reports import year_over_year
+from .provisional import project_tax
+from .bulk import reassign_financial_years, recompute_gst
+from .models import GSTReturn
+
+
+def create_owner(username='jane'):
+    """Create a user to own the ledger under test."""
+    owner = get_user_model().objects.create_user(username, password='secret')
+    # Test transactions roll back without running on_commit, so an earlier
+    # test's user with the same pk may still have details cached here
+    invalidate_personal_details(owner.pk)
+    return owner
 
 
 class ModelTests(TestCase):
     def setUp(self):
-        self.financial_year = FinancialYear.objects.create(year=2024)
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.owner = create_owner()
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
         """Setup common data for tests."""
         self.earning_data = {
             'description': 'Freelance project',
@@ -29,6 +101,7 @@ class ModelTests(TestCase):
         }
 
         self.personal_detail_data = {
+            'owner': self.owner,
             'first_name': 'Jane',
             'last_name': 'Doe',
             'gst_registered': True,
@@ -38,6 +111,10 @@ class ModelTests(TestCase):
 
         }
 
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
     def test_create_earning(self):
         """Test creating an earning record."""
         earning = Earning.objects.create(**self.earning_data)
@@ -84,4 +161,1604 @@ class ModelTests(TestCase):
     def test_gst_registration(self):
         """Test GST registered field works correctly."""
         personal_detail = PersonalDetails.objects.create(**self.personal_detail_data)
-        self.assertTrue(personal_detail.gst_registered)
\ No newline at end of file
+        self.assertTrue(personal_detail.gst_registered)
+
+def reference_tax_for_income(income, tax_brackets=NZ_2023_TAX_BRACKETS):
+    """The original per-bracket loop from FinancialYear.calculate_tax, unrounded."""
+    tax_owed = Decimal(0)
+    remaining_income = income
+
+    for lower, upper, rate in tax_brackets:
+        if remaining_income > lower:
+            taxable_income_in_bracket = (remaining_income if upper is None else min(remaining_income, upper)) - lower
+            if taxable_income_in_bracket > 0:
+                tax_owed += Decimal(taxable_income_in_bracket) * Decimal(rate)
+    return tax_owed
+
+
+class TaxEngineTests(TestCase):
+    def setUp(self):
+        """Incomes around every bracket edge, plus a spread of ordinary values."""
+        self.incomes = [0, 1, -50, 14000, 14000.5, 14001, 14002, 48000, 48001, 70000,
+                        70001, 180000, 180000.75, 180001, 1000000, 55555.55]
+        self.incomes += [Decimal('0.01'), Decimal('14000.99'), Decimal('48000.50'), Decimal('123456.78')]
+        self.incomes += [income * 37 for income in range(0, 10000, 7)]
+
+    def test_matches_reference_loop(self):
+        """The compiled schedule gives the old loop's exact tax, rounded half up to the cent."""
+        for income in self.incomes:
+            expected = round_money(reference_tax_for_income(Decimal(str(income))))
+            self.assertEqual(NZ_2023_TAX_SCHEDULE.tax_for_income(income), expected, income)
+
+    def test_rounding_is_half_up_in_whole_cents(self):
+        self.assertEqual(to_cents(Decimal('0.105')), 11)
+        self.assertEqual(to_cents(0.1), 10)
+        self.assertEqual(to_cents(Decimal('-0.125')), -13)
+        self.assertEqual(from_cents(1050), Decimal('10.50'))
+        self.assertEqual(apply_rate(10, Decimal('0.15')), 2)  # 1.5 cents
+        self.assertEqual(included_at_rate(11500, Decimal('0.15')), 1500)
+        self.assertEqual(NZ_2023_TAX_SCHEDULE.tax_for_income(Decimal('0.10')), Decimal('0.01'))  # 1.05 cents
+
+    def test_calculate_tax_uses_engine(self):
+        """FinancialYear.calculate_tax matches the old loop after rounding."""
+        owner = create_owner()
+        PersonalDetails.objects.create(owner=owner, permanent_income=Decimal('65432.10'))
+        financial_year = FinancialYear.objects.create(owner=owner, year=2024)
+        earnings = Decimal('23456.78')
+        tax_owed_permanent_income, tax_owed_earnings = financial_year.calculate_tax(earnings, True)
+        self.assertEqual(tax_owed_permanent_income, round_money(reference_tax_for_income(Decimal('65432.1'))))
+        self.assertEqual(tax_owed_earnings, round_money(reference_tax_for_income(Decimal('20397.20'))))  # Less GST
+
+    def test_batch_matches_scalar(self):
+        """The vectorised batch agrees with the scalar path to well under a cent."""
+        taxes = NZ_2023_TAX_SCHEDULE.tax_for_incomes(self.incomes)
+        for income, tax in zip(self.incomes, taxes):
+            self.assertAlmostEqual(float(tax), float(reference_tax_for_income(income)), places=6)
+
+    def test_batch_pure_python_fallback(self):
+        """Without NumPy the batch returns the scalar path's Decimals."""
+        with mock.patch.object(tax_engine, 'np', None):
+            taxes = TaxSchedule(NZ_2023_TAX_BRACKETS).tax_for_incomes(self.incomes)
+        self.assertEqual(taxes, [round_money(reference_tax_for_income(Decimal(str(income)))) for income in self.incomes])
+
+
+class TaxImpactTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=False, permanent_income=0)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        get_summary(self.financial_year)
+        get_schedule(self.financial_year)
+        Earning.objects.create(description='Contract', amount=Decimal('60000.00'), date=timezone.now(),
+                               financial_year=self.financial_year)
+        self.expenses = [
+            Expense.objects.create(description=f'Cost {amount}', amount=amount, purchase_date=timezone.now(),
+                                   expense_type='rent', financial_year=self.financial_year)
+            for amount in (Decimal('1000.00'), Decimal('5000.00'), Decimal('20000.00'))
+        ]
+
+    def expected_saving(self, expense):
+        """Tax on earnings less every other expense, minus tax on earnings less all of them."""
+        taxable = Decimal('60000.00') - sum(expense.amount for expense in self.expenses)
+        saving = reference_tax_for_income(taxable + expense.amount) - reference_tax_for_income(taxable)
+        return saving.quantize(Decimal('0.01'))
+
+    def test_batch_matches_per_expense_loop(self):
+        """Every expense's saving is worked out in one pass, one query for the amounts."""
+        financial_year = financial_years().get(pk=self.financial_year.pk)
+        with self.assertNumQueries(1):
+            savings = expense_tax_savings(financial_year)
+        self.assertEqual(savings, {expense.pk: self.expected_saving(expense) for expense in self.expenses})
+        with mock.patch.object(tax_engine, 'np', None):
+            self.assertEqual(expense_tax_savings(financial_year), savings)
+
+    def test_expense_detail_and_dashboard_show_saving(self):
+        expense = Expense.objects.get(pk=self.expenses[1].pk)
+        self.assertEqual(expense.tax_impact(), self.expected_saving(expense))
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('expense_detail', args=[expense.pk]))
+        self.assertEqual(response.context['tax_saving'], self.expected_saving(expense))
+        self.assertContains(response, 'Tax Saving')
+
+
+class FinancialYearResolverTests(TestCase):
+    def setUp(self):
+        self.addCleanup(clear_year_cache)
+        self.owner = create_owner()
+
+    def test_year_is_unique_per_owner(self):
+        FinancialYear.objects.create(owner=self.owner, year=2024)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FinancialYear.objects.create(owner=self.owner, year=2024)
+        FinancialYear.objects.create(owner=create_owner('sam'), year=2024)
+
+    def test_expense_form_validates_without_queries(self):
+        """Validation no longer writes; saving puts the expense in its purchase date's year."""
+        form = ExpenseForm({
+            'description': 'Train', 'amount': '120.00', 'expense_type': 'travel',
+            'purchase_date': '2025-03-31', 'depreciation_method': STRAIGHT_LINE,
+        }, instance=Expense(owner=self.owner))
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid(), form.errors)
+        self.assertFalse(FinancialYear.objects.exists())
+        expense = form.save()
+        self.assertEqual((expense.financial_year.owner, expense.financial_year.year), (self.owner, 2024))
+
+    def test_known_years_need_no_queries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = get_financial_year_id(self.owner.pk, 2024)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_financial_year_id_for_date(self.owner.pk, timezone.datetime(2025, 1, 15).date()), pk)
+
+        other_owner = create_owner('sam')
+        self.assertNotEqual(get_financial_year_id(other_owner.pk, 2024), pk)
+        FinancialYear.objects.get(pk=pk).delete()
+        self.assertNotEqual(get_financial_year_id(self.owner.pk, 2024), pk)
+
+    def test_year_deleted_by_another_process_is_resolved_again(self):
+        """Another process's deletion moves the shared stamp on, so this process stops using the dead pk."""
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = get_financial_year_id(self.owner.pk, 2024)
+        with mock.patch('finance.signals.forget_financial_year'):  # As if deleted elsewhere
+            FinancialYear.objects.filter(pk=pk).delete()
+        self.assertEqual(get_financial_year_id(self.owner.pk, 2024), pk)  # Not told yet
+        with self.captureOnCommitCallbacks(execute=True):
+            FinancialYear.objects.create(owner=self.owner, year=2019).delete()  # Any deletion of the owner's years
+        new_pk = get_financial_year_id(self.owner.pk, 2024)
+        self.assertNotEqual(new_pk, pk)
+        self.assertTrue(FinancialYear.objects.filter(pk=new_pk).exists())
+
+    def test_rolled_back_years_are_not_remembered(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                get_financial_year_id(self.owner.pk, 2031)
+                transaction.set_rollback(True)
+        self.assertEqual(callbacks, [])
+        self.assertTrue(FinancialYear.objects.filter(pk=get_financial_year_id(self.owner.pk, 2031), year=2031).exists())
+
+    def test_least_recently_used_years_are_dropped(self):
+        with mock.patch.object(years._year_ids, 'max_size', 2), self.captureOnCommitCallbacks(execute=True):
+            first = get_financial_year_id(self.owner.pk, 2023)
+            get_financial_year_id(self.owner.pk, 2024)
+            get_financial_year_id(self.owner.pk, 2023)  # Used again, so 2024 goes next
+            get_financial_year_id(self.owner.pk, 2025)
+        self.assertEqual(list(years._year_ids), [(self.owner.pk, 2023), (self.owner.pk, 2025)])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_financial_year_id(self.owner.pk, 2023), first)
+
+
+class ScheduleTests(TestCase):
+    def setUp(self):
+        clear_schedule_cache()
+        self.owner = create_owner()
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2010)
+        TaxBracket.objects.create(financial_year=self.financial_year, lower=0, upper=10000, rate=Decimal('0.10'))
+        TaxBracket.objects.create(financial_year=self.financial_year, lower=10000, upper=None, rate=Decimal('0.20'))
+        GSTRate.objects.create(financial_year=self.financial_year, rate=Decimal('0.125'))
+        self.financial_year.refresh_from_db()
+
+    def test_year_without_schedule_uses_defaults(self):
+        """Years with no brackets or GST rate fall back to the NZ defaults."""
+        financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        self.assertIs(get_tax_schedule(financial_year), NZ_2023_TAX_SCHEDULE)
+        self.assertEqual(get_gst_rate(financial_year), Decimal('0.15'))
+
+    def test_year_uses_its_own_schedule(self):
+        """Historical years compute with their own brackets and GST rate."""
+        self.assertEqual(get_tax_schedule(self.financial_year).tax_for_income(Decimal('15000')), Decimal('2000'))
+        self.assertEqual(get_gst_rate(self.financial_year), Decimal('0.125'))
+        earning = Earning.objects.create(description='Consulting', amount=Decimal('100.00'), date=timezone.now(), financial_year=self.financial_year)
+        self.assertEqual(earning.gst, Decimal('12.50'))
+
+    def test_saving_a_stale_year_keeps_its_schedule_version(self):
+        """A full save of an instance loaded before a bracket change must not put the old version back."""
+        stale = FinancialYear.objects.get(pk=self.financial_year.pk)
+        GSTRate.objects.filter(financial_year=self.financial_year).get().delete()
+        version = FinancialYear.objects.get(pk=self.financial_year.pk).schedule_version
+        self.assertEqual(version, stale.schedule_version + 1)
+        stale.save()
+        self.assertEqual(FinancialYear.objects.get(pk=self.financial_year.pk).schedule_version, version)
+
+    def test_schedule_is_compiled_once(self):
+        """A cached schedule is reused without touching the database."""
+        get_tax_schedule(self.financial_year)
+        with self.assertNumQueries(0):
+            get_tax_schedule(self.financial_year)
+            get_gst_rate(self.financial_year)
+
+    def test_editing_a_rate_invalidates_the_cache(self):
+        """Saving a bracket bumps the year's version, which forces a recompile."""
+        get_tax_schedule(self.financial_year)
+        bracket = self.financial_year.tax_brackets.get(lower=10000)
+        bracket.rate = Decimal('0.30')
+        bracket.save()
+        financial_year = FinancialYear.objects.get(pk=self.financial_year.pk)
+        self.assertEqual(financial_year.schedule_version, self.financial_year.schedule_version + 1)
+        self.assertEqual(get_tax_schedule(financial_year).tax_for_income(Decimal('15000')), Decimal('2500'))
+
+    def test_least_recently_used_schedules_are_dropped(self):
+        other_year = FinancialYear.objects.create(owner=self.owner, year=2011)
+        with mock.patch.object(schedules._compiled_schedules, 'max_size', 1):
+            get_tax_schedule(self.financial_year)
+            get_tax_schedule(other_year)
+            self.assertEqual(list(schedules._compiled_schedules), [other_year.pk])
+
+
+class PersonalDetailsCacheTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.personal_details = PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=80000)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        get_schedule(self.financial_year)
+
+    def test_loaded_once_per_process(self):
+        get_personal_details(self.owner.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_personal_details(self.owner.pk).pk, self.personal_details.pk)
+
+    def test_saving_and_deleting_invalidate(self):
+        get_personal_details(self.owner.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.personal_details.permanent_income = 50000
+            self.personal_details.save()
+            # Until the save commits other processes could only read the old row
+            self.assertEqual(get_personal_details(self.owner.pk).permanent_income, 80000)
+        self.assertEqual(get_personal_details(self.owner.pk).permanent_income, 50000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.personal_details.delete()
+        self.assertIsNone(get_personal_details(self.owner.pk))
+
+    def test_rolled_back_save_keeps_the_stamp(self):
+        get_personal_details(self.owner.pk)
+        stamp = cache.get(personal.version_key(self.owner.pk))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.personal_details.save()
+            raise IntegrityError('Rolled back')
+        self.assertEqual(cache.get(personal.version_key(self.owner.pk)), stamp)
+
+    @override_settings(WEB_WORKERS=4)
+    def test_several_web_processes_need_a_shared_cache(self):
+        """check --deploy reports the process-local cache, without stopping other commands."""
+        self.assertEqual([error.id for error in personal.check_shared_cache()], ['finance.E001'])
+        with self.assertRaises(SystemCheckError):
+            call_command('check', deploy=True, stdout=StringIO(), stderr=StringIO())
+        call_command('check', stdout=StringIO())
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache'}}):
+            self.assertEqual(personal.check_shared_cache(), [])
+
+    def test_pdf_workers_read_details_every_time_with_a_local_cache(self):
+        """A PDF worker never sees the web process's local stamps move, so it does not trust its own."""
+        get_personal_details(self.owner.pk)
+        with mock.patch.object(personal, '_local_stamps_trusted', False):
+            with self.assertNumQueries(1):
+                self.assertEqual(get_personal_details(self.owner.pk).permanent_income, 80000)
+
+    def test_other_workers_see_a_new_version_stamp(self):
+        """A save in another process moves the shared stamp on, so this process reloads."""
+        get_personal_details(self.owner.pk)
+        PersonalDetails.objects.update(permanent_income=20000)  # Skips signals, as another process's save would here
+        self.assertEqual(get_personal_details(self.owner.pk).permanent_income, 80000)
+        cache.set(personal.version_key(self.owner.pk), 'another-worker')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_personal_details(self.owner.pk).permanent_income, 20000)
+
+    def test_each_user_has_their_own_details(self):
+        """Saving one user's details leaves every other user's cached copy alone."""
+        other_owner = create_owner('sam')
+        PersonalDetails.objects.create(owner=other_owner, permanent_income=30000)
+        get_personal_details(other_owner.pk)
+        self.personal_details.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_personal_details(other_owner.pk).permanent_income, 30000)
+        with self.assertRaises(ValidationError):
+            PersonalDetails.objects.create(owner=other_owner)
+
+    def test_least_recently_used_users_are_dropped(self):
+        with mock.patch.object(personal._cached, 'max_size', 1):
+            get_personal_details(self.owner.pk)
+            get_personal_details(create_owner('sam').pk)
+            self.assertEqual(list(personal._cached), [self.owner.pk + 1])
+        invalidate_personal_details(self.owner.pk)
+
+    def test_permanent_income_tax_is_worked_out_once(self):
+        expected = NZ_2023_TAX_SCHEDULE.tax_for_income(Decimal(80000))
+        with mock.patch.object(NZ_2023_TAX_SCHEDULE, 'tax_for_income', wraps=NZ_2023_TAX_SCHEDULE.tax_for_income) as tax_for_income:
+            self.assertEqual(get_permanent_income_tax(self.financial_year), expected)
+            self.assertEqual(self.financial_year.calculate_tax(Decimal(0), False)[0], round(expected, 2))
+        self.assertEqual(tax_for_income.call_count, 2)  # Permanent income once, then the earnings
+
+
+class FinancialYearSummaryTests(TestCase):
+    def setUp(self):
+        owner = create_owner()
+        self.financial_year = FinancialYear.objects.create(owner=owner, year=2024)
+        self.other_year = FinancialYear.objects.create(owner=owner, year=2023)
+        get_summary(self.financial_year)
+        get_summary(self.other_year)
+
+    def add_earning(self, amount, financial_year=None):
+        return Earning.objects.create(description='Job', amount=Decimal(amount), date=timezone.now(),
+                                      financial_year=financial_year or self.financial_year)
+
+    def add_expense(self, amount, financial_year=None):
+        return Expense.objects.create(description='Rent', amount=Decimal(amount), purchase_date=timezone.now(),
+                                      expense_type='rent', financial_year=financial_year or self.financial_year)
+
+    def test_save_during_a_rebuild_is_neither_lost_nor_counted_twice(self):
+        """A save whose delta lands after the rebuild locked the summary, before it writes the totals."""
+        self.add_earning('100.00')
+        real_ledger_totals = summaries.ledger_totals
+
+        def save_meanwhile(financial_year):
+            self.add_earning('50.00')
+            return real_ledger_totals(financial_year)
+
+        with mock.patch('finance.summaries.ledger_totals', side_effect=save_meanwhile):
+            summary = rebuild_summary(self.financial_year)
+        self.assertEqual(summary.total_earnings, Decimal('150.00'))
+        self.assertEqual(check_summary(self.financial_year), {})
+
+    def test_saves_and_deletes_keep_summary_in_step(self):
+        """Creating, editing, moving and deleting rows never lets the summary drift."""
+        earning = self.add_earning('100.00')
+        self.add_earning('250.50')
+        expense = self.add_expense('40.00')
+
+        earning.amount = Decimal('120.00')
+        earning.save()
+        expense.financial_year = self.other_year
+        expense.save()
+        Earning.objects.get(pk=earning.pk).delete()
+
+        summary = get_summary(self.financial_year)
+        self.assertEqual(summary.total_earnings, Decimal('250.50'))
+        self.assertEqual(summary.earning_count, 1)
+        self.assertEqual(summary.total_expenses, Decimal('0'))
+        self.assertEqual(get_summary(self.other_year).total_expenses, Decimal('40.00'))
+        self.assertEqual(check_summary(self.financial_year), {})
+        self.assertEqual(check_summary(self.other_year), {})
+
+    def test_data_version_changes_on_every_save(self):
+        """Edits that leave the totals alone still bump the data version."""
+        earning = self.add_earning('100.00')
+        version = get_summary(self.financial_year).data_version
+        earning.description = 'Renamed'
+        earning.save()
+        self.assertEqual(get_summary(self.financial_year).data_version, version + 1)
+
+    def test_deferred_rows_fall_back_to_a_rebuild(self):
+        """Saving a row loaded with only() recounts the year instead of guessing."""
+        earning = self.add_earning('100.00')
+        earning = Earning.objects.only('id', 'description').get(pk=earning.pk)
+        earning.description = 'Renamed'
+        earning.save()
+        self.assertEqual(check_summary(self.financial_year), {})
+
+    def test_summary_is_a_single_read(self):
+        """Once built, reading a summary is one primary-key query."""
+        self.add_earning('100.00')
+        with self.assertNumQueries(1):
+            get_summary(self.financial_year)
+
+    def test_rebuild_command_fixes_drift(self):
+        """The management command reports drift and rebuilds the summary."""
+        self.add_expense('75.00')
+        FinancialYearSummary.objects.filter(pk=self.financial_year.pk).update(total_expenses=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_summaries', '--check', stdout=StringIO())
+        call_command('rebuild_summaries', stdout=StringIO())
+        call_command('rebuild_summaries', '--check', stdout=StringIO())
+        self.assertEqual(get_summary(self.financial_year).total_expenses, Decimal('75.00'))
+
+
+class QueryBudgetMixin:
+    def assertWithinQueryBudget(self, view, url):
+        """Request a URL and check the view stayed within its declared query budget."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), view.query_budget,
+            '\n'.join(query['sql'] for query in queries.captured_queries),
+        )
+        return response
+
+
+class DashboardContextTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=60000)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=get_current_financial_year())
+        # The summary is built on first read; from then on saves keep it current
+        get_summary(self.financial_year)
+        for i in range(20):
+            Earning.objects.create(description=f'Job {i}', amount=Decimal('100.00'), date=timezone.now(),
+                                   financial_year=self.financial_year)
+            Expense.objects.create(description=f'Rent {i}', amount=Decimal('40.00'), purchase_date=timezone.now(),
+                                   expense_type='rent', financial_year=self.financial_year)
+        # Compiling the year's tax schedule and loading the personal details are
+        # one-offs per process, not per request
+        get_schedule(self.financial_year)
+        get_personal_details(self.owner.pk)
+
+    def test_dashboard_query_budget(self):
+        response = self.assertWithinQueryBudget(views.dashboard, reverse('dashboard'))
+        self.assertEqual(response.context['total_earnings'], Decimal('2000.00'))
+        self.assertEqual(response.context['total_expenses'], Decimal('800.00'))
+        self.assertEqual(response.context['projection'].earnings, Decimal('2000.00'))
+        self.assertContains(response, 'Job 19')
+        self.assertTrue(all(expense.tax_saving > 0 for expense in response.context['expenses']))
+
+    def test_financial_year_detail_query_budget(self):
+        url = reverse('financial_year_detail', args=[self.financial_year.pk])
+        response = self.assertWithinQueryBudget(views.financial_year_detail, url)
+        self.assertContains(response, 'Rent 19')
+        self.assertEqual(response.context['tax_owed_earnings'], self.financial_year.calculate_tax(Decimal('1200.00'), True)[1])
+
+    def test_derived_amounts_come_from_the_database(self):
+        earning = ledger_page(self.financial_year, 'earnings').rows[0]
+        self.assertEqual(earning.amount_including_gst, earning.amount + earning.gst)
+        expense = ledger_page(self.financial_year, 'expenses').rows[0]
+        self.assertEqual(expense.amount_excluding_gst, expense.amount - expense.gst)
+
+    def test_ledger_tables_are_cached_until_the_year_changes(self):
+        cache.clear()
+        self.client.get(reverse('dashboard'))
+        # update() skips the signals that move the data version on, so the cached rows stay
+        Expense.objects.update(description='Renamed')
+        self.assertContains(self.client.get(reverse('dashboard')), 'Rent 19')
+
+        expense = Expense.objects.first()
+        expense.save()
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, 'Renamed')
+        self.assertNotContains(response, 'Rent 19')
+
+    async def test_async_views_serve_concurrent_requests(self):
+        """Under ASGI the dashboard and detail views await their queries, so one worker serves many requests at once."""
+        await self.async_client.aforce_login(self.owner)
+        expense = await Expense.objects.for_owner(self.owner).afirst()
+        urls = [
+            reverse('dashboard'),
+            reverse('financial_year_detail', args=[self.financial_year.pk]),
+            reverse('expense_detail', args=[expense.pk]),
+        ] * 3
+        responses = await asyncio.gather(*(self.async_client.get(url) for url in urls))
+        self.assertEqual([response.status_code for response in responses], [200] * len(urls))
+        self.assertEqual(responses[0].context['total_earnings'], Decimal('2000.00'))
+        self.assertContains(responses[1], 'Rent 19')
+
+
+class TenantIsolationTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.other_owner = create_owner('sam')
+        year = get_current_financial_year()
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=year)
+        self.other_year = FinancialYear.objects.create(owner=self.other_owner, year=year)
+        Expense.objects.create(description='Mine', amount=Decimal('40.00'), purchase_date=timezone.now(),
+                               expense_type='rent', financial_year=self.financial_year)
+        self.other_expense = Expense.objects.create(description='Theirs', amount=Decimal('90.00'), purchase_date=timezone.now(),
+                                                    expense_type='rent', financial_year=self.other_year)
+        self.client.force_login(self.owner)
+
+    def test_rows_take_their_year_owner(self):
+        self.assertEqual(self.other_expense.owner, self.other_owner)
+        self.assertEqual(list(Expense.objects.for_owner(self.owner).values_list('description', flat=True)), ['Mine'])
+
+    def test_dashboard_only_shows_the_users_ledger(self):
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['financial_year'], self.financial_year)
+        self.assertContains(response, 'Mine')
+        self.assertNotContains(response, 'Theirs')
+
+    def test_other_users_rows_are_not_found(self):
+        for name, pk in [('expense_detail', self.other_expense.pk), ('update_expense', self.other_expense.pk),
+                         ('delete_expense', self.other_expense.pk), ('financial_year_detail', self.other_year.pk)]:
+            with self.subTest(route=name):
+                self.assertEqual(self.client.get(reverse(name, args=[pk])).status_code, 404)
+        self.assertTrue(Expense.objects.filter(pk=self.other_expense.pk).exists())
+
+    def test_detail_pages_work_before_personal_details_are_saved(self):
+        """A new user has no PersonalDetails row yet, and is treated as not GST registered."""
+        earning = Earning.objects.create(description='Job', amount=Decimal('100.00'), date=timezone.now(),
+                                         financial_year=self.financial_year)
+        expense = Expense.objects.for_owner(self.owner).get()
+        for url in (reverse('earning_detail', args=[earning.pk]), reverse('expense_detail', args=[expense.pk])):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(response.context['is_gst_registered'])
+
+    def test_signed_out_requests_go_to_sign_in(self):
+        self.client.logout()
+        response = self.client.get(reverse('dashboard'))
+        self.assertRedirects(response, f"{reverse('login')}?next={reverse('dashboard')}")
+        self.assertEqual(self.client.get(reverse('login')).status_code, 200)
+
+
+class LedgerPaginationTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=0)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        get_summary(self.financial_year)
+        get_schedule(self.financial_year)
+        # Three expenses a day, so pages have to break ties on id
+        for i in range(12):
+            Expense.objects.create(
+                description=f'Item {i}', amount=Decimal(10 + i), purchase_date=timezone.datetime(2024, 5, 1 + i // 3).date(),
+                expense_type='travel' if i % 2 else 'rent', financial_year=self.financial_year,
+            )
+        get_personal_details(self.owner.pk)
+
+    @override_settings(LEDGER_PAGE_SIZE=5)
+    def walk(self, filters):
+        """Follow the cursors through every page, returning the descriptions in order."""
+        seen, cursor = [], None
+        while True:
+            page = ledger_page(self.financial_year, 'expenses', {**filters, 'cursor': cursor})
+            seen += [expense.description for expense in page]
+            cursor = page.next_cursor
+            if not cursor:
+                return seen
+
+    def test_pages_cover_every_row_once_in_order(self):
+        expected = Expense.objects.order_by('-purchase_date', '-pk').values_list('description', flat=True)
+        self.assertEqual(self.walk({}), list(expected))
+        self.assertEqual(self.walk({'sort': 'amount'}), [f'Item {i}' for i in range(12)])
+
+    def test_filters(self):
+        self.assertEqual(self.walk({'sort': 'amount', 'expense_type': 'travel', 'min_amount': Decimal(12)}),
+                         ['Item 3', 'Item 5', 'Item 7', 'Item 9', 'Item 11'])
+
+    def test_fragment_endpoint(self):
+        """Further pages come back as rendered rows plus the next URL, within budget."""
+        url = reverse('ledger_page', args=[self.financial_year.pk, 'expenses'])
+        with override_settings(LEDGER_PAGE_SIZE=5):
+            first = ledger_page(self.financial_year, 'expenses', {'sort': 'date'})
+            response = self.assertWithinQueryBudget(
+                views.ledger_page_view, f'{url}?expenses-sort=date&expenses-cursor={first.next_cursor}'
+            )
+        page = response.json()
+        self.assertIn('Item 5', page['html'])
+        self.assertNotIn('Item 4', page['html'])
+        self.assertIn('expenses-cursor=', page['next_url'])
+        self.assertEqual(self.client.get(f'{url}?expenses-cursor=nonsense').status_code, 400)
+        self.assertEqual(self.client.get(reverse('ledger_page', args=[self.financial_year.pk, 'taxes'])).status_code, 404)
+
+
+# Older than any report job is allowed to wait
+STALE = timezone.timedelta(seconds=settings.PDF_RENDER_TIMEOUT + 1)
+
+
+class PdfReportTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, PDF_RENDER_WORKERS=0)
+        self.settings_override.enable()
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=60000)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=get_current_financial_year())
+        get_summary(self.financial_year)
+        Earning.objects.create(description='Job', amount=Decimal('100.00'), date=timezone.now(),
+                               financial_year=self.financial_year)
+        get_schedule(self.financial_year)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_cached_pdf_is_served_within_budget(self):
+        """The first download renders the PDF; the next one just serves the stored file."""
+        response = self.client.get(reverse('dashboard_pdf'))
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        with mock.patch('finance.pdf_jobs.run_report_job') as run:
+            response = self.assertWithinQueryBudget(views.dashboard_pdf, reverse('dashboard_pdf'))
+        run.assert_not_called()
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+    def test_new_data_renders_a_new_version(self):
+        """A change to the ledger makes a new PDF and removes the old one."""
+        self.client.get(reverse('dashboard_pdf'))
+        Earning.objects.create(description='Another job', amount=Decimal('50.00'), date=timezone.now(),
+                               financial_year=self.financial_year)
+        self.client.get(reverse('dashboard_pdf'))
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, ReportJob.DONE)
+        self.assertEqual(job.data_version, get_summary(self.financial_year).data_version)
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_pending_pdf_returns_status_url(self):
+        """With a worker pool the endpoint answers 202 straight away with a status URL."""
+        with mock.patch('finance.pdf_jobs.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(reverse('dashboard_pdf'))
+        self.assertEqual(response.status_code, 202)
+        job = ReportJob.objects.get()
+        get_executor.return_value.submit.assert_called_once_with(run_report_job, job.pk)
+
+        status = self.client.get(response['Location']).json()
+        self.assertEqual(status['status'], ReportJob.PENDING)
+
+        run_report_job(job.pk)
+        status = self.assertWithinQueryBudget(views.report_status, response['Location']).json()
+        self.assertEqual(status['status'], ReportJob.DONE)
+        download = self.assertWithinQueryBudget(views.report_download, status['download_url'])
+        self.assertEqual(download['Content-Type'], 'application/pdf')
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_broken_pool_is_replaced(self):
+        """A pool broken by a dead worker is dropped and the job goes to a new one."""
+        broken, fresh = mock.Mock(), mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool('A worker died')
+        with mock.patch('finance.pdf_jobs.get_executor', side_effect=[broken, fresh]):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(reverse('dashboard_pdf'))
+        self.assertEqual(response.status_code, 202)
+        broken.shutdown.assert_called_once()
+        fresh.submit.assert_called_once_with(run_report_job, ReportJob.objects.get().pk)
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_failed_submit_leaves_job_pending(self):
+        """When no pool takes the job it stays pending, for the next request or run_report_jobs."""
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool('A worker died')
+        with mock.patch('finance.pdf_jobs.get_executor', return_value=broken):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('dashboard_pdf'))
+        self.assertEqual(ReportJob.objects.get().status, ReportJob.PENDING)
+
+    def abandon_job(self, started_at):
+        """Create the year's report job as if a worker claimed it at ``started_at`` and then died."""
+        job, created = get_report_job(financial_years().get(pk=self.financial_year.pk))
+        ReportJob.objects.filter(pk=job.pk).update(status=ReportJob.RUNNING, started_at=started_at)
+        return job
+
+    def test_stale_running_job_is_reclaimed(self):
+        """A job left running by a dead worker is queued again once it passes PDF_RENDER_TIMEOUT."""
+        job = self.abandon_job(timezone.now())
+        self.assertEqual(self.client.get(reverse('dashboard_pdf')).status_code, 202)
+
+        ReportJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - STALE)
+        response = self.client.get(reverse('dashboard_pdf'))
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(ReportJob.objects.get(pk=job.pk).status, ReportJob.DONE)
+
+    def test_run_report_jobs_reclaims_stale_jobs(self):
+        """run_report_jobs renders stale running jobs as well as pending ones, but leaves fresh running ones."""
+        job = self.abandon_job(timezone.now())
+        call_command('run_report_jobs', stdout=StringIO())
+        self.assertEqual(ReportJob.objects.get(pk=job.pk).status, ReportJob.RUNNING)
+        ReportJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - STALE)
+        call_command('run_report_jobs', stdout=StringIO())
+        self.assertEqual(ReportJob.objects.get(pk=job.pk).status, ReportJob.DONE)
+
+
+STATEMENT_CSV = """date,amount,description,reference,expense_type,is_good,depreciation_rate
+2024-05-01,1150.00,Invoice 1,INV-1,,,
+31/03/2024,-230.00,Stationery,CARD-1,office_supplies,,
+2024-06-10,-2000.00,Laptop,CARD-2,equipment,yes,25
+"""
+
+STATEMENT_OFX = """OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20240702120000
+<TRNAMT>500.00
+<FITID>202407020001
+<NAME>Client Ltd
+<MEMO>Invoice 2
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20240703
+<TRNAMT>-46.00
+<FITID>202407030001
+<NAME>Power Co
+</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+class StatementImportTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+
+    def test_csv_import(self):
+        """Lines land in the right financial year with GST worked out."""
+        result = import_statement(self.owner.pk, StringIO(STATEMENT_CSV), 'csv', chunk_size=2)
+        self.assertEqual((result.earnings_created, result.expenses_created), (1, 2))
+
+        earning = Earning.objects.get(reference='INV-1')
+        self.assertEqual(earning.financial_year.year, 2024)
+        self.assertEqual(earning.gst, Decimal('172.50'))
+
+        stationery = Expense.objects.get(reference='CARD-1')
+        self.assertEqual(stationery.financial_year.year, 2023)  # Before April belongs to the previous year
+        self.assertEqual(stationery.amount, Decimal('230.00'))
+        self.assertEqual(stationery.gst, Decimal('30.00'))
+
+        laptop = Expense.objects.get(reference='CARD-2')
+        self.assertEqual(Depreciation.objects.filter(expense=laptop).count(), laptop.depreciation_years())
+        self.assertEqual(check_summary(earning.financial_year), {})
+
+    def test_reimport_is_idempotent(self):
+        """Importing the same statement twice updates rows instead of duplicating them."""
+        import_statement(self.owner.pk, StringIO(STATEMENT_CSV), 'csv')
+        result = import_statement(self.owner.pk, StringIO(STATEMENT_CSV.replace('1150.00', '1265.00')), 'csv')
+        self.assertEqual((result.earnings_created, result.earnings_updated), (0, 1))
+        self.assertEqual(Earning.objects.get().amount, Decimal('1265.00'))
+        self.assertEqual(Expense.objects.count(), 2)
+        self.assertEqual(Depreciation.objects.count(), Expense.objects.get(reference='CARD-2').depreciation_years())
+
+    def test_ofx_import(self):
+        """OFX transactions are read block by block, keyed on their FITID."""
+        result = import_statement(self.owner.pk, StringIO(STATEMENT_OFX), 'ofx')
+        self.assertEqual((result.earnings_created, result.expenses_created), (1, 1))
+        earning = Earning.objects.get(reference='202407020001')
+        self.assertEqual(earning.description, 'Client Ltd Invoice 2')
+        self.assertEqual(str(earning.date), '2024-07-02')
+
+    def test_bad_line_writes_nothing(self):
+        """A bad line after earlier chunks were written rolls the whole statement back."""
+        statement = STATEMENT_CSV + 'not a date,10.00,Broken,BAD-1,,,\n'
+        with self.assertRaises(StatementImportError):
+            import_statement(self.owner.pk, StringIO(statement), 'csv', chunk_size=2)
+        self.assertFalse(Earning.objects.exists())
+        self.assertFalse(Expense.objects.exists())
+        self.assertFalse(FinancialYearSummary.objects.filter(total_earnings__gt=0).exists())
+
+    def test_upload_view(self):
+        """The upload view imports the file and redirects to the dashboard."""
+        upload = SimpleUploadedFile('statement.csv', STATEMENT_CSV.encode(), content_type='text/csv')
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse('import_statement'), {'statement': upload, 'expense_type': 'travel'})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        self.assertEqual(Expense.objects.for_owner(self.owner).count(), 2)
+
+    def test_same_reference_for_another_user_is_a_new_row(self):
+        """References only match rows of the same user, so two users' statements never collide."""
+        import_statement(self.owner.pk, StringIO(STATEMENT_CSV), 'csv')
+        other_owner = create_owner('sam')
+        result = import_statement(other_owner.pk, StringIO(STATEMENT_CSV), 'csv')
+        self.assertEqual((result.earnings_created, result.expenses_created), (1, 2))
+        self.assertEqual(Earning.objects.get(owner=other_owner).financial_year.owner, other_owner)
+        self.assertEqual(Earning.objects.count(), 2)
+
+
+class LedgerExportTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+        import_statement(self.owner.pk, StringIO(STATEMENT_CSV), 'csv')
+        import_statement(create_owner('sam').pk, StringIO(STATEMENT_CSV.replace('Invoice 1', 'Not mine')), 'csv')
+
+    def test_csv_export_has_computed_columns(self):
+        """Exports include columns worked out by the database, such as amount including GST."""
+        rows = list(csv.DictReader(StringIO(''.join(export(self.owner.pk, 'earnings', 'csv')))))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(Decimal(rows[0]['amount_including_gst']), Decimal('1322.50'))
+        self.assertEqual(rows[0]['financial_year'], '2024')
+
+    def test_filters_by_year_and_date_range(self):
+        """Rows can be limited to financial years or a date range."""
+        lines = ''.join(export(self.owner.pk, 'expenses', 'jsonl', years=[2024])).splitlines()
+        self.assertEqual([json.loads(line)['reference'] for line in lines], ['CARD-2'])
+        lines = ''.join(export(self.owner.pk, 'expenses', 'jsonl', end=timezone.datetime(2024, 3, 31).date())).splitlines()
+        self.assertEqual([json.loads(line)['reference'] for line in lines], ['CARD-1'])
+
+    def test_columnar_depreciation_export(self):
+        """The columnar format groups rows into lists of values per column."""
+        groups = [json.loads(line) for line in ''.join(export(self.owner.pk, 'depreciation', 'columnar')).splitlines()]
+        self.assertEqual(groups[0]['rows'], Depreciation.objects.for_owner(self.owner).count())
+        self.assertEqual(set(groups[0]['columns']['expense_reference']), {'CARD-2'})
+
+    def test_streaming_endpoint(self):
+        """The endpoint streams the export and rejects unknown datasets and bad dates."""
+        response = self.client.get(reverse('export_ledger', args=['expenses', 'csv']), {'year': '2023'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="expenses.csv"')
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['reference'] for row in rows], ['CARD-1'])
+        self.assertEqual(self.client.get(reverse('export_ledger', args=['taxes', 'csv'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('export_ledger', args=['expenses', 'csv']), {'start': 'soon'}).status_code, 400)
+
+
+class AttachmentStorageTests(TestCase):
+    RECEIPT = b'%PDF-1.4 scanned receipt ' * 100
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def upload_expense(self, description):
+        receipt = SimpleUploadedFile('Receipt.PDF', self.RECEIPT, content_type='application/pdf')
+        self.client.post(reverse('add_expense'), {
+            'description': description, 'amount': '20.00', 'expense_type': 'office_supplies',
+            'purchase_date': '2024-05-01', 'depreciation_method': STRAIGHT_LINE, 'attachment': receipt,
+        })
+        return Expense.objects.get(description=description)
+
+    def blobs(self):
+        return [name for directory, dirs, files in os.walk(self.media_root) for name in files]
+
+    def test_identical_uploads_share_one_blob(self):
+        """Small uploads are hashed in memory and large ones as they stream to disk; both land on the same blob."""
+        digest = hashlib.sha256(self.RECEIPT).hexdigest()
+        first = self.upload_expense('Pens')
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100):
+            second = self.upload_expense('More pens')
+        self.assertEqual(first.attachment.name, f'attachments/{digest[:2]}/{digest}.pdf')
+        self.assertEqual(second.attachment.name, first.attachment.name)
+        self.assertEqual(self.blobs(), [f'{digest}.pdf'])
+
+    def test_saving_without_an_upload_hashes_the_content(self):
+        financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        earning = Earning(description='Job', amount=Decimal('10.00'), date=timezone.now(), financial_year=financial_year)
+        earning.attachment.save('invoice.pdf', ContentFile(self.RECEIPT))
+        self.assertIn(hashlib.sha256(self.RECEIPT).hexdigest(), earning.attachment.name)
+
+    def test_serving_ranges_and_revalidation(self):
+        expense = self.upload_expense('Pens')
+        url = reverse('attachment', args=['expenses', expense.pk])
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.RECEIPT)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=4-8')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.RECEIPT[4:9])
+        self.assertEqual(response['Content-Range'], f'bytes 4-8/{len(self.RECEIPT)}')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=99999-').status_code, 416)
+
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertIn('attachment;', self.client.get(f'{url}?download')['Content-Disposition'])
+
+    def test_replaced_file_is_not_served_from_the_old_etag(self):
+        """The URL stays the same when the file is replaced, so the browser's copy must be revalidated."""
+        expense = self.upload_expense('Pens')
+        url = reverse('attachment', args=['expenses', expense.pk])
+        etag = self.client.get(url)['ETag']
+        self.client.post(reverse('update_expense', args=[expense.pk]), {
+            'description': 'Pens', 'amount': '20.00', 'expense_type': 'office_supplies',
+            'purchase_date': '2024-05-01', 'depreciation_method': STRAIGHT_LINE,
+            'attachment': SimpleUploadedFile('Receipt.PDF', b'%PDF-1.4 another receipt'),
+        })
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_web_server_sends_the_file(self):
+        expense = self.upload_expense('Pens')
+        url = reverse('attachment', args=['expenses', expense.pk])
+        with override_settings(ATTACHMENT_SENDFILE='x-accel-redirect'):
+            self.assertEqual(self.client.get(url)['X-Accel-Redirect'], f'/protected-media/{expense.attachment.name}')
+        with override_settings(ATTACHMENT_SENDFILE='x-sendfile'):
+            self.assertEqual(self.client.get(url)['X-Sendfile'], expense.attachment.path)
+
+    def test_other_users_attachments_are_not_found(self):
+        expense = self.upload_expense('Pens')
+        self.client.force_login(create_owner('sam'))
+        self.assertEqual(self.client.get(reverse('attachment', args=['expenses', expense.pk])).status_code, 404)
+
+    def test_orphaned_blobs_are_removed_with_their_previews(self):
+        """A blob goes once no row refers to it and it was last stored more than --min-age hours ago."""
+        kept = self.upload_expense('Pens')
+        shared = kept.attachment.name
+        replaced = self.upload_expense('More pens')
+        self.client.post(reverse('update_expense', args=[kept.pk]), {
+            'description': 'Pens', 'amount': '20.00', 'expense_type': 'office_supplies',
+            'purchase_date': '2024-05-01', 'depreciation_method': STRAIGHT_LINE,
+            'attachment': SimpleUploadedFile('Receipt.PDF', b'%PDF-1.4 another receipt'),
+        })
+        kept.refresh_from_db()
+        self.assertEqual(Expense.objects.get(pk=replaced.pk).attachment.name, shared)  # Still in use
+        remove = lambda *args: call_command('remove_orphaned_attachments', '--min-age', '0', *args, stdout=StringIO())
+        remove()
+        self.assertTrue(attachment_storage.exists(shared))
+
+        replaced.delete()
+        for name in (preview_name(shared, 'thumbnail'), f'{shared}.failed'):
+            with open(attachment_storage.path(name), 'wb') as file:
+                file.write(b'beside the blob')
+        call_command('remove_orphaned_attachments', stdout=StringIO())  # Stored just now
+        remove('--dry-run')
+        self.assertTrue(attachment_storage.exists(shared))
+        remove()
+        self.assertEqual(sorted(self.blobs()), [os.path.basename(kept.attachment.name)])
+
+
+def receipt_image(image_format, size=(1600, 2400)):
+    """A receipt-sized scan, in any format Pillow writes (PDF gives a page holding the image)."""
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'white').save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@override_settings(PDF_RENDER_WORKERS=0)
+class AttachmentPreviewTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.owner = create_owner()
+        self.client.force_login(self.owner)
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=60000)
+        self.addCleanup(clear_year_cache)  # The years uploads create are rolled back
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def upload_expense(self, filename, content):
+        self.client.post(reverse('add_expense'), {
+            'description': 'Receipt', 'amount': '20.00', 'expense_type': 'office_supplies',
+            'purchase_date': '2024-05-01', 'depreciation_method': STRAIGHT_LINE,
+            'attachment': SimpleUploadedFile(filename, content),
+        })
+        return Expense.objects.get(description='Receipt')
+
+    def open_preview(self, name, size):
+        with attachment_storage.open(preview_name(name, size)) as file:
+            image = Image.open(file)
+            image.load()
+        return image
+
+    def test_scans_get_thumbnails_beside_the_blob(self):
+        expense = self.upload_expense('scan.tiff', receipt_image('TIFF'))
+        for size, pixels in PREVIEW_SIZES.items():
+            self.assertEqual(max(self.open_preview(expense.attachment.name, size).size), pixels)
+
+        response = self.client.get(reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail']))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('image/'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(reverse('expense_detail', args=[expense.pk]))
+        self.assertContains(response, reverse('attachment_preview', args=['expenses', expense.pk, 'preview']))
+        rows = self.client.get(reverse('ledger_page', args=[expense.financial_year_id, 'expenses'])).json()['html']
+        self.assertIn(reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail']), rows)
+
+    def test_pdf_preview_is_its_first_page(self):
+        expense = self.upload_expense('receipt.pdf', receipt_image('PDF'))
+        self.assertTrue(preview_name(expense.attachment.name, 'preview').endswith('.preview.png'))
+        self.assertEqual(self.open_preview(expense.attachment.name, 'preview').format, 'PNG')
+
+    def test_files_that_are_not_images_get_no_preview(self):
+        expense = self.upload_expense('notes.pdf', b'not really a PDF')
+        self.assertEqual(generate_previews(expense.attachment.name), [])
+        url = reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(reverse('attachment_preview', args=['expenses', expense.pk, 'huge'])).status_code, 404)
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_failed_previews_are_not_queued_again(self):
+        with override_settings(PDF_RENDER_WORKERS=0):
+            expense = self.upload_expense('notes.pdf', b'not really a PDF')
+        url = reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail'])
+        with mock.patch('finance.pdf_jobs.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        get_executor.assert_not_called()
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_previews_are_made_by_the_worker_pool_after_commit(self):
+        with mock.patch('finance.pdf_jobs.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                expense = self.upload_expense('scan.png', receipt_image('PNG'))
+        get_executor.return_value.submit.assert_called_once_with(generate_previews, expense.attachment.name)
+
+    @override_settings(PDF_RENDER_WORKERS=2)
+    def test_previews_already_queued_are_not_queued_again(self):
+        with mock.patch('finance.pdf_jobs.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                expense = self.upload_expense('scan.png', receipt_image('PNG'))
+            url = reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail'])
+            for _ in range(3):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(self.client.get(url).status_code, 404)
+        get_executor.return_value.submit.assert_called_once_with(generate_previews, expense.attachment.name)
+
+        pending = attachment_storage.path(pending_name(expense.attachment.name))
+        os.utime(pending, (0, 0))  # Its worker died long ago
+        with mock.patch('finance.pdf_jobs.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(url)
+        get_executor.return_value.submit.assert_called_once_with(generate_previews, expense.attachment.name)
+
+        generate_previews(expense.attachment.name)
+        self.assertFalse(os.path.exists(pending))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_files_that_cannot_be_previewed_get_no_img(self):
+        expense = self.upload_expense('notes.txt', b'Paid in cash')
+        response = self.client.get(reverse('expense_detail', args=[expense.pk]))
+        self.assertNotContains(response, reverse('attachment_preview', args=['expenses', expense.pk, 'preview']))
+        rows = self.client.get(reverse('ledger_page', args=[expense.financial_year_id, 'expenses'])).json()['html']
+        self.assertNotIn(reverse('attachment_preview', args=['expenses', expense.pk, 'thumbnail']), rows)
+        self.assertIn(reverse('attachment', args=['expenses', expense.pk]), rows)
+
+
+class DepreciationScheduleTests(TestCase):
+    def setUp(self):
+        self.financial_year = FinancialYear.objects.create(owner=create_owner(), year=2024)
+
+    def add_laptop(self, **fields):
+        values = {
+            'description': 'Laptop', 'amount': Decimal('3000.00'), 'purchase_date': timezone.datetime(2024, 6, 1).date(),
+            'financial_year': self.financial_year, 'is_good': True, 'depreciation_rate': 40,
+        }
+        values.update(fields)
+        return Expense.objects.create(**values)
+
+    def stored_schedule(self, expense):
+        rows = Depreciation.objects.filter(expense=expense).order_by('financial_year__year')
+        return [(row.financial_year.year, row.tax_write_off, row.current_value) for row in rows]
+
+    def test_straight_line(self):
+        """Straight line writes off the same amount each year, the last year taking what is left."""
+        schedule = depreciation_schedule(Decimal('1000'), Decimal('0.3'), timezone.datetime(2024, 2, 1).date(), STRAIGHT_LINE)
+        self.assertEqual([year.financial_year for year in schedule], [2023, 2024, 2025, 2026])
+        self.assertEqual([year.tax_write_off for year in schedule], [Decimal('300.00')] * 3 + [Decimal('100.00')])
+        self.assertEqual([year.years_to_zero for year in schedule], [4, 3, 2, 1])
+
+    def test_diminishing_value(self):
+        """Diminishing value writes off a share of what is left, then the remainder once it is under a dollar."""
+        schedule = depreciation_schedule(Decimal('1000'), Decimal('0.5'), timezone.datetime(2024, 4, 1).date(), DIMINISHING_VALUE)
+        self.assertEqual(schedule[0].financial_year, 2024)
+        self.assertEqual([year.tax_write_off for year in schedule[:2]], [Decimal('500.00'), Decimal('250.00')])
+        self.assertEqual(schedule[-1].current_value, 0)
+        self.assertEqual(sum(year.tax_write_off for year in schedule), Decimal('1000.00'))
+
+    def test_editing_an_expense_replaces_its_schedule(self):
+        """Changing the amount, rate or method recomputes the stored rows."""
+        laptop = self.add_laptop()
+        self.assertEqual(len(self.stored_schedule(laptop)), 3)
+        laptop.depreciation_method = DIMINISHING_VALUE
+        laptop.save()
+        schedule = self.stored_schedule(laptop)
+        self.assertEqual(schedule[0], (2024, Decimal('1200.00'), Decimal('1800.00')))
+        self.assertEqual(sum(write_off for year, write_off, value in schedule), Decimal('3000.00'))
+
+        laptop.is_good = False
+        laptop.save()
+        self.assertEqual(self.stored_schedule(laptop), [])
+
+    def test_deleting_an_expense_removes_its_schedule(self):
+        laptop = self.add_laptop()
+        laptop.delete()
+        self.assertFalse(Depreciation.objects.exists())
+
+    def test_business_cost_schedule(self):
+        """Business costs get a schedule too, with their rate given as a fraction."""
+        cost = BusinessCost.objects.create(
+            description='Desk', amount=Decimal('500.00'), date=timezone.datetime(2024, 5, 1).date(),
+            depreciation_rate=Decimal('0.25'), financial_year=self.financial_year,
+        )
+        self.assertEqual(Depreciation.objects.filter(business_cost=cost).count(), 4)
+
+    def test_recompute_command(self):
+        """The command rebuilds every schedule, for example after rounding rules change."""
+        laptop = self.add_laptop()
+        Depreciation.objects.filter(expense=laptop).delete()
+        out = StringIO()
+        call_command('recompute_depreciation', '--chunk-size', '1', stdout=out)
+        self.assertIn('Created 3 depreciation rows', out.getvalue())
+        self.assertEqual(len(self.stored_schedule(laptop)), 3)
+
+
+class BenchCommandTests(TestCase):
+    def test_writes_json_and_leaves_the_database_alone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/bench.json'
+            call_command('bench', 'tax', 'depreciation', 'dashboard', '--repeat', '1', '--rows', '100',
+                         '--save-rows', '5', '--output', path, stderr=StringIO())
+            with open(path) as output:
+                report = json.load(output)
+
+            names = {result['name'] for result in report['results']}
+            self.assertEqual(names, {'tax.calculate_tax', 'tax.batch', 'depreciation.schedule',
+                                     'depreciation.replace_schedules', 'dashboard.page', 'dashboard.full_ledger'})
+            self.assertFalse(FinancialYear.objects.exists())
+
+            # A baseline ten thousand times faster than this run fails the check
+            for result in report['results']:
+                result['median'] /= 10000
+            with open(path, 'w') as baseline:
+                json.dump(report, baseline)
+            with self.assertRaises(CommandError):
+                call_command('bench', 'tax', '--repeat', '1', '--baseline', path, '--max-slowdown', '2',
+                             stdout=StringIO(), stderr=StringIO())
+
+
+class DatabaseProfileTests(TransactionTestCase):
+    def test_sqlite_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def test_load_test_commits_from_its_own_connections_and_cleans_up(self):
+        output = StringIO()
+        clear_year_cache()  # Years other tests resolved were rolled back or flushed
+        # One thread: the in-memory test database locks whole tables between connections
+        call_command('load_test', '--threads', '1', '--writes', '3', '--read-every', '2', stdout=output)
+        result = json.loads(output.getvalue())['result']
+        self.assertEqual((result['writes_saved'], result['write_errors'], result['read_errors']), (3, 0, 0))
+        self.assertFalse(get_user_model().objects.filter(username__startswith='load-test').exists())
+        self.assertFalse(Expense.objects.exists())
+
+    def test_load_test_never_touches_an_existing_user(self):
+        owner = create_owner('load-test')
+        Expense.objects.create(description='Real', amount=Decimal('10.00'), purchase_date=timezone.now(), expense_type='rent',
+                               financial_year=FinancialYear.objects.create(owner=owner, year=2024))
+        with self.assertRaises(LoadTestError):
+            load_test(1, 1, username='load-test')
+        self.assertTrue(Expense.objects.filter(owner=owner).exists())
+
+
+class ProvisionalTaxTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        get_summary(self.financial_year)
+        Earning.objects.create(description='Contract', amount=Decimal('36600.00'), date=date(2024, 5, 1),
+                               financial_year=self.financial_year)
+        Expense.objects.create(description='Rent', amount=Decimal('1830.00'), purchase_date=date(2024, 5, 1),
+                               expense_type='rent', financial_year=self.financial_year)
+        self.summary = get_summary(self.financial_year)
+        get_schedule(self.financial_year)
+
+    def test_year_to_date_is_annualised(self):
+        """Half way through the year the running totals are doubled, without a query."""
+        with self.assertNumQueries(0):
+            projection = project_tax(self.financial_year, self.summary, False, as_of=date(2024, 9, 30))
+        self.assertEqual(projection.elapsed, 183 / 365)
+        self.assertEqual(projection.projected_earnings, Decimal('73000.00'))
+        self.assertEqual(projection.projected_expenses, Decimal('3650.00'))
+        self.assertEqual(projection.projected_tax, NZ_2023_TAX_SCHEDULE.tax_for_income(Decimal('69350.00')))
+
+    def test_a_finished_year_is_not_scaled(self):
+        projection = project_tax(self.financial_year, self.summary, False, as_of=date(2025, 6, 1))
+        self.assertEqual(projection.elapsed, 1)
+        self.assertEqual(projection.projected_earnings, Decimal('36600.00'))
+        self.assertEqual(projection.projected_tax, self.financial_year.calculate_tax(Decimal('34770.00'), False)[1])
+
+    def test_instalments_split_the_projected_tax(self):
+        projection = project_tax(self.financial_year, self.summary, False, as_of=date(2024, 9, 30))
+        self.assertEqual([instalment.due for instalment in projection.instalments],
+                         [date(2024, 8, 28), date(2025, 1, 15), date(2025, 5, 7)])
+        self.assertEqual(sum(instalment.amount for instalment in projection.instalments), projection.projected_tax)
+        self.assertTrue(all(instalment.past for instalment in projection.instalments))  # 2024 is over
+
+    def test_no_instalments_under_the_threshold(self):
+        Earning.objects.filter(financial_year=self.financial_year).delete()
+        projection = project_tax(self.financial_year, get_summary(self.financial_year), False, as_of=date(2024, 9, 30))
+        self.assertEqual(projection.instalments, [])
+
+    def test_saving_an_earning_moves_the_projection(self):
+        """The summary the projection reads is kept current by each save."""
+        before = project_tax(self.financial_year, self.summary, False, as_of=date(2024, 9, 30)).projected_earnings
+        Earning.objects.create(description='Extra', amount=Decimal('183.00'), date=date(2024, 9, 1),
+                               financial_year=self.financial_year)
+        after = project_tax(self.financial_year, get_summary(self.financial_year), False, as_of=date(2024, 9, 30))
+        self.assertEqual(after.projected_earnings - before, Decimal('365.00'))
+
+
+class YearReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = create_owner()
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=False, permanent_income=60000)
+        self.years = []
+        for year in range(2015, 2025):
+            financial_year = FinancialYear.objects.create(owner=self.owner, year=year)
+            self.years.append(financial_year)
+            Earning.objects.create(description='Invoice', amount=Decimal(1000 + year), date=date(year, 6, 1),
+                                   financial_year=financial_year)
+            for expense_type, amount in (('rent', 300), ('travel', 50), ('travel', 25)):
+                Expense.objects.create(description='Cost', amount=Decimal(amount), purchase_date=date(year, 7, 1),
+                                       expense_type=expense_type, financial_year=financial_year)
+        laptop = Expense.objects.create(description='Laptop', amount=Decimal(2000), purchase_date=date(2022, 5, 1),
+                                        expense_type='equipment', is_good=True, depreciation_rate=50,
+                                        depreciation_method=STRAIGHT_LINE, financial_year=self.years[7])
+        self.laptop_write_off = laptop.amount / 2
+
+    def test_every_year_in_a_few_queries(self):
+        # Years, brackets, the two ledgers and insert of the missing summaries,
+        # expense types, depreciation and personal details
+        with self.assertNumQueries(8):
+            reports = year_over_year(self.owner)
+        self.assertEqual(FinancialYearSummary.objects.filter(financial_year__owner=self.owner).count(), 10)
+        with self.assertNumQueries(3):  # Years, brackets and depreciation; the rest is cached
+            year_over_year(self.owner)
+        self.assertEqual([report.year for report in reports], list(range(2015, 2025)))
+        report = reports[0]
+        self.assertEqual(report.earnings, Decimal('3015.00'))
+        self.assertEqual(report.expenses_by_type, {'rent': Decimal('300.00'), 'travel': Decimal('75.00')})
+        self.assertEqual(report.tax_owed_earnings, self.years[0].calculate_tax(Decimal('2640.00'), False)[1])
+        self.assertEqual([r.depreciation for r in reports[7:9]], [self.laptop_write_off] * 2)
+        self.assertEqual(reports[9].depreciation, 0)
+        self.assertEqual(check_summary(self.years[0]), {})
+
+    def test_only_changed_years_are_grouped_again(self):
+        year_over_year(self.owner)
+        Expense.objects.create(description='Train', amount=Decimal(10), purchase_date=date(2024, 8, 1),
+                               expense_type='travel', financial_year=self.years[-1])
+        with CaptureQueriesContext(connection) as queries:
+            reports = year_over_year(self.owner)
+        grouped = [query['sql'] for query in queries if 'expense_type' in query['sql']]
+        self.assertEqual(len(grouped), 1)
+        self.assertIn(f'IN ({self.years[-1].pk})', grouped[0])
+        self.assertEqual(reports[-1].expenses_by_type['travel'], Decimal('85.00'))
+        self.assertEqual(reports[0].expenses_by_type['travel'], Decimal('75.00'))
+
+    def test_json_view(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('year_report_json'))
+        years = response.json()['years']
+        self.assertEqual(len(years), 10)
+        self.assertEqual(years[-1]['expenses_by_type']['rent'], '300.00')
+
+
+class GSTReturnTests(TestCase):
+    def setUp(self):
+        self.owner = create_owner()
+        PersonalDetails.objects.create(owner=self.owner, gst_registered=True, permanent_income=60000)
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=get_current_financial_year() - 1)
+        year = self.financial_year.year
+        for day, amount in ((date(year, 4, 10), 100), (date(year, 5, 20), 200), (date(year, 6, 1), 400)):
+            Earning.objects.create(description='Invoice', amount=Decimal(amount), date=day, financial_year=self.financial_year)
+        Expense.objects.create(description='Pens', amount=Decimal('23.00'), purchase_date=date(year, 5, 2),
+                               expense_type='office_supplies', financial_year=self.financial_year)
+
+    def test_filing_periods_follow_the_financial_year(self):
+        """Two-monthly periods run April-May, June-July and so on to February-March."""
+        periods = filing_periods(2023, 2)
+        self.assertEqual(len(periods), 6)
+        self.assertEqual(periods[0], (date(2023, 4, 1), date(2023, 5, 31)))
+        self.assertEqual(periods[-1], (date(2024, 2, 1), date(2024, 3, 31)))
+        self.assertEqual(filing_periods(2023, 6)[1], (date(2023, 10, 1), date(2024, 3, 31)))
+
+    def test_rows_are_grouped_by_period(self):
+        first, second = gst_returns(self.financial_year, 2)[:2]
+        self.assertEqual(first.sales, Decimal('345.00'))  # 300 before GST, plus 15%
+        self.assertEqual(first.gst_collected, Decimal('45.00'))
+        self.assertEqual(first.purchases, Decimal('23.00'))
+        self.assertEqual(first.gst_claimed, Decimal('3.00'))
+        self.assertEqual(first.gst_to_pay, Decimal('42.00'))
+        self.assertEqual(second.gst_collected, Decimal('60.00'))
+
+    def test_closed_periods_are_not_summed_again(self):
+        """A past year's returns are stored on the first read, after which only they are read."""
+        gst_returns(self.financial_year, 2)
+        self.assertEqual(GSTReturn.objects.filter(financial_year=self.financial_year, months=2).count(), 6)
+        with self.assertNumQueries(1):
+            periods = gst_returns(self.financial_year, 2)
+        self.assertTrue(all(period.closed for period in periods))
+        self.assertEqual(periods[0].gst_collected, Decimal('45.00'))
+
+    def test_back_dated_change_drops_stored_returns(self):
+        gst_returns(self.financial_year, 2)
+        Earning.objects.create(description='Late invoice', amount=Decimal(1000), date=date(self.financial_year.year, 4, 30),
+                               financial_year=self.financial_year)
+        self.assertFalse(GSTReturn.objects.filter(financial_year=self.financial_year).exists())
+        self.assertEqual(gst_returns(self.financial_year, 2)[0].gst_collected, Decimal('195.00'))
+
+    def test_back_dated_edit_in_the_view_stays_within_budget(self):
+        """Editing a depreciating asset in a closed period drops the stored returns within update_expense's budget."""
+        year = self.financial_year.year
+        laptop = Expense.objects.create(description='Laptop', amount=Decimal('2000.00'), purchase_date=date(year, 5, 3),
+                                        expense_type='equipment', is_good=True, depreciation_rate=25,
+                                        financial_year=self.financial_year)
+        gst_returns(self.financial_year, 2)
+        self.client.force_login(self.owner)
+        get_personal_details(self.owner.pk)
+        get_schedule(self.financial_year)
+        clear_year_cache()  # The worst case: the year is resolved again
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('update_expense', args=[laptop.pk]), {
+                'description': 'Laptop', 'amount': '2300.00', 'is_good': 'on', 'depreciation_rate': '25',
+                'depreciation_method': DIMINISHING_VALUE, 'expense_type': 'equipment', 'purchase_date': date(year, 5, 3).isoformat(),
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(GSTReturn.objects.filter(financial_year=self.financial_year).exists())
+        self.assertLessEqual(len(queries), query_budget_of(views.update_expense),
+                             '\n'.join(query['sql'] for query in queries.captured_queries))
+
+    def test_back_dated_earning_is_filed_in_its_year(self):
+        """A new earning goes to the year its date falls in, so its GST is in that year's returns."""
+        self.client.force_login(self.owner)
+        self.client.post(reverse('add_earning'), {
+            'description': 'Late invoice', 'amount': '100.00', 'date': date(self.financial_year.year, 7, 1).isoformat(),
+        })
+        earning = Earning.objects.get(description='Late invoice')
+        self.assertEqual(earning.financial_year, self.financial_year)
+        summary = get_summary(self.financial_year)
+        self.assertEqual(sum(period.gst_collected for period in gst_returns(self.financial_year, 2)), summary.gst_collected)
+
+    def test_editing_an_earnings_date_moves_it_to_that_year(self):
+        get_summary(self.financial_year)
+        current_year = FinancialYear.objects.create(owner=self.owner, year=self.financial_year.year + 1)
+        earning = Earning.objects.create(description='Invoice', amount=Decimal('100.00'),
+                                         date=date(current_year.year, 4, 2), financial_year=current_year)
+        self.client.force_login(self.owner)
+        self.client.post(reverse('earning_update', args=[earning.pk]), {
+            'description': 'Invoice', 'amount': '100.00', 'date': date(self.financial_year.year, 8, 1).isoformat(),
+        })
+        earning.refresh_from_db()
+        self.assertEqual(earning.financial_year, self.financial_year)
+        self.assertEqual(get_summary(current_year).total_earnings, 0)
+        self.assertEqual(check_summary(self.financial_year), {})
+
+    def test_description_change_keeps_stored_returns(self):
+        gst_returns(self.financial_year, 2)
+        earning = Earning.objects.for_owner(self.owner).first()
+        earning.description = 'Renamed'
+        earning.save()
+        self.assertEqual(GSTReturn.objects.filter(financial_year=self.financial_year).count(), 6)
+
+    def test_back_dated_import_drops_stored_returns(self):
+        gst_returns(self.financial_year, 2)
+        statement = f'date,amount,description\n{self.financial_year.year}-05-01,115.00,Late invoice\n'
+        import_statement(self.owner.pk, StringIO(statement), 'csv')
+        self.assertEqual(gst_returns(self.financial_year, 2)[0].gst_collected, Decimal('62.25'))
+
+    def test_view_lists_periods(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('gst_returns', args=[self.financial_year.pk]))
+        self.assertEqual(len(response.context['periods']), 6)
+        self.assertContains(response, '$42.00')
+
+    def test_dashboard_uses_the_stored_gst(self):
+        context = build_dashboard_context(financial_years().get(pk=self.financial_year.pk))
+        self.assertEqual(context['gst_to_pay'], Decimal('105.00'))
+        self.assertEqual(context['gst_to_claim'], Decimal('3.00'))
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin_user)
+        self.owner = create_owner()
+        self.financial_year = FinancialYear.objects.create(owner=self.owner, year=2024)
+        self.other_year = FinancialYear.objects.create(owner=self.owner, year=2023)
+        get_summary(self.financial_year)
+        get_summary(self.other_year)
+
+    def add_rows(self, count, financial_year=None):
+        financial_year = financial_year or self.financial_year
+        Expense.objects.bulk_create(
+            Expense(description=f'Cost {i}', amount=Decimal('115.00'), gst=0, purchase_date=date(2024, 6, 1),
+                    expense_type='rent', financial_year=financial_year, owner=self.owner)
+            for i in range(count)
+        )
+
+    def changelist_queries(self, model):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f'admin:finance_{model}_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelists_do_not_grow_with_rows(self):
+        for model in ('expense', 'depreciation', 'financialyear'):
+            with self.subTest(model=model):
+                self.add_rows(2)
+                few = self.changelist_queries(model)
+                self.add_rows(40)
+                self.assertEqual(self.changelist_queries(model), few)
+
+    def test_financial_year_totals_come_from_the_summary(self):
+        Earning.objects.create(description='Job', amount=Decimal('100.00'), date=date(2024, 6, 1),
+                               financial_year=self.financial_year)
+        response = self.client.get(reverse('admin:finance_financialyear_changelist'))
+        self.assertContains(response, '100.00')
+
+    def test_reassign_year_moves_rows_in_one_update(self):
+        """Rows filed under the wrong year go to the year of their date, which is created if missing."""
+        self.add_rows(3, self.other_year)
+        Expense.objects.bulk_create([Expense(
+            description='Next year', amount=Decimal('10.00'), gst=0, purchase_date=date(2025, 5, 1),
+            expense_type='rent', financial_year=self.other_year, owner=self.owner,
+        )])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reassign_financial_years(Expense.objects.all()), 4)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "finance_expense"') for query in queries), 1)
+        self.assertEqual(Expense.objects.filter(financial_year=self.financial_year).count(), 3)
+        self.assertEqual(Expense.objects.get(description='Next year').financial_year.year, 2025)
+        self.assertEqual(get_summary(self.financial_year).expense_count, 3)
+        self.assertEqual(get_summary(self.other_year).expense_count, 0)
+        self.assertEqual(reassign_financial_years(Expense.objects.all()), 0)
+
+    def test_recompute_gst(self):
+        self.add_rows(2)
+        Earning.objects.bulk_create([Earning(description='Job', amount=Decimal('100.01'), gst=0, date=date(2024, 6, 1),
+                                             financial_year=self.financial_year, owner=self.owner)])
+        GSTRate.objects.create(financial_year=self.financial_year, rate=Decimal('0.10'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(recompute_gst(Expense.objects.all()), 2)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "finance_expense"') for query in queries), 1)
+        recompute_gst(Earning.objects.all())
+        self.assertEqual(Expense.objects.first().gst, Decimal('10.45'))  # 115 * 0.1 / 1.1
+        self.assertEqual(Earning.objects.get().gst, Decimal('10.00'))
+        self.assertEqual(check_summary(self.financial_year), {})
+
+    def test_recompute_gst_rounds_half_cents_as_save_does(self):
+        """1.5 and 16.5 cents of GST round up, as money.ROUNDING does, in the batched recompute too."""
+        earnings = [
+            Earning.objects.create(description=f'Job {amount}', amount=Decimal(amount), date=date(2024, 6, 1),
+                                   financial_year=self.financial_year)
+            for amount in ('0.10', '1.10', '100.01')
+        ]
+        saved = {earning.pk: earning.gst for earning in earnings}
+        self.assertEqual(saved[earnings[0].pk], Decimal('0.02'))
+        self.assertEqual(saved[earnings[1].pk], Decimal('0.17'))
+        Earning.objects.update(gst=0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(recompute_gst(Earning.objects.all(), batch_size=2), 3)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "finance_earning"') for query in queries), 2)
+        self.assertEqual(dict(Earning.objects.values_list('pk', 'gst')), saved)
+        self.assertEqual(recompute_gst(Earning.objects.all()), 0)  # Nothing left to change
+        self.assertEqual(check_summary(self.financial_year), {})
+
+    def test_actions_through_the_admin(self):
+        self.add_rows(1)
+        expense = Expense.objects.get()
+        expense.is_good, expense.depreciation_rate = True, 50
+        Expense.objects.bulk_update([expense], ['is_good', 'depreciation_rate'])
+        self.client.post(reverse('admin:finance_expense_changelist'), {
+            'action': 'regenerate_depreciation', '_selected_action': [expense.pk],
+        })
+        self.assertEqual(Depreciation.objects.filter(expense=expense).count(), 0)  # 115 is under the $500 threshold
+        Expense.objects.filter(pk=expense.pk).update(amount=Decimal('1000.00'))
+        self.client.post(reverse('admin:finance_expense_changelist'), {
+            'action': 'regenerate_depreciation', '_selected_action': [expense.pk],
+        })
+        self.assertEqual(Depreciation.objects.filter(expense=expense).count(), 2)
+
+
+class RoutePerformanceTests(TestCase):
+    """
+    Request every route in finance/urls.py against a large ledger and hold each
+    view to its declared query budget, a wall-time limit and a peak-memory
+    limit. Budgets do not grow with the data, so an N+1 query fails here.
+    """
+    ROWS_PER_YEAR = 400
+    TIME_LIMIT = 2.0  # Seconds per request, generous so slow CI machines pass
+    MEMORY_LIMIT = 8 * 1024 * 1024  # Peak bytes allocated during a request
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = create_owner()
+        PersonalDetails.objects.create(owner=cls.owner, gst_registered=True, permanent_income=60000)
+        current_year = get_current_financial_year()
+        cls.financial_year = FinancialYear.objects.create(owner=cls.owner, year=current_year)
+        cls.last_year = FinancialYear.objects.create(owner=cls.owner, year=current_year - 1)
+        for financial_year in (cls.financial_year, cls.last_year):
+            start = timezone.datetime(financial_year.year, 4, 1).date()
+            Earning.objects.bulk_create(
+                Earning(description=f'Invoice {i}', reference=f'INV-{financial_year.year}-{i}',
+                        amount=Decimal(100 + i), gst=Decimal(15), date=start + timezone.timedelta(days=i % 365),
+                        financial_year=financial_year, owner=cls.owner)
+                for i in range(cls.ROWS_PER_YEAR)
+            )
+            Expense.objects.bulk_create(
+                Expense(description=f'Purchase {i}', reference=f'EXP-{financial_year.year}-{i}',
+                        amount=Decimal(50 + i), gst=Decimal(6), purchase_date=start + timezone.timedelta(days=i % 365),
+                        expense_type=Expense.EXPENSE_TYPES[i % len(Expense.EXPENSE_TYPES)][0],
+                        is_good=i % 10 == 0, depreciation_rate=25, financial_year=financial_year, owner=cls.owner)
+                for i in range(cls.ROWS_PER_YEAR)
+            )
+            recompute_all()
+            rebuild_summary(financial_year)
+        cls.earning = Earning.objects.filter(financial_year=cls.financial_year).first()
+        cls.expense = Expense.objects.filter(financial_year=cls.financial_year, is_good=True).first()
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, PDF_RENDER_WORKERS=0)
+        self.settings_override.enable()
+        self.client.force_login(self.owner)
+        # Per-process one-offs, not per-request work
+        get_personal_details(self.owner.pk)
+        for financial_year in (self.financial_year, self.last_year):
+            get_schedule(financial_year)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def routes(self):
+        """Every route as (url name, args, method, POST data)."""
+        today = timezone.now().date().isoformat()
+        self.expense.attachment.save('receipt.png', ContentFile(receipt_image('PNG')))  # Before the report, as it is a ledger change
+        job = request_report(financial_years().get(pk=self.financial_year.pk))
+        statement = SimpleUploadedFile('statement.csv', STATEMENT_CSV.encode(), content_type='text/csv')
+        return [
+            ('dashboard', [], 'get', None),
+            ('dashboard_pdf', [], 'get', None),
+            ('report_status', [job.pk], 'get', None),
+            ('report_download', [job.pk], 'get', None),
+            ('add_earning', [], 'get', None),
+            ('add_earning', [], 'post', {'description': 'New job', 'amount': '100.00', 'date': today}),
+            ('add_expense', [], 'get', None),
+            ('add_expense', [], 'post', {'description': 'Pens', 'amount': '20.00', 'expense_type': 'office_supplies',
+                                         'purchase_date': today, 'depreciation_method': STRAIGHT_LINE}),
+            ('import_statement', [], 'get', None),
+            ('import_statement', [], 'post', {'statement': statement, 'expense_type': 'travel'}),
+            ('export_ledger', ['expenses', 'csv'], 'get', None),
+            ('financial_year_detail', [self.last_year.pk], 'get', None),
+            ('ledger_page', [self.financial_year.pk, 'expenses'], 'get', None),
+            ('gst_returns', [self.last_year.pk], 'get', None),
+            ('year_report', [], 'get', None),
+            ('year_report_json', [], 'get', None),
+            ('update_personal_details', [], 'get', None),
+            ('earning_detail', [self.earning.pk], 'get', None),
+            ('expense_detail', [self.expense.pk], 'get', None),
+            ('earning_update', [self.earning.pk], 'get', None),
+            ('earning_update', [self.earning.pk], 'post', {'description': 'Edited', 'amount': '150.00', 'date': today}),
+            ('update_expense', [self.expense.pk], 'get', None),
+            ('update_expense', [self.expense.pk], 'post', {
+                'description': 'Edited laptop', 'amount': '2500.00', 'is_good': 'on', 'depreciation_rate': '40',
+                'depreciation_method': DIMINISHING_VALUE, 'expense_type': 'equipment', 'purchase_date': today,
+            }),
+            ('attachment', ['expenses', self.expense.pk], 'get', None),
+            ('attachment_preview', ['expenses', self.expense.pk, 'thumbnail'], 'get', None),
+            ('delete_earning', [self.earning.pk], 'get', None),
+            ('delete_expense', [self.expense.pk], 'get', None),
+            # Last, as saving the personal details makes the next request reload them
+            ('update_personal_details', [], 'post', {'gst_registered': 'on', 'gst_filing_months': '2', 'first_name': 'Jo', 'permanent_income': '70000'}),
+        ]
+
+    def measure(self, url, method, data):
+        """Request a URL, reading any streamed body, and return the response, queries, seconds and peak bytes."""
+        tracemalloc.start()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data) if data is not None else getattr(self.client, method)(url)
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    pass
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return response, queries, seconds, peak
+
+    def test_every_route_is_covered(self):
+        """A new route must declare a query budget and be added to routes()."""
+        covered = {name for name, args, method, data in self.routes()}
+        for pattern in urls.urlpatterns:
+            if pattern.name:
+                self.assertIn(pattern.name, covered)
+                self.assertIsNotNone(query_budget_of(pattern.callback), pattern.name)
+
+    def test_routes_stay_within_budget(self):
+        for name, args, method, data in self.routes():
+            with self.subTest(route=name, method=method):
+                url = reverse(name, args=args)
+                response, queries, seconds, peak = self.measure(url, method, data)
+                self.assertLess(response.status_code, 400)
+                budget = query_budget_of(resolve(url).func)
+                self.assertLessEqual(
+                    len(queries), budget,
+                    '\n'.join(query['sql'] for query in queries.captured_queries),
+                )
+                self.assertLess(seconds, self.TIME_LIMIT)
+                self.assertLess(peak, self.MEMORY_LIMIT)
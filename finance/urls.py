@@ -1,14 +1,20 @@
 from django.urls import path
 from . import views
-from django.conf.urls.static import static
-from django.conf import settings
 
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('dashboard/pdf/', views.dashboard_pdf, name='dashboard_pdf'),
+    path('reports/years/', views.year_report, name='year_report'),
+    path('reports/years/json/', views.year_report_json, name='year_report_json'),
+    path('reports/<int:pk>/', views.report_status, name='report_status'),
+    path('reports/<int:pk>/download/', views.report_download, name='report_download'),
     path('add-earning/', views.add_earning, name='add_earning'),
     path('add-expense/', views.add_expense, name='add_expense'),
+    path('import-statement/', views.import_statement_view, name='import_statement'),
+    path('export/<str:dataset>/<str:file_format>/', views.export_ledger, name='export_ledger'),
     path('financial-year/<int:pk>/', views.financial_year_detail, name='financial_year_detail'),
+    path('financial-year/<int:pk>/gst/', views.gst_return_periods, name='gst_returns'),
+    path('financial-year/<int:pk>/<str:ledger>/', views.ledger_page_view, name='ledger_page'),
     path('delete-earning/<int:pk>/', views.delete_earning, name='delete_earning'),
     path('delete-expense/<int:pk>/', views.delete_expense, name='delete_expense'),
     path('update-personal-details/', views.update_personal_details, name='update_personal_details'),
@@ -16,4 +22,6 @@ urlpatterns = [
     path('expense/<int:expense_id>/', views.expense_detail, name='expense_detail'),
     path('earning/update/<int:pk>/', views.EarningUpdateView.as_view(), name='earning_update'),
     path('expense/update/<int:pk>/', views.update_expense, name='update_expense'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('attachment/<str:ledger>/<int:pk>/', views.attachment, name='attachment'),
+    path('attachment/<str:ledger>/<int:pk>/<str:size>/', views.attachment_preview, name='attachment_preview'),
+]
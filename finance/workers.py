@@ -0,0 +1,11 @@
+import django
+
+
+def start_worker():
+    """
+    Set Django up in a new PDF worker process, before its first job. Kept
+    apart from the app's modules, which cannot be imported until this has run.
+    """
+    django.setup()
+    from .personal import distrust_local_stamps
+    distrust_local_stamps()
@@ -0,0 +1,118 @@
+from django.db import transaction
+from .caching import LRUCache, current_stamp, new_stamp
+from .models import FinancialYear, get_current_financial_year, get_financial_year_for_date
+
+# Process-local map of (owner pk, year) to (FinancialYear pk, stamp), where
+# year is e.g. 2024 for 2024-25. A year's row is never renumbered, so an entry
+# only goes stale when the row is deleted. Deleting a year moves the owner's
+# stamp on in the shared cache, and every process then drops its entries.
+# Ten years each for as many owners as personal.MAX_CACHED_OWNERS
+MAX_CACHED_YEARS = 10000
+_year_ids = LRUCache(MAX_CACHED_YEARS)
+
+
+def stamp_key(owner_id):
+    """Cache key of a user's years stamp, shared by every process like the personal details version stamp."""
+    return f'finance:financial_years:version:{owner_id}'
+
+
+def remember_year_id(owner_id, year, pk, stamp):
+    """
+    Add a year to the map once the transaction that read or created it
+    commits. ``stamp`` must be read before the row, so a deletion in between
+    leaves the entry already stale.
+    """
+    if stamp is None:
+        return  # A cache that stores nothing (e.g. DummyCache) cannot tell us when to forget
+    # A rolled-back insert must never be remembered, or later saves would
+    # point at a row that does not exist
+    transaction.on_commit(lambda: _year_ids.__setitem__((owner_id, year), (pk, stamp)))
+
+
+def known_year_id(owner_id, year, stamp):
+    """Return the pk of a year from the map, or None if it is not there or another process deleted a year since."""
+    entry = _year_ids.get((owner_id, year))
+    if entry is None or stamp is None:
+        return None
+    pk, entry_stamp = entry
+    if entry_stamp != stamp:
+        _year_ids.pop((owner_id, year), None)
+        return None
+    return pk
+
+
+def get_financial_year_id(owner_id, year):
+    """
+    Return the pk of a user's FinancialYear for a year, creating the row if it is missing.
+
+    Once a year is known this needs no query at all, only a read of the
+    owner's stamp from the cache. Creation goes
+    through ``get_or_create`` on the unique (owner, year), so when two requests
+    race to create the same year one insert wins and the other reads the winner's row.
+    """
+    stamp = current_stamp(stamp_key(owner_id))
+    pk = known_year_id(owner_id, year, stamp)
+    if pk is None:
+        pk = FinancialYear.objects.get_or_create(owner_id=owner_id, year=year)[0].pk
+        remember_year_id(owner_id, year, pk, stamp)
+    return pk
+
+
+def get_financial_year_id_for_date(owner_id, date):
+    """Return the pk of the user's FinancialYear a date falls in, creating it if missing."""
+    return get_financial_year_id(owner_id, get_financial_year_for_date(date))
+
+
+def get_financial_year(owner_id, year, queryset=None):
+    """
+    Return a user's FinancialYear for a year from ``queryset`` (every year by
+    default), creating the row if it is missing. One read when the year exists.
+    """
+    queryset = (FinancialYear.objects.all() if queryset is None else queryset).for_owner(owner_id)
+    stamp = current_stamp(stamp_key(owner_id))
+    financial_year = queryset.filter(year=year).first()
+    if financial_year is None:
+        get_financial_year_id(owner_id, year)
+        financial_year = queryset.get(year=year)
+    remember_year_id(owner_id, year, financial_year.pk, stamp)
+    return financial_year
+
+
+def get_current_year(owner_id, queryset=None):
+    """Return the user's FinancialYear of today's date, creating it if missing."""
+    return get_financial_year(owner_id, get_current_financial_year(), queryset)
+
+
+def resolve_financial_years(owner_id, years):
+    """Return a dict of year to a user's FinancialYear for many years at once, creating any that are missing."""
+    years = set(years)
+    stamp = current_stamp(stamp_key(owner_id))
+    owned = FinancialYear.objects.for_owner(owner_id)
+    financial_years = {financial_year.year: financial_year for financial_year in owned.filter(year__in=years)}
+    missing = years - set(financial_years)
+    if missing:
+        # One insert for every missing year; rows another request inserted
+        # first are skipped by the unique (owner, year) rather than raising
+        FinancialYear.objects.bulk_create(
+            [FinancialYear(owner_id=owner_id, year=year) for year in missing], ignore_conflicts=True,
+        )
+        for financial_year in owned.filter(year__in=missing):
+            financial_years[financial_year.year] = financial_year
+    for year, financial_year in financial_years.items():
+        remember_year_id(owner_id, year, financial_year.pk, stamp)
+    return financial_years
+
+
+def forget_financial_year(financial_year):
+    """
+    Drop a deleted FinancialYear from this process's map, and once the
+    deletion commits, tell every other process to drop the owner's years.
+    """
+    owner_id = financial_year.owner_id
+    _year_ids.pop((owner_id, financial_year.year), None)
+    transaction.on_commit(lambda: new_stamp(stamp_key(owner_id)))
+
+
+def clear_year_cache():
+    """Forget every year this process has resolved."""
+    _year_ids.clear()
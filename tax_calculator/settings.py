@@ -58,8 +58,16 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compile each template once per process rather than on every render.
+            # Django does this by default, but only while no loaders are listed,
+            # so it is spelt out here to keep it when loaders are added.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -76,11 +84,63 @@ WSGI_APPLICATION = 'tax_calculator.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_PROFILE picks the database: 'sqlite' (the default) or 'postgresql'.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'tax_calculator'),
+            'USER': os.environ.get('POSTGRES_USER', ''),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', ''),
+            'PORT': os.environ.get('POSTGRES_PORT', ''),
+            # Check a reused connection still works before handing it to a request
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    # With POSTGRES_POOL_MAX_SIZE set, each process keeps a psycopg pool of that
+    # many connections. Otherwise each thread keeps its own connection open for
+    # DATABASE_CONN_MAX_AGE seconds. Django allows one or the other, not both.
+    POSTGRES_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 0))
+    if POSTGRES_POOL_MAX_SIZE:
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+            'max_size': POSTGRES_POOL_MAX_SIZE,
+            'timeout': int(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),  # Seconds to wait for a free connection
+        }
+    else:
+        DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Take the write lock when a transaction begins. A deferred
+                # transaction that reads, then writes (get_or_create) fails at once
+                # with "database is locked" if another connection wrote meanwhile,
+                # whatever the busy timeout.
+                'transaction_mode': os.environ.get('SQLITE_TRANSACTION_MODE', 'IMMEDIATE'),
+            },
+        }
     }
+
+# Pragmas set on every new SQLite connection (see finance.signals). WAL lets
+# readers carry on while one connection writes, NORMAL syncs only at
+# checkpoints (safe in WAL mode), mmap_size maps that many bytes of the file
+# for reads, and busy_timeout is how many milliseconds a writer waits for the
+# lock before giving up.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
 }
 
 
@@ -102,9 +162,63 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Every ledger belongs to a user, so every page needs a signed-in user
+LOGIN_URL = 'login'
+LOGIN_REDIRECT_URL = 'dashboard'
+LOGOUT_REDIRECT_URL = 'login'
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploads are hashed as their chunks arrive, so identical attachments are
+# stored once under their digest
+FILE_UPLOAD_HANDLERS = [
+    'finance.attachments.HashingMemoryFileUploadHandler',
+    'finance.attachments.HashingTemporaryFileUploadHandler',
+]
+
+# How attachments are sent: unset streams them from Python with FileResponse,
+# 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx) hands the file
+# to the web server once the view has checked who is asking
+ATTACHMENT_SENDFILE = os.environ.get('ATTACHMENT_SENDFILE') or None
+# The internal nginx location that maps onto MEDIA_ROOT, for x-accel-redirect
+ATTACHMENT_ACCEL_REDIRECT_PREFIX = os.environ.get('ATTACHMENT_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
+# Holds the version stamps that keep each process's cached personal details
+# current. With more than one web process, point this at a shared backend
+# such as Redis or Memcached: check --deploy reports an error otherwise.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Web server processes (e.g. gunicorn --workers), read from the variable
+# gunicorn itself uses
+WEB_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Worker processes that render dashboard PDFs and attachment thumbnails in the
+# background. Set to 0 to do both in the request instead.
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', 2))
+# With no worker processes, async views render PDFs on a pool of this many
+# threads, so a burst of downloads cannot start a render per request.
+PDF_RENDER_THREADS = int(os.environ.get('PDF_RENDER_THREADS', 2))
+# Seconds after which a report job still pending or running is taken to have
+# lost its worker, and is queued again by the next request for it
+PDF_RENDER_TIMEOUT = int(os.environ.get('PDF_RENDER_TIMEOUT', 600))
+
+# Rows per page of the earnings and expenses tables
+LEDGER_PAGE_SIZE = 50
+
+# Seconds a rendered page of ledger rows stays in the cache. Its key changes
+# with the year's data, so this only bounds how long unused pages take up room.
+LEDGER_FRAGMENT_TIMEOUT = 60 * 60
+
+# Seconds a year's expenses by type stay cached for the year-over-year report.
+# Like the ledger pages, the key moves on with the year's data.
+YEAR_REPORT_TIMEOUT = 24 * 60 * 60
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/